@@ -0,0 +1,328 @@
+"""
+Benchmarks the robot and delivery hot paths, and reports the latency
+percentiles and throughput of every scenario as JSON.
+
+By default the server is driven in-process through the Flask test client,
+against a temporary database and state store. With --url, a running server
+is benchmarked instead; it must run with TESTING enabled for the
+delivery_patch scenario, which cycles deliveries through every state.
+
+    python benchmark.py --concurrency 8 --robots 50 --output results.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import timeit
+
+SCENARIOS = ['login', 'deliveries_post', 'deliveries_get', 'delivery_patch',
+             'robot_poll', 'robot_update', 'fleet_batch']
+
+SENDER = 'benchmark-sender'
+RECEIVER = 'benchmark-receiver'
+PASSWORD = 'benchmark'
+
+PATCH_STATES = ['MOVING_TO_SOURCE', 'AWAITING_AUTHENTICATION_SENDER',
+                'AWAITING_PACKAGE_LOAD', 'PACKAGE_LOAD_COMPLETE',
+                'MOVING_TO_DESTINATION', 'AWAITING_AUTHENTICATION_RECEIVER',
+                'AWAITING_PACKAGE_RETRIEVAL', 'PACKAGE_RETRIEVAL_COMPLETE',
+                'COMPLETE']
+PATCH_ROBOT_OFFSET = 1000000
+
+
+class TestClient:
+    """
+    Sends requests to the application in this process.
+    """
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data = None, headers = None):
+        r = self.client.open(path, method = method, data = data,
+                             headers = headers or {})
+        return (r.status_code, r.data)
+
+
+class HttpClient:
+    """
+    Sends requests to a running server, over a keep-alive session.
+    """
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, data = None, headers = None):
+        r = self.session.request(method, self.url + path, data = data,
+                                 headers = headers)
+        return (r.status_code, r.content)
+
+
+def percentile(latencies, p):
+    """
+    Returns the p-th percentile of a sorted list, by nearest rank.
+    """
+    if len(latencies) == 0:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(latencies))) - 1
+    return latencies[min(max(rank, 0), len(latencies) - 1)]
+
+
+def robot_sample():
+    return {'correction': random.uniform(-1.0, 1.0),
+            'angle': random.uniform(0.0, 360.0),
+            'distance': random.uniform(0.0, 100.0),
+            'motor': random.random() < 0.5}
+
+
+class Benchmark:
+    def __init__(self, make_client, options):
+        self.make_client = make_client
+        self.options = options
+        self.client = make_client()
+        self.headers = {}
+        self.targets = []
+
+    def request(self, client, method, path, data = None, headers = None):
+        if data is not None:
+            data = json.dumps(data)
+        return client.request(method, path, data, headers)
+
+    def setup(self):
+        for username in [SENDER, RECEIVER]:
+            self.request(self.client, 'POST', '/register',
+                         {'username': username, 'password': PASSWORD})
+        self.headers = self.login(self.client)
+
+        for name in ['Benchmark source', 'Benchmark destination']:
+            (status, body) = self.request(self.client, 'POST', '/targets',
+                                          {'name': name})
+        self.targets = [t['id'] for t in json.loads(body)][-2:]
+
+    def login(self, client):
+        (status, body) = self.request(client, 'POST', '/login', {
+            'username': SENDER, 'password': PASSWORD})
+        if status != 200:
+            raise Exception("Could not log in: " + body)
+        return {'Authorization': 'Bearer ' + json.loads(body)['bearer']}
+
+    def post_delivery(self, client):
+        return self.request(client, 'POST', '/deliveries', {
+            'name': 'Benchmark', 'priority': random.randint(0, 5),
+            'from': self.targets[0], 'to': self.targets[1],
+            'sender': SENDER, 'receiver': RECEIVER}, self.headers)
+
+    def robot_ids(self):
+        return range(0, self.options.robots)
+
+    def make_scenario(self, name):
+        """
+        Returns a function that sends the n-th request of a client in the
+        given scenario, after any setup it needs.
+        """
+        client = self.make_client()
+
+        if name == 'login':
+            return lambda n: self.request(client, 'POST', '/login', {
+                'username': SENDER, 'password': PASSWORD})
+        elif name == 'deliveries_post':
+            return lambda n: self.post_delivery(client)
+        elif name == 'deliveries_get':
+            return lambda n: self.request(client, 'GET', '/deliveries')
+        elif name == 'delivery_patch':
+            # Each worker cycles its own delivery with its own robot, which
+            # is numbered after the delivery so it cannot be busy already
+            (status, body) = self.post_delivery(client)
+            delivery = json.loads(body)['id']
+            robot = PATCH_ROBOT_OFFSET + delivery
+
+            def patch(n):
+                data = {'state': PATCH_STATES[n % len(PATCH_STATES)]}
+                if n % len(PATCH_STATES) == 0:
+                    data['robot'] = robot
+                return self.request(client, 'PATCH',
+                                    '/delivery/' + str(delivery), data)
+            return patch
+        elif name == 'robot_poll':
+            return lambda n: self.request(
+                client, 'GET',
+                '/robot/' + str(random.choice(self.robot_ids())) + '/batch')
+        elif name == 'robot_update':
+            return lambda n: self.request(
+                client, 'POST',
+                '/robot/' + str(random.choice(self.robot_ids())) + '/batch',
+                robot_sample())
+        elif name == 'fleet_batch':
+            def ingest(n):
+                data = []
+                for id in self.robot_ids():
+                    sample = robot_sample()
+                    sample['robot'] = id
+                    data.append(sample)
+                return self.request(client, 'POST', '/batch', data)
+            return ingest
+
+        raise ValueError("Unknown scenario: " + name)
+
+    def run_scenario(self, name):
+        options = self.options
+        count = options.requests
+        if name == 'login':
+            count = options.login_requests
+
+        # Split the requests between the workers
+        workers = [count // options.concurrency +
+                   (1 if i < count % options.concurrency else 0)
+                   for i in range(0, options.concurrency)]
+        senders = [self.make_scenario(name)
+                   for i in range(0, options.concurrency)]
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+
+        def run(send, requests):
+            timings = []
+            failed = 0
+            for n in range(0, requests):
+                start = timeit.default_timer()
+                (status, body) = send(n)
+                timings.append(timeit.default_timer() - start)
+                if status >= 400:
+                    failed += 1
+            with lock:
+                latencies.extend(timings)
+                errors[0] += failed
+
+        threads = [threading.Thread(target=run, args=(send, requests))
+                   for send, requests in zip(senders, workers)]
+        start = timeit.default_timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = timeit.default_timer() - start
+
+        latencies.sort()
+        result = {'requests': len(latencies), 'errors': errors[0],
+                  'seconds': elapsed,
+                  'rps': len(latencies) / elapsed if elapsed > 0 else None}
+        for p in [50, 95, 99]:
+            value = percentile(latencies, p)
+            if value is not None:
+                value *= 1000.0
+            result['p' + str(p) + '_ms'] = value
+        return result
+
+    def run(self, scenarios):
+        self.setup()
+        results = {}
+        for name in scenarios:
+            results[name] = self.run_scenario(name)
+            if name == 'login':
+                # Logging in replaces the bearer token used by other scenarios
+                self.headers = self.login(self.client)
+        return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd = os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure_app(app, directory, store):
+    """
+    Points the application at a temporary database and state store, so the
+    benchmark doesn't touch the development data.
+    """
+    app.config['TESTING'] = True
+    app.config['DATASET_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    app.config['SHELVE_FILENAME'] = os.path.join(directory, 'cache.db')
+    app.config['STATE_DATABASE_FILENAME'] = \
+        os.path.join(directory, 'state.db')
+    app.config['STATE_JOURNAL_FILENAME'] = \
+        os.path.join(directory, 'cache.journal')
+    app.config['TELEMETRY_LOG_DIR'] = os.path.join(directory, 'telemetry')
+    if store is not None:
+        app.config['STATE_STORE'] = store
+
+
+def parse_args(args = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[1])
+    parser.add_argument('--url', help = "benchmark a running server at "
+                        "this URL instead of the in-process test client")
+    parser.add_argument('--store', choices = ['shelve', 'memory', 'sqlite'],
+                        help = "state store used by the in-process server")
+    parser.add_argument('--scenarios', default = ','.join(SCENARIOS),
+                        help = "comma-separated scenarios to run")
+    parser.add_argument('--concurrency', type = int, default = 4,
+                        help = "number of concurrent clients")
+    parser.add_argument('--robots', type = int, default = 20,
+                        help = "fleet size")
+    parser.add_argument('--requests', type = int, default = 500,
+                        help = "requests per scenario")
+    parser.add_argument('--login-requests', type = int, default = 20,
+                        help = "requests for the login scenario")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', help = "also write the results here")
+
+    options = parser.parse_args(args)
+    options.scenarios = [s for s in options.scenarios.split(',') if s]
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: " + name)
+    return options
+
+
+def main(args = None):
+    options = parse_args(args)
+    random.seed(options.seed)
+
+    directory = None
+    if options.url is not None:
+        benchmark = Benchmark(lambda: HttpClient(options.url), options)
+    else:
+        import flaskapp
+        directory = tempfile.mkdtemp()
+        configure_app(flaskapp.app, directory, options.store)
+        benchmark = Benchmark(lambda: TestClient(flaskapp.app), options)
+
+    try:
+        scenarios = benchmark.run(options.scenarios)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    report = {
+        'commit': get_commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'target': options.url or 'test-client',
+        'store': options.store,
+        'concurrency': options.concurrency,
+        'robots': options.robots,
+        'scenarios': scenarios
+    }
+    output = json.dumps(report, indent = 2, sort_keys = True)
+    print(output)
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import hashlib
+import threading
+from classes import Target
+from encoder import dumps
+
+
+class TargetCatalogue:
+    """
+    An in-process copy of the targets table, by ID, along with its
+    serialised listing and ETag.
+
+    The catalogue follows a version counter that is incremented with every
+    change to the table. A process applies its own changes to the catalogue
+    directly, and reloads the whole table when it finds that the counter
+    moved on by more than its own change, i.e. when another process changed
+    the table meanwhile.
+
+    Listeners are called with the set of target IDs that were added,
+    changed or removed, after the catalogue was updated.
+    """
+
+    def __init__(self, load):
+        self.lock = threading.RLock()
+        self._load = load
+        self._targets = None
+        self._response = None
+        self._listeners = []
+        self.version = None
+
+    def add_listener(self, listener):
+        """
+        Adds a listener, which is called at once with the IDs of every
+        target if the catalogue is loaded, so that it starts in sync.
+        """
+        with self.lock:
+            self._listeners.append(listener)
+            if self._targets is not None and len(self._targets) > 0:
+                listener(set(self._targets.keys()))
+
+    def refresh(self, version):
+        """
+        Reloads the table unless the catalogue is at the given version.
+        """
+        with self.lock:
+            if self._targets is not None and self.version == version:
+                return
+
+            previous = self._targets
+            targets = {}
+            for row in self._load():
+                targets[row['id']] = Target.from_dict(row)
+
+            self._targets = targets
+            self._response = None
+            self.version = version
+            if previous is not None:
+                self._notify(changed_ids(previous, targets))
+
+    def apply(self, version, changes):
+        """
+        Applies changes made by this process at the given version, where
+        changes maps target IDs to the new target, or None if it was
+        deleted. If the catalogue wasn't at the previous version, it is
+        reloaded instead.
+        """
+        with self.lock:
+            if self._targets is None or self.version != version - 1:
+                self.version = None
+                self.refresh(version)
+                return
+
+            for id, target in changes.items():
+                if target is None:
+                    self._targets.pop(id, None)
+                else:
+                    self._targets[id] = target
+
+            self._response = None
+            self.version = version
+            self._notify(set(changes.keys()))
+
+    def _notify(self, ids):
+        if len(ids) > 0:
+            for listener in self._listeners:
+                listener(ids)
+
+    def get(self, id):
+        return self._targets.get(id)
+
+    def targets(self):
+        """
+        Returns the dictionary of targets by ID, which must not be modified.
+        """
+        return self._targets
+
+    def response(self):
+        """
+        Returns the serialised list of targets, ordered by ID, and its ETag.
+        """
+        with self.lock:
+            if self._response is None:
+                body = dumps([self._targets[id]
+                              for id in sorted(self._targets)])
+                self._response = (body, hashlib.md5(body).hexdigest())
+            return self._response
+
+
+def changed_ids(previous, targets):
+    ids = set(previous.keys()) ^ set(targets.keys())
+    for id in set(previous.keys()) & set(targets.keys()):
+        if previous[id].__getstate__() != targets[id].__getstate__():
+            ids.add(id)
+    return ids
@@ -1,6 +1,40 @@
 from enum import Enum
 
 
+class Record(object):
+    """
+    Base of the domain classes. Their fields are kept in __slots__ rather
+    than an instance dictionary, which makes large queues much smaller in
+    memory. Fields are read and written by name when pickled.
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+def is_number(value):
+    return (isinstance(value, (int, long, float)) and         # NOQA
+            not isinstance(value, bool))
+
+
+def target_id(target):
+    """
+    Returns the ID of a target given as an ID, a Target or a database row.
+    """
+    if isinstance(target, (int, long)):                 # NOQA
+        return target
+    elif isinstance(target, Target):
+        return target.id
+    return target['id']
+
+
 # A delivery contains packages
 class DeliveryState(Enum):
     IN_QUEUE = 0,
@@ -17,15 +51,25 @@ class DeliveryState(Enum):
     UNKNOWN = 5
 
 
-class Delivery:
+class Delivery(Record):
+    """
+    fromTarget and toTarget are the IDs of the targets, which are looked
+    up when the delivery is serialised rather than copied into it.
+    """
+
+    __slots__ = ('id', 'fromTarget', 'toTarget', 'name', 'description',
+                 'priority', 'sender', 'receiver', 'robot',
+                 'senderAuthToken', 'receiverAuthToken', 'state', 'minTemp',
+                 'maxTemp', 'timeLimit', 'version')
+
     def __init__(self, id, fromTarget, toTarget, sender, receiver,
                  priority, name, description = None,
                  state = DeliveryState.IN_QUEUE,
                  minTemp = None, maxTemp = None, timeLimit = None,
                  robot = None):
         self.id = id
-        self.fromTarget = fromTarget
-        self.toTarget = toTarget
+        self.fromTarget = target_id(fromTarget)
+        self.toTarget = target_id(toTarget)
         self.name = name
         self.description = description
         self.priority = priority
@@ -40,6 +84,9 @@ class Delivery:
         self.maxTemp = maxTemp
         self.timeLimit = timeLimit
 
+        # Incremented whenever the delivery is saved
+        self.version = 0
+
         if(minTemp and maxTemp and minTemp > maxTemp):
             raise ValueError("Invalid temperatures")
         if(timeLimit and timeLimit < 0):
@@ -52,7 +99,9 @@ class InstructionType(Enum):
     TURN = 1
 
 
-class Instruction:
+class Instruction(Record):
+    __slots__ = ('type', 'value')
+
     def __init__(self, type, value):
         self.type = type
         self.value = value
@@ -87,12 +136,21 @@ class Instruction:
 
 
 # Describes a possible target location
-class Target:
-    def __init__(self, id, name, description = None, color = None):
+class Target(Record):
+    """
+    x and y are the optional coordinates of the target, in metres.
+    """
+
+    __slots__ = ('id', 'name', 'description', 'color', 'x', 'y')
+
+    def __init__(self, id, name, description = None, color = None,
+                 x = None, y = None):
         self.id = id
         self.name = name
         self.description = description
         self.color = color
+        self.x = x
+        self.y = y
 
         if(not isinstance(id, int)):
             raise ValueError("ID must be positive integer")
@@ -106,6 +164,10 @@ class Target:
         elif(color is not None and
              not isinstance(color, basestring)):        # NOQA
             raise ValueError("Color must be string")
+        elif((x is None) != (y is None)):
+            raise ValueError("Must provide both coordinates")
+        elif(x is not None and not (is_number(x) and is_number(y))):
+            raise ValueError("Coordinates must be numbers")
 
     @classmethod
     def from_dict(self, obj):
@@ -124,10 +186,14 @@ class Target:
         if 'color' in obj:
             color = obj['color']
 
-        return Target(id, name, description, color)
+        return Target(id, name, description, color, obj.get('x'),
+                      obj.get('y'))
 
 
-class Robot:
+class Robot(Record):
+    __slots__ = ('id', 'motor', 'angle', 'distance', 'correction', 'lock',
+                 'delivery', 'location', 'version', 'batchCache')
+
     def __init__(self, id):
         self.id = id
         self.motor = False
@@ -136,3 +202,21 @@ class Robot:
         self.correction = 0.0
         self.lock = False
         self.delivery = None
+
+        # ID of the target the robot was last at, if known
+        self.location = None
+
+        # Incremented whenever the robot is saved. batchCache holds the
+        # serialised batch response for a version as (version, body, etag).
+        self.version = 0
+        self.batchCache = None
+
+    def __getstate__(self):
+        state = Record.__getstate__(self)
+        state['batchCache'] = None
+        return state
+
+    def __setstate__(self, state):
+        # Fields missing from older snapshots keep their defaults
+        self.__init__(state['id'])
+        Record.__setstate__(self, state)
@@ -0,0 +1,164 @@
+"""
+The serialisation format of the state store. Domain objects are written as
+a tuple of their fields in schema order, and the record is marshalled along
+with the format version and the tag of its schema, e.g.
+
+    (1, 'delivery', (3, 1, 2, 'Papers', ...))
+
+Marshalling a tuple of plain values is several times faster than pickling
+an instance, and the records carry neither class paths nor field names.
+
+Fields may be appended to the end of a schema: records written before keep
+the default of the fields they lack. Any other change to a schema must
+increment FORMAT_VERSION. Values without a schema are pickled.
+
+Snapshots written before this format was introduced kept every delivery
+and robot in one pickled dictionary of classic instances, which can't be
+read; the state stores discard them (see store.LEGACY_KEYS).
+"""
+import anydbm
+import cPickle
+import marshal
+import operator
+import os
+import shelve
+from classes import Delivery, DeliveryState, Instruction, InstructionType
+from classes import Robot, Target
+
+FORMAT_VERSION = 1
+
+# Pickles written with protocol 2 start with the PROTO opcode
+PICKLE_PREFIX = '\x80'
+
+
+class Schema:
+    """
+    Maps a class to its tuple of fields. fields is a list of (attribute,
+    default) pairs, and enums maps attributes holding an Enum to its class,
+    as enums are stored by name. transient maps attributes that aren't
+    stored to the value they are loaded with.
+    """
+
+    def __init__(self, cls, tag, fields, enums = {}, transient = {}):
+        self.cls = cls
+        self.tag = tag
+        self.transient = transient.items()
+        self.names = [name for name, default in fields]
+        self.defaults = [default for name, default in fields]
+        self.enums = [(self.names.index(name), enum)
+                      for name, enum in enums.items()]
+        self._getter = operator.attrgetter(*self.names)
+
+    def pack(self, obj):
+        values = self._getter(obj)
+        if len(self.enums) > 0:
+            values = list(values)
+            for i, enum in self.enums:
+                values[i] = values[i].name
+            values = tuple(values)
+        return values
+
+    def unpack(self, values):
+        if len(values) < len(self.names):
+            values = values + tuple(self.defaults[len(values):])
+        if len(self.enums) > 0:
+            values = list(values)
+            for i, enum in self.enums:
+                values[i] = enum[values[i]]
+
+        obj = self.cls.__new__(self.cls)
+        for name, value in zip(self.names, values):
+            setattr(obj, name, value)
+        for name, value in self.transient:
+            setattr(obj, name, value)
+        return obj
+
+
+SCHEMAS = [
+    Schema(Delivery, 'delivery', [
+        ('id', None), ('fromTarget', None), ('toTarget', None),
+        ('name', None), ('description', None), ('priority', None),
+        ('sender', None), ('receiver', None), ('robot', None),
+        ('senderAuthToken', None), ('receiverAuthToken', None),
+        ('state', 'IN_QUEUE'), ('minTemp', None), ('maxTemp', None),
+        ('timeLimit', None), ('version', 0)
+    ], {'state': DeliveryState}),
+    # The batch cache of a robot is rebuilt on demand, so it isn't stored
+    Schema(Robot, 'robot', [
+        ('id', None), ('motor', False), ('angle', 0.0), ('distance', 0.0),
+        ('correction', 0.0), ('lock', False), ('delivery', None),
+        ('version', 0), ('location', None)
+    ], transient = {'batchCache': None}),
+    Schema(Target, 'target', [
+        ('id', None), ('name', None), ('description', None), ('color', None),
+        ('x', None), ('y', None)
+    ]),
+    Schema(Instruction, 'instruction', [
+        ('type', None), ('value', None)
+    ], {'type': InstructionType})
+]
+
+SCHEMAS_BY_CLASS = dict((schema.cls, schema) for schema in SCHEMAS)
+SCHEMAS_BY_TAG = dict((schema.tag, schema) for schema in SCHEMAS)
+
+
+def dumps(value):
+    schema = SCHEMAS_BY_CLASS.get(value.__class__)
+    if schema is not None:
+        return marshal.dumps((FORMAT_VERSION, schema.tag,
+                              schema.pack(value)), 2)
+
+    try:
+        return marshal.dumps((FORMAT_VERSION, None, value), 2)
+    except ValueError:
+        # The value is, or contains, an object marshal can't serialise
+        return cPickle.dumps(value, 2)
+
+
+def loads(data):
+    if data[:1] == PICKLE_PREFIX:
+        return cPickle.loads(data)
+
+    (version, tag, value) = marshal.loads(data)
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported state format version: " +
+                         str(version))
+    if tag is None:
+        return value
+    return SCHEMAS_BY_TAG[tag].unpack(value)
+
+
+class CompactShelf(shelve.Shelf):
+    """
+    A shelf storing its values in the compact format instead of pickles.
+    """
+
+    def __getitem__(self, key):
+        return loads(self.dict[key])
+
+    def __setitem__(self, key, value):
+        self.dict[key] = dumps(value)
+
+
+def open_shelf(filename):
+    return CompactShelf(anydbm.open(filename, 'c'))
+
+
+def fsync_shelf(filename):
+    """
+    Waits until a closed shelf is on disk. Depending on the dbm module, a
+    shelf is kept in the file itself, in filename.db, or in filename.dat and
+    filename.dir, which is replaced through a rename on every commit, so the
+    directory is synced as well.
+    """
+    for path in [filename] + [filename + ext for ext in
+                              ('.db', '.dat', '.dir', '.bak')]:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                os.fsync(f.fileno())
+
+    fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -1,5 +1,29 @@
 class Config:
     DEBUG = True
     DATASET_DATABASE_URI = 'sqlite:///development.db'
+    DATABASE_POOL_SIZE = 5
+    BEARER_CACHE_TTL = 300.0
+    BCRYPT_LOG_ROUNDS = 12
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_QUEUE_LIMIT = 16
     SHELVE_FILENAME = 'development-cache.db'
+    STATE_STORE = 'memory'
+    STATE_SNAPSHOT_INTERVAL = 5.0
+    STATE_JOURNAL_FILENAME = 'development-cache.journal'
+    STATE_JOURNAL_COMMIT_INTERVAL = 0.05
+    STATE_RECOVER = True
+    STATE_DATABASE_FILENAME = 'development-state.db'
+    DELIVERY_ID_BLOCK_SIZE = 100
+    LONG_POLL_TIMEOUT = 30
+    LONG_POLL_INTERVAL = 1.0
+    ROBOT_LOCK_TIMEOUT = 5.0
+    METRICS_ENABLED = False
+    DISPATCH_POLICY = 'priority'
+    DISPATCH_INTERVAL = 0
+    ROBOT_SPEED = 0.5
+    TELEMETRY_CAPACITY = 3600
+    TELEMETRY_MAX_POINTS = 500
+    TELEMETRY_LOG_DIR = 'development-telemetry'
+    TELEMETRY_SEGMENT_RECORDS = 65536
+    TELEMETRY_MAX_SEGMENTS = 16
     HOST = '0.0.0.0'
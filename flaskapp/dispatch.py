@@ -0,0 +1,81 @@
+import bisect
+import operator
+
+robot_id = operator.attrgetter('id')
+
+
+def same_target_distance(a, b):
+    """
+    Distance between targets while their positions are unknown: robots at
+    the target itself are nearest, and every other robot is equally far.
+    None means the distance is unknown.
+    """
+    if a is not None and a == b:
+        return 0.0
+    return None
+
+
+class PriorityPolicy:
+    """
+    Assigns the deliveries in order of priority to the idle robots in order
+    of ID.
+    """
+
+    def assign(self, deliveries, robots):
+        return zip(deliveries, sorted(robots, key=robot_id))
+
+
+class RoundRobinPolicy:
+    """
+    Like PriorityPolicy, but takes turns between the robots, starting after
+    the robot assigned last, so that work is spread over the fleet.
+    """
+
+    def __init__(self):
+        self.last = None
+
+    def assign(self, deliveries, robots):
+        robots = sorted(robots, key=robot_id)
+        if self.last is not None:
+            i = bisect.bisect_right([r.id for r in robots], self.last)
+            robots = robots[i:] + robots[:i]
+
+        pairs = zip(deliveries, robots)
+        if len(pairs) > 0:
+            self.last = pairs[-1][1].id
+        return pairs
+
+
+class NearestTargetPolicy:
+    """
+    Assigns each delivery, in order of priority, to the idle robot nearest
+    to its source, according to distance(a, b) between target IDs. Robots
+    whose distance is unknown come last, and ties go to the lowest ID.
+    """
+
+    def __init__(self, distance = same_target_distance):
+        self.distance = distance
+
+    def assign(self, deliveries, robots):
+        free = sorted(robots, key=robot_id)
+        pairs = []
+        for delivery in deliveries:
+            if len(free) == 0:
+                break
+
+            best = None
+            bestRank = None
+            for i, robot in enumerate(free):
+                distance = self.distance(robot.location, delivery.fromTarget)
+                rank = (distance is None, distance)
+                if best is None or rank < bestRank:
+                    (best, bestRank) = (i, rank)
+            pairs.append((delivery, free.pop(best)))
+        return pairs
+
+
+POLICIES = {
+    'priority': PriorityPolicy,
+    'nearest': NearestTargetPolicy,
+    'round-robin': RoundRobinPolicy
+}
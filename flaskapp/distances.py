@@ -0,0 +1,125 @@
+import array
+import math
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DistanceMatrix:
+    """
+    Distances between every pair of targets with coordinates. Each target
+    is given a slot, i.e. a row and a column of a square matrix, so that
+    adding or moving a target only recomputes its own row and column, and
+    the distance between two targets is a single lookup. The slots of
+    removed targets are reused.
+
+    The matrix is a NumPy array when NumPy is installed, and a list of
+    arrays of doubles otherwise. Distances of unused slots are NaN.
+    """
+
+    def __init__(self, speed = 1.0):
+        self.lock = threading.Lock()
+        self.speed = speed
+        self.numpy = numpy
+        self._slots = {}
+        self._free = []
+        self._size = 0
+        self._xs = []
+        self._ys = []
+        self._rows = self._empty(0)
+
+    def _empty(self, capacity):
+        if self.numpy is not None:
+            return self.numpy.full((capacity, capacity), float('nan'))
+        return [array.array('d', [float('nan')] * capacity)
+                for i in range(0, capacity)]
+
+    def _grow(self):
+        capacity = max(8, 2 * self._size)
+        rows = self._empty(capacity)
+        if self.numpy is not None:
+            rows[:self._size, :self._size] = self._rows
+        else:
+            for i in range(0, self._size):
+                rows[i][:self._size] = self._rows[i]
+        self._xs += [float('nan')] * (capacity - self._size)
+        self._ys += [float('nan')] * (capacity - self._size)
+        self._free = range(capacity - 1, self._size - 1, -1) + self._free
+        self._rows = rows
+        self._size = capacity
+
+    def __contains__(self, id):
+        return id in self._slots
+
+    def set(self, id, x, y):
+        """
+        Adds a target at (x, y), or moves it there.
+        """
+        with self.lock:
+            if id not in self._slots:
+                if len(self._free) == 0:
+                    self._grow()
+                self._slots[id] = self._free.pop()
+            slot = self._slots[id]
+            self._xs[slot] = x
+            self._ys[slot] = y
+
+            if self.numpy is not None:
+                row = self.numpy.hypot(self.numpy.array(self._xs) - x,
+                                       self.numpy.array(self._ys) - y)
+                self._rows[slot, :] = row
+                self._rows[:, slot] = row
+            else:
+                row = self._rows[slot]
+                for i in range(0, self._size):
+                    row[i] = math.hypot(self._xs[i] - x, self._ys[i] - y)
+                    self._rows[i][slot] = row[i]
+
+    def remove(self, id):
+        with self.lock:
+            slot = self._slots.pop(id, None)
+            if slot is not None:
+                self._xs[slot] = float('nan')
+                self._ys[slot] = float('nan')
+                self._free.append(slot)
+
+    def update(self, targets, ids):
+        """
+        Brings the given targets up to date from a dictionary of targets by
+        ID. Targets that are missing from it or have no coordinates are
+        removed.
+        """
+        for id in ids:
+            target = targets.get(id)
+            if target is None or target.x is None or target.y is None:
+                self.remove(id)
+            else:
+                self.set(id, target.x, target.y)
+
+    def distance(self, a, b):
+        """
+        Returns the distance between two targets, or None if either of them
+        has no coordinates. A target is at no distance from itself.
+        """
+        if a is not None and a == b:
+            return 0.0
+        i = self._slots.get(a)
+        j = self._slots.get(b)
+        if i is None or j is None:
+            return None
+        if self.numpy is not None:
+            return float(self._rows[i, j])
+        return self._rows[i][j]
+
+    def eta(self, a, b):
+        """
+        Returns the time a robot takes to travel between two targets, or
+        None if the distance is unknown.
+        """
+        distance = self.distance(a, b)
+        if distance is None:
+            return None
+        return distance / self.speed
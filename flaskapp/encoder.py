@@ -2,46 +2,86 @@ from flask.json import JSONEncoder
 from classes import Instruction, Target, Delivery, DeliveryState
 
 
+def encode_target(obj, targets):
+    res = {'id': obj.id, 'name': obj.name}
+    if obj.description is not None:
+        res['description'] = obj.description
+    if obj.color is not None:
+        res['color'] = obj.color
+    if obj.x is not None:
+        res['x'] = obj.x
+    if obj.y is not None:
+        res['y'] = obj.y
+    return res
+
+
+def encode_delivery(obj, targets):
+    """
+    The targets of a delivery are encoded from the targets given, or as
+    {'id': ID} if they aren't known.
+    """
+    res = {'id': obj.id, 'name': obj.name, 'priority': obj.priority,
+           'state': obj.state, 'sender': obj.sender,
+           'receiver': obj.receiver,
+           'from': targets.get(obj.fromTarget) or {'id': obj.fromTarget},
+           'to': targets.get(obj.toTarget) or {'id': obj.toTarget}}
+    if obj.robot is not None:
+        res['robot'] = obj.robot
+    if obj.description is not None:
+        res['description'] = obj.description
+    return res
+
+
+# Encoders of the domain classes, looked up by the exact class of an object
+ENCODERS = {
+    Instruction: lambda obj, targets: {'type': obj.type.name,
+                                       'value': obj.value},
+    Target: encode_target,
+    DeliveryState: lambda obj, targets: obj.name,
+    Delivery: encode_delivery
+}
+
+
+def find_encoder(obj):
+    encode = ENCODERS.get(obj.__class__)
+    if encode is None:
+        for cls, candidate in ENCODERS.items():
+            if isinstance(obj, cls):
+                return candidate
+    return encode
+
+
 class CustomJSONEncoder(JSONEncoder):
+    """
+    Encodes the domain objects. The targets referred to by deliveries are
+    looked up in the targets keyword argument, a dictionary by ID.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.targets = kwargs.pop('targets', None) or {}
+        super(CustomJSONEncoder, self).__init__(*args, **kwargs)
+
     def default(self, obj):
-        if isinstance(obj, Instruction):
-            return {
-                'type': obj.type.name,
-                'value': obj.value
-            }
-        elif isinstance(obj, Target):
-            res = {
-                'id': obj.id,
-                'name': obj.name
-            }
-
-            if obj.description is not None:
-                res['description'] = obj.description
-
-            if obj.color is not None:
-                res['color'] = obj.color
-
-            return res
-        elif isinstance(obj, DeliveryState):
-            return obj.name
-        elif isinstance(obj, Delivery):
-            res = {
-                'id': obj.id,
-                'name': obj.name,
-                'priority': obj.priority,
-                'from': obj.fromTarget,
-                'to': obj.toTarget,
-                'state': obj.state,
-                'sender': obj.sender,
-                'receiver': obj.receiver
-            }
-
-            if obj.robot is not None:
-                res['robot'] = obj.robot
-
-            if obj.description is not None:
-                res['description'] = obj.description
-
-            return res
+        encode = find_encoder(obj)
+        if encode is not None:
+            return encode(obj, self.targets)
 
         return super(CustomJSONEncoder, self).default(obj)
+
+
+# Neither indenting nor sorting keys, as either makes the json module fall
+# back from its C encoder to the pure Python one
+FAST_ENCODER = CustomJSONEncoder(separators = (',', ':'))
+
+
+def dumps(obj, targets = None):
+    """
+    Serialises obj compactly, with the C encoder of the json module when the
+    interpreter provides it. Use this instead of jsonify for large or
+    frequent responses. targets is a dictionary of the targets deliveries
+    refer to, by ID.
+    """
+    if targets is None:
+        return FAST_ENCODER.encode(obj)
+    return CustomJSONEncoder(separators = (',', ':'),
+                             targets = targets).encode(obj)
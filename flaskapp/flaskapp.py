@@ -1,35 +1,311 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, g, has_request_context
+import flask
 import dataset
-import shelve
+import atexit
+import hashlib
+import time
 import random
 import string
-from flask_bcrypt import Bcrypt
-from classes import Delivery, Robot, Target, DeliveryState
-from encoder import CustomJSONEncoder
+import threading
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from classes import Delivery, Robot, Target, DeliveryState, is_number
+from encoder import CustomJSONEncoder, dumps
+from store import create_store, is_threaded_store
+from indexes import DeliveryIndex
+from allocator import IdAllocator
+from catalogue import TargetCatalogue
+from dispatch import POLICIES, NearestTargetPolicy
+from statemachine import DELIVERY_STATES
+from distances import DistanceMatrix
+from tokens import TokenCache
+from hashing import PasswordHasher, PoolSaturatedException
+from notifier import RobotNotifier
+from locks import RobotLocks
+from telemetry import TelemetryHistory, TelemetryLog
+from metrics import Metrics, NULL_TIMER
 
 app = Flask(__name__)
 app.config.from_object('config.Config')
 app.json_encoder = CustomJSONEncoder
-bcrypt = Bcrypt(app)
+robot_notifier = RobotNotifier()
+robot_locks = RobotLocks()
+delivery_locks = RobotLocks()
+telemetry_history = None
+telemetry_log = None
+metrics = Metrics()
+metrics.describe('flaskapp_request_duration_seconds', 'histogram',
+                 'Time taken to serve requests, by route.')
+metrics.describe('flaskapp_requests_total', 'counter',
+                 'Requests served, by route and status code.')
+metrics.describe('flaskapp_stage_duration_seconds', 'histogram',
+                 'Time spent in each stage of requests, by route.')
+metrics.describe('flaskapp_cache_requests_total', 'counter',
+                 'Cache lookups, by cache and result.')
+metrics.describe('flaskapp_dispatch_duration_seconds', 'histogram',
+                 'Time taken to dispatch queued deliveries, by policy.')
+metrics.describe('flaskapp_dispatch_assignments_total', 'counter',
+                 'Deliveries dispatched to robots, by policy and result.')
+
+
+def metrics_enabled():
+    return app.config.get('METRICS_ENABLED', False)
+
+
+def get_route():
+    if not has_request_context():
+        return ''
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+def timed(stage):
+    """
+    Times a stage of the current request (e.g. 'db' or 'json') when
+    METRICS_ENABLED is set, and does nothing otherwise.
+    """
+    if not metrics_enabled():
+        return NULL_TIMER
+    return metrics.timer('flaskapp_stage_duration_seconds',
+                         {'route': get_route(), 'stage': stage})
+
+
+def count_cache_lookup(cache, hit):
+    if metrics_enabled():
+        metrics.inc('flaskapp_cache_requests_total',
+                    {'cache': cache, 'result': 'hit' if hit else 'miss'})
+
+
+def jsonify(*args, **kwargs):
+    with timed('json'):
+        return flask.jsonify(*args, **kwargs)
+
+
+def json_response(obj, targets = None):
+    """
+    Like jsonify, but serialised compactly through encoder.dumps, which is
+    much faster for large collections. Responses with deliveries must pass
+    the targets they refer to, from get_targets().
+    """
+    with timed('json'):
+        body = dumps(obj, targets)
+    return app.response_class(body, mimetype='application/json')
+
+
+databases = {}
+
+TARGET_COLUMNS = [('name', 'text'), ('description', 'text'),
+                  ('color', 'text'), ('x', 'float'), ('y', 'float')]
+
+
+def create_schema(db):
+    """
+    Creates the targets table and all of its columns, rather than letting
+    them be created as they are first written. Every process keeps the
+    table metadata it reflected, so the table is never dropped or altered
+    afterwards.
+    """
+    targets = db.create_table('targets')
+    for (name, type) in TARGET_COLUMNS:
+        targets.create_column(name, getattr(db.types, type))
+
+
+def get_database():
+    """
+    Databases are connected once per process, so the engine, its connection
+    pool and the reflected table metadata are shared by every request.
+    """
+    uri = app.config['DATASET_DATABASE_URI']
+    if uri not in databases:
+        engine_kwargs = {
+            'poolclass': QueuePool,
+            'pool_size': app.config.get('DATABASE_POOL_SIZE', 5)
+        }
+        if uri.startswith('sqlite'):
+            # Pooled connections are handed from thread to thread
+            engine_kwargs['connect_args'] = {'check_same_thread': False}
+
+        # Workers starting together may create the schema at once, in which
+        # case the losers reconnect and reflect the winner's
+        for attempt in range(0, 3):
+            db = dataset.connect(uri, engine_kwargs=engine_kwargs)
+            try:
+                create_schema(db)
+                break
+            except OperationalError:
+                db.engine.dispose()
+                if attempt == 2:
+                    raise
+
+        databases[uri] = db
+        event.listen(databases[uri].engine,
+                     'before_cursor_execute', start_query_timer)
+        event.listen(databases[uri].engine,
+                     'after_cursor_execute', stop_query_timer)
+    return databases[uri]
+
+
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    if metrics_enabled():
+        context.queryTimer = timed('db')
+        context.queryTimer.__enter__()
+
+
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    timer = getattr(context, 'queryTimer', None)
+    if timer is not None:
+        timer.__exit__(None, None, None)
 
 
 def get_db():
     if not hasattr(g, 'db'):
-        g.db = dataset.connect(app.config['DATASET_DATABASE_URI'])
+        g.db = get_database()
     return g.db
 
 
+state_store = None
+
+
+def get_state_store():
+    """
+    The state store is created once per process and selected through
+    STATE_STORE in the configuration.
+    """
+    global state_store
+    if state_store is None:
+        state_store = create_store(app.config)
+        atexit.register(state_store.flush)
+    return state_store
+
+
+delivery_index = None
+delivery_index_position = None
+delivery_index_lock = threading.Lock()
+
+
+def get_delivery_index():
+    """
+    The delivery index orders the deliveries in the state store by priority.
+    It is built from the store on first use and kept up to date as
+    deliveries are added, saved and deleted.
+
+    A shared state store may also be changed by other worker processes, so
+    the index then catches up with the committed changes once per request.
+    """
+    global delivery_index, delivery_index_position
+    shared = get_state_store().shared
+    if delivery_index is not None and (not shared or
+                                       g.get('deliveryIndexRefreshed')):
+        return delivery_index
+
+    with delivery_index_lock:
+        if not shared:
+            if delivery_index is None:
+                index = DeliveryIndex()
+                for key in get_cache().keys():
+                    if key.startswith('delivery:'):
+                        delivery = get_cache()[key]
+                        index.add(delivery)
+                delivery_index = index
+        else:
+            index = delivery_index or DeliveryIndex()
+            (position, reset, entries) = get_state_store().changes(
+                'delivery:', delivery_index_position)
+            if reset:
+                index.clear()
+            for key, delivery in entries:
+                id = int(key[len('delivery:'):])
+                if delivery is not None:
+                    index.add(delivery)
+                elif id in index:
+                    index.remove(id)
+            delivery_index = index
+            delivery_index_position = position
+            g.deliveryIndexRefreshed = True
+
+    return delivery_index
+
+
+def reset_state():
+    """
+    Clears the state store and the delivery index. This can run outside of
+    a request, e.g. once in the server process before workers are started.
+    """
+    cache = get_state_store().open()
+    try:
+        cache.clear()
+    finally:
+        cache.close()
+
+    if delivery_index is not None:
+        delivery_index.clear()
+    target_catalogues.clear()
+    distance_matrices.clear()
+
+
 def get_cache():
     """
-    The cache is meant to be a volatile data store backed by shelve.
+    The cache is meant to be a volatile data store backed by the state store.
     It can store arbitrary objects.
     """
     if not hasattr(g, 'cache'):
-        g.cache = shelve.open(app.config['SHELVE_FILENAME'], protocol=2,
-                              writeback=True)
+        with timed('cache_open'):
+            g.cache = get_state_store().open()
     return g.cache
 
 
+id_allocators = {}
+
+
+def get_delivery_id_allocator():
+    """
+    Delivery IDs are allocated in blocks of DELIVERY_ID_BLOCK_SIZE, from a
+    sequence in the state store. Allocators are kept per store, as blocks
+    are only valid for the store they were reserved from.
+    """
+    store = get_state_store()
+    if store not in id_allocators:
+        id_allocators[store] = IdAllocator(
+            'deliveryQueue', app.config.get('DELIVERY_ID_BLOCK_SIZE', 100))
+    return id_allocators[store]
+
+
+password_hasher = None
+
+
+def get_password_hasher():
+    """
+    Password hashing runs on a process-wide worker pool sized through
+    PASSWORD_HASH_WORKERS and PASSWORD_HASH_QUEUE_LIMIT.
+    """
+    global password_hasher
+    if password_hasher is None:
+        password_hasher = PasswordHasher(
+            app.config.get('BCRYPT_LOG_ROUNDS', 12),
+            app.config.get('PASSWORD_HASH_WORKERS', 2),
+            app.config.get('PASSWORD_HASH_QUEUE_LIMIT', 16))
+    return password_hasher
+
+
+token_caches = {}
+
+
+def get_token_cache():
+    """
+    Bearer tokens are cached per database, as they are only valid for the
+    users table they were issued from.
+    """
+    uri = app.config['DATASET_DATABASE_URI']
+    if uri not in token_caches:
+        token_caches[uri] = TokenCache(app.config.get('BEARER_CACHE_TTL',
+                                                      300.0))
+    return token_caches[uri]
+
+
 def generate_bearer_token():
     return ''.join([random.choice(string.ascii_letters + string.digits)
                     for n in range(32)])
@@ -48,6 +324,10 @@ class InvalidBearerException(Exception):
     pass
 
 
+class ConflictException(Exception):
+    pass
+
+
 def get_data_object():
     data = {}
     try:
@@ -67,23 +347,75 @@ def get_username(headers):
         raise InvalidBearerException("Bearer token invalid.")
 
     bearer = headers['Authorization'][7:]
+    current = None
+    if get_state_store().shared:
+        current = get_current_bearer
+    username = get_token_cache().get(bearer, current)
+    count_cache_lookup('bearer', username is not None)
+    if username is not None:
+        return username
+
     usersTable = get_db()['users']
     user = usersTable.find_one(bearer=bearer)
 
     if user is None:
         raise InvalidBearerException("This bearer token is invalid.")
 
+    get_token_cache().set(bearer, user['username'])
     return user['username']
 
 
+def bearer_key(username):
+    # Store keys are byte strings
+    return 'bearer:' + username.encode('utf-8')
+
+
+def get_current_bearer(username):
+    """
+    Returns the token a user was last given, as recorded in the state store
+    so that every worker can check the tokens it cached against it, or None
+    if the user hasn't logged in since the state was cleared.
+    """
+    key = bearer_key(username)
+    cache = get_cache()
+    return cache[key] if key in cache else None
+
+
 @app.before_first_request
 def startup():
-    if 'DEBUG' not in app.config or not app.config['DEBUG']:
+    if app.config.get('STATE_CLEARED'):
+        # Already cleared by the server before it started this worker
+        pass
+    elif app.config.get('STATE_RECOVER'):
+        # Loading the store replays its journal
+        print('Recovering cache...')
+        get_state_store()
+    elif 'DEBUG' not in app.config or not app.config['DEBUG']:
         print('Clearing cache...')
-        get_cache().clear()
+        reset_state()
     else:
         print('Skipping cache clear as we are running in debug mode.')
 
+    start_dispatcher()
+
+
+@app.before_request
+def start_request_timer():
+    if metrics_enabled():
+        g.requestStart = time.time()
+
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.pop('requestStart', None)
+    if start is not None:
+        labels = {'route': get_route(), 'method': request.method}
+        metrics.observe('flaskapp_request_duration_seconds', labels,
+                        time.time() - start)
+        labels['status'] = str(response.status_code)
+        metrics.inc('flaskapp_requests_total', labels)
+    return response
+
 
 @app.teardown_request
 def force_cache_sync(exc):
@@ -92,6 +424,21 @@ def force_cache_sync(exc):
     except Exception:
         pass
 
+    # Wake up requests long-polling the robots saved by this request
+    for id in g.pop('savedRobots', ()):
+        robot_notifier.notify(id)
+    g.pop('deliveryIndexRefreshed', None)
+    g.pop('deliveryVersions', None)
+    g.pop('targetCatalogue', None)
+
+    # Robots are only unlocked once this request's changes are committed
+    g.pop('robots', None)
+    g.pop('robotVersions', None)
+    for id in g.pop('lockedRobots', ()):
+        robot_locks.release(id)
+    for id in g.pop('lockedDeliveries', ()):
+        delivery_locks.release(id)
+
 
 def sanitize_input(old):
     new = old.replace('"', '\\"')
@@ -105,6 +452,23 @@ def close_cache(error):
         g.cache.close()
 
 
+@app.teardown_appcontext
+def release_db(error):
+    # Return this thread's connection to the pool
+    if hasattr(g, 'db') and hasattr(g.db.local, 'conn'):
+        g.db.local.conn.close()
+        del g.db.local.conn
+
+
+@app.route('/metrics', methods = ['GET'])
+def metrics_get():
+    if not metrics_enabled():
+        return file_not_found("Metrics are disabled.")
+
+    return app.response_class(metrics.render(),
+                              mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/', methods = ['GET'])
 def root():
     return 'Congratulations! You have successfully setup RobotIX\'s \
@@ -126,10 +490,17 @@ def login():
     usersTable = get_db()['users']
     user = usersTable.find_one(username=username)
     if(user):
-        if(bcrypt.check_password_hash(user['password'], password)):
+        with timed('password_hash'):
+            valid = get_password_hasher().check_password_hash(
+                user['password'], password)
+        if(valid):
             token = generate_bearer_token()
             usersTable.update({"username": username, "bearer": token},
                               ['username'])
+            usersTable.create_index(['bearer'])
+            if get_state_store().shared:
+                get_cache()[bearer_key(username)] = token
+            get_token_cache().set(token, username)
             return jsonify({'bearer': token})
 
     return unauthorized("No such username/password combination")
@@ -145,7 +516,6 @@ def register():
 
     username = sanitize_input(data['username'])
     password = sanitize_input(data['password'])
-    hashedPassword = bcrypt.generate_password_hash(password)
 
     usersTable = get_db()['users']
     user = usersTable.find_one(username=username)
@@ -153,6 +523,9 @@ def register():
         return bad_request("This username is already taken.")
 
     if(username and password and len(username) > 0 and len(password) > 0):
+        with timed('password_hash'):
+            hashedPassword = get_password_hasher().generate_password_hash(
+                password)
         usersTable.insert(dict(username=username, password=hashedPassword,
                                bearer=''))
         return ''
@@ -176,102 +549,204 @@ def get_users():
 #                                            #
 #              DELIVERY ROUTES               #
 #                                            #
-def get_delivery_by_id(id):
-    if 'deliveries' not in get_cache():
-        get_cache()['deliveries'] = dict()
+def delivery_key(id):
+    return 'delivery:' + str(id)
 
-    if id not in get_cache()['deliveries']:
+
+def get_delivery_by_id(id):
+    """
+    Returns a delivery, or None if it doesn't exist. Like robots, the
+    version a delivery was first read at in a request is remembered, so
+    that saving it along with robots can detect changes made meanwhile.
+    """
+    key = delivery_key(id)
+    if key not in get_cache():
         return None
 
-    return get_cache()['deliveries'][id]
+    delivery = get_cache()[key]
+    g.setdefault('deliveryVersions', {}).setdefault(id, delivery.version)
+    return delivery
+
+
+def lock_deliveries(ids):
+    """
+    Locks deliveries for the rest of the request, like lock_robots. A
+    delivery must be locked before it is read for an update, and before the
+    robots it changes.
+    """
+    held = g.setdefault('lockedDeliveries', set())
+    timeout = app.config.get('ROBOT_LOCK_TIMEOUT', 5.0)
+    for id in sorted(set(ids) - held):
+        if not delivery_locks.acquire(id, timeout):
+            raise ConflictException("Delivery " + str(id) + " is busy. "
+                                    "Please try again.")
+        held.add(id)
 
 
 def delete_delivery_by_id(id):
+    lock_deliveries([id])
     delivery = get_delivery_by_id(id)
 
-    if get_delivery_by_id(id) is not None:
+    if delivery is not None:
         # Clear robot assignment
-        robot = get_robot(delivery.robot)
-        if robot is not None:
+        if delivery.robot is not None:
+            lock_robots([delivery.robot])
+            robot = get_robot(delivery.robot)
             robot.delivery = None
+            save_robot(robot)
 
         # Delete delivery
-        del get_cache()['deliveries'][id]
+        del get_cache()[delivery_key(id)]
+        get_delivery_index().remove(id)
     else:
         raise Exception("Delivery with that ID does not exist")
 
 
 def add_delivery_with_id(id, delivery):
     if get_delivery_by_id(id) is None:
-        get_cache()['deliveries'][id] = delivery
+        get_cache()[delivery_key(id)] = delivery
+        get_delivery_index().add(delivery)
     else:
         raise Exception("Delivery with that ID already exists!")
 
 
 def get_sorted_delivery_ids():
-    if 'deliveries' not in get_cache():
-        get_cache()['deliveries'] = dict()
+    return get_delivery_index().ids()
 
-    # Build list of (priority, id) tuples
-    params = []
-    for key, delivery in get_cache()['deliveries'].iteritems():
-        params.append((delivery.priority, delivery.id))
 
-    # Sort list of tuples
-    params.sort()
+def get_float_arg(name):
+    if name not in request.args:
+        return None
 
-    # Filter out ids
-    return [x[1] for x in params]
+    try:
+        return float(request.args[name])
+    except ValueError:
+        raise BadRequestException(name + " must be a number")
+
+
+def get_int_arg(name):
+    if name not in request.args:
+        return None
+
+    try:
+        return int(request.args[name])
+    except ValueError:
+        raise BadRequestException(name + " must be integer")
+
+
+def parse_delivery_cursor(cursor):
+    try:
+        (priority, id) = cursor.split(':')
+        return (int(priority), int(id))
+    except ValueError:
+        raise BadRequestException("Invalid cursor")
 
 
 @app.route('/deliveries', methods = ['GET'])
 def deliveries_get():
-    sorted_ids = get_sorted_delivery_ids()
-    return jsonify([get_delivery_by_id(x) for x in sorted_ids])
+    filters = {}
+    for field in ['state', 'sender', 'receiver']:
+        if field in request.args:
+            filters[field] = sanitize_input(request.args[field])
+    if ('state' in filters and
+            filters['state'] not in DeliveryState.__members__):
+        return bad_request("Invalid state")
+    if 'robot' in request.args:
+        filters['robot'] = get_int_arg('robot')
 
+    limit = get_int_arg('limit')
+    if limit is not None and limit < 1:
+        return bad_request("limit must be positive")
 
-@app.route('/deliveries', methods = ['POST'])
-def deliveries_post():
-    if 'deliveryQueueCounter' not in get_cache():
-        get_cache()['deliveryQueueCounter'] = 0
+    after = None
+    if 'cursor' in request.args:
+        after = parse_delivery_cursor(request.args['cursor'])
 
-    data = get_data_object()
-    counter = get_cache()['deliveryQueueCounter']
+    (ids, last) = get_delivery_index().query(
+        filters, limit, after, get_int_arg('minPriority'),
+        get_int_arg('maxPriority'))
+
+    response = json_response([get_delivery_by_id(x) for x in ids],
+                             get_targets())
+    if last is not None:
+        response.headers['X-Next-Cursor'] = '%d:%d' % last
+    return response
 
-    # Check for errors in input
+
+def check_delivery(data):
+    """
+    Validates the fields of a new delivery, and returns its source and
+    destination targets. Raises a BadRequestException otherwise.
+    """
+    if not isinstance(data, dict):
+        raise BadRequestException("Delivery must be an object")
     if 'name' not in data:
-        return bad_request("Must provde a name")
+        raise BadRequestException("Must provde a name")
     if not isinstance(data['name'], basestring):        # NOQA
-        return bad_request("Name must be string")
+        raise BadRequestException("Name must be string")
     if ('description' in data and not isinstance(data['description'], basestring)):        # NOQA
-        return bad_request("Description must be string")
+        raise BadRequestException("Description must be string")
     if 'priority' not in data:
-        return bad_request("Must provide a priority")
+        raise BadRequestException("Must provide a priority")
     if not isinstance(data['priority'], int):
-        return bad_request("Priority must be integer")
+        raise BadRequestException("Priority must be integer")
     if 'sender' not in data or 'receiver' not in data:
-        return bad_request("Must provide both a sender and a receiver")
+        raise BadRequestException("Must provide both a sender and a "
+                                  "receiver")
     if (not isinstance(data['sender'], basestring) or       # NOQA
             not isinstance(data['receiver'], basestring)):  # NOQA
-        return bad_request("Must provide both a sender and a receiver")
-
-    data_name = sanitize_input(data['name'])
-    data_sender = sanitize_input(data['sender'])
-    data_receiver = sanitize_input(data['receiver'])
-    data_from = data['from']
-    data_to = data['to']
-    data_priority = data['priority']
+        raise BadRequestException("Must provide both a sender and a "
+                                  "receiver")
 
     # Check for target existence
-    targetsTable = get_db()['targets']
-    fromTarget = targetsTable.find_one(id=data_from)
-    toTarget = targetsTable.find_one(id=data_to)
+    targets = []
+    for (field, name) in [('from', 'From'), ('to', 'To')]:
+        target = None
+        if isinstance(data.get(field), int):
+            target = get_target_catalogue().get(data[field])
+        if target is None:
+            raise BadRequestException(name + " target doesn't exist")
+        targets.append(target)
+
+    return tuple(targets)
+
+
+def check_delivery_users(data, username, usernames):
+    """
+    Checks the sender and receiver of a new delivery, given the logged in
+    user and the set of users that exist.
+    """
+    if sanitize_input(data['sender']) != username:
+        raise BadRequestException("Sender has to be logged in user.")
+    if sanitize_input(data['sender']) not in usernames:
+        raise BadRequestException("Sender user doesn't exist")
+    if sanitize_input(data['receiver']) not in usernames:
+        raise BadRequestException("Receiver user doesn't exist")
+
+
+def find_usernames(usernames):
+    """
+    Returns the subset of the given usernames that exist, with one query.
+    """
+    usersTable = get_db()['users']
+    return set(row['username']
+               for row in usersTable.find(username = list(usernames)))
 
-    if fromTarget is None:
-        return bad_request("From target doesn't exist")
 
-    if toTarget is None:
-        return bad_request("To target doesn't exist")
+def new_delivery(id, data, fromTarget, toTarget):
+    description = None
+    if 'description' in data:
+        description = sanitize_input(data['description'])
+
+    return Delivery(id, fromTarget, toTarget, sanitize_input(data['sender']),
+                    sanitize_input(data['receiver']), data['priority'],
+                    sanitize_input(data['name']), description)
+
+
+@app.route('/deliveries', methods = ['POST'])
+def deliveries_post():
+    data = get_data_object()
+    (fromTarget, toTarget) = check_delivery(data)
 
     # Check for authorization errors
     try:
@@ -280,49 +755,97 @@ def deliveries_post():
         return unauthorized(e.message)
 
     # Check for sender/receiver existence
-    usersTable = get_db()['users']
-    senderUser = usersTable.find_one(username=data_sender)
-    receiverUser = usersTable.find_one(username=data_receiver)
-
-    if data_sender != username:
-        return bad_request("Sender has to be logged in user.")
+    check_delivery_users(data, username, find_usernames(
+        [sanitize_input(data['sender']), sanitize_input(data['receiver'])]))
 
-    if senderUser is None:
-        return bad_request("Sender user doesn't exist")
-
-    if receiverUser is None:
-        return bad_request("Receiver user doesn't exist")
-
-    # Construct delivery object
-    d = None
-    if 'description' in data:
-        data_description = sanitize_input(data['description'])
-        d = Delivery(counter, fromTarget, toTarget, data_sender,
-                     data_receiver, data_priority, data_name,
-                     data_description)
-    else:
-        d = Delivery(counter, fromTarget, toTarget, data_sender,
-                     data_receiver, data_priority, data_name)
+    counter = get_delivery_id_allocator().allocate(get_cache())
 
     # Add object
-    add_delivery_with_id(counter, d)
+    add_delivery_with_id(counter,
+                         new_delivery(counter, data, fromTarget, toTarget))
 
     # Return added object
-    get_cache()['deliveryQueueCounter'] += 1
     return delivery_get(counter)
 
 
+@app.route('/deliveries/bulk', methods = ['POST'])
+def deliveries_bulk_post():
+    """
+    Creates several deliveries at once. The whole payload is validated
+    first, resolving the users it refers to with a single query, so either
+    every delivery is created or none is; on errors, the response has one
+    result per entry, in order. The deliveries are given contiguous IDs and
+    stored together.
+    """
+    data = get_data_object()
+    if not isinstance(data, list) or len(data) == 0:
+        return bad_request("Must supply a list of deliveries.")
+
+    try:
+        username = get_username(request.headers)
+    except InvalidBearerException as e:
+        return unauthorized(e.message)
+
+    usernames = set()
+    for obj in data:
+        if isinstance(obj, dict):
+            for field in ['sender', 'receiver']:
+                if isinstance(obj.get(field), basestring):  # NOQA
+                    usernames.add(sanitize_input(obj[field]))
+    usernames = find_usernames(usernames)
+
+    results = []
+    targets = []
+    errors = False
+    for obj in data:
+        result = {}
+        try:
+            targets.append(check_delivery(obj))
+            check_delivery_users(obj, username, usernames)
+        except BadRequestException as e:
+            result['error'] = str(e)
+            errors = True
+        results.append(result)
+
+    if errors:
+        return jsonify(results), 400
+
+    first = get_delivery_id_allocator().allocate_block(get_cache(),
+                                                       len(data))
+    deliveries = []
+    entries = {}
+    for (i, obj) in enumerate(data):
+        delivery = new_delivery(first + i, obj, *targets[i])
+        delivery.version = 1
+        deliveries.append(delivery)
+        entries[delivery_key(delivery.id)] = delivery
+
+    if not get_cache().compare_and_update(
+            entries, dict((key, 0) for key in entries)):
+        raise ConflictException("Deliveries were created with the same IDs "
+                                "by another request. Please try again.")
+
+    versions = g.setdefault('deliveryVersions', {})
+    for delivery in deliveries:
+        versions[delivery.id] = delivery.version
+        get_delivery_index().add(delivery)
+
+    return json_response(deliveries, get_targets())
+
+
 @app.route('/deliveries', methods = ['DELETE'])
 def deliveries_delete():
     sorted_ids = get_sorted_delivery_ids()
     for id in sorted_ids:
         delete_delivery_by_id(id)
 
-    get_cache()['deliveryQueueCounter'] = 0
+    get_delivery_id_allocator().reset(get_cache())
 
     # TODO: This shouldn't be necessary
-    if 'robots' in get_cache():
-        del get_cache()['robots']
+    keys = [key for key in get_cache().keys() if key.startswith('robot:')]
+    lock_robots([get_cache()[key].id for key in keys])
+    for key in keys:
+        del get_cache()[key]
 
     return ''
 
@@ -334,7 +857,7 @@ def delivery_get(id):
     if delivery is None:
         return file_not_found("There's no delivery with that ID!")
 
-    return jsonify(delivery)
+    return json_response(delivery, get_targets())
 
 
 @app.route('/delivery/<int:id>', methods = ['PATCH'])
@@ -343,75 +866,155 @@ def delivery_patch(id):
     return patch_delivery_with_json(id, data)
 
 
-def patch_delivery_with_json(id, data, force = False):
-    delivery = get_delivery_by_id(id)
-    if delivery is None:
-        return file_not_found("There's no delivery with that ID!")
-
-    if 'state' not in data:
-        return bad_request("Missing state")
-    if data['state'] not in [e.name for e in DeliveryState]:
-        return bad_request("Invalid state")
+def check_delivery_patch(delivery, data, force = False):
+    """
+    Validates a state change of a delivery, and returns the new state.
+    Raises a BadRequestException otherwise.
+    """
+    if not isinstance(data, dict) or 'state' not in data:
+        raise BadRequestException("Missing state")
+    state = DELIVERY_STATES.state(data['state'])
+    if state is None:
+        raise BadRequestException("Invalid state")
 
     # Check if PATCH is valid
-    valid_patches = {
-        "IN_QUEUE": "MOVING_TO_SOURCE",
-        "MOVING_TO_SOURCE": "AWAITING_AUTHENTICATION_SENDER",
-        "AWAITING_PACKAGE_LOAD": "PACKAGE_LOAD_COMPLETE",
-        "PACKAGE_LOAD_COMPLETE": "MOVING_TO_DESTINATION",
-        "MOVING_TO_DESTINATION": "AWAITING_AUTHENTICATION_RECEIVER",
-        "AWAITING_PACKAGE_RETRIEVAL": "PACKAGE_RETRIEVAL_COMPLETE",
-        "PACKAGE_RETRIEVAL_COMPLETE": "COMPLETE"
-    }
-
     if not force and ('TESTING' not in app.config or
                       not app.config['TESTING']):
-        if (delivery.state.name not in valid_patches or
-                valid_patches[delivery.state.name] != data['state']):
-            return bad_request(str(delivery.state.name))
+        if not DELIVERY_STATES.check(delivery, state):
+            raise BadRequestException(str(delivery.state.name))
 
-    state = DeliveryState[data['state']]
     if state == DeliveryState.MOVING_TO_SOURCE:
         if 'robot' not in data:
-            return bad_request("Missing robot assignment")
+            raise BadRequestException("Missing robot assignment")
         if not isinstance(data['robot'], int):
-            return bad_request("Robot parameter must be ID")
-        if get_robot(data['robot']).delivery is not None:
-            return bad_request("This robot is busy on another delivery")
+            raise BadRequestException("Robot parameter must be ID")
+
+    return state
 
-        delivery.robot = data['robot']
-        get_robot(delivery.robot).delivery = delivery.id
 
-    delivery.state = state
+def patch_delivery_robot_ids(delivery, data):
+    """
+    Returns the IDs of the robots a state change may change, which must be
+    locked before they are read.
+    """
+    robotIds = [delivery.robot]
+    if isinstance(data.get('robot'), int):
+        robotIds.append(data['robot'])
+    return [robotId for robotId in robotIds if robotId is not None]
+
+
+def patch_delivery_with_json(id, data, force = False):
+    lock_deliveries([id])
+    delivery = get_delivery_by_id(id)
+    if delivery is None:
+        return file_not_found("There's no delivery with that ID!")
+
+    state = check_delivery_patch(delivery, data, force)
+    lock_robots(patch_delivery_robot_ids(delivery, data))
 
     if state == DeliveryState.MOVING_TO_SOURCE:
-        delivery.senderAuthToken = generate_challenge_token()
-        delivery.receiverAuthToken = generate_challenge_token()
-
-    lock_state_mapping = {
-        DeliveryState.MOVING_TO_SOURCE: True,
-        DeliveryState.AWAITING_AUTHENTICATION_SENDER: True,
-        DeliveryState.AWAITING_PACKAGE_LOAD: False,
-        DeliveryState.PACKAGE_LOAD_COMPLETE: True,
-        DeliveryState.MOVING_TO_DESTINATION: True,
-        DeliveryState.AWAITING_AUTHENTICATION_RECEIVER: True,
-        DeliveryState.AWAITING_PACKAGE_RETRIEVAL: False,
-        DeliveryState.PACKAGE_RETRIEVAL_COMPLETE: True,
-        DeliveryState.COMPLETE: True
-    }
+        if get_robot(data['robot']).delivery is not None:
+            return bad_request("This robot is busy on another delivery")
 
-    robot = get_robot(delivery.robot)
-    if delivery.state in lock_state_mapping:
-        robot.lock = lock_state_mapping[state]
-    else:
-        robot.lock = False
+        start_delivery(delivery, get_robot(data['robot']))
 
-    if state == DeliveryState.COMPLETE:
-        robot.delivery = None
+    robot = get_delivery_robot(delivery)
+    DELIVERY_STATES.apply(delivery, robot, state)
 
+    save_robots([robot] if robot is not None else [], [delivery])
     return delivery_get(id)
 
 
+@app.route('/deliveries', methods = ['PATCH'])
+def deliveries_patch():
+    """
+    Changes the state of several deliveries at once, e.g. for operations on
+    the whole fleet. Each entry is an object like the body of PATCH
+    /delivery/<id>, along with the ID of the delivery. Every entry is
+    checked first, so either every delivery is changed or none is; on
+    errors, the response has one result per entry, in order.
+    """
+    data = get_data_object()
+    if not isinstance(data, list) or len(data) == 0:
+        return bad_request("Must supply a list of delivery changes.")
+
+    lock_deliveries([obj['id'] for obj in data
+                     if isinstance(obj, dict) and isinstance(obj.get('id'),
+                                                             int)])
+
+    results = []
+    deliveries = []
+    states = []
+    ids = set()
+    errors = False
+    for obj in data:
+        delivery = None
+        state = None
+        result = {}
+        try:
+            if not isinstance(obj, dict) or not isinstance(obj.get('id'),
+                                                           int):
+                raise BadRequestException("Delivery must be integer.")
+            result['id'] = obj['id']
+            delivery = get_delivery_by_id(obj['id'])
+            if delivery is None:
+                raise BadRequestException("There's no delivery with that "
+                                          "ID!")
+            if obj['id'] in ids:
+                raise BadRequestException("Delivery changed twice.")
+            ids.add(obj['id'])
+            state = check_delivery_patch(delivery, obj)
+        except BadRequestException as e:
+            result['error'] = str(e)
+            errors = True
+        results.append(result)
+        deliveries.append(delivery)
+        states.append(state)
+
+    if errors:
+        return jsonify(results), 400
+
+    lock_robots([robotId for delivery, obj in zip(deliveries, data)
+                 for robotId in patch_delivery_robot_ids(delivery, obj)])
+
+    # Robots must be free, and assigned to one delivery each
+    assigned = set()
+    for (obj, state, result) in zip(data, states, results):
+        if state == DeliveryState.MOVING_TO_SOURCE:
+            if (obj['robot'] in assigned or
+                    get_robot(obj['robot']).delivery is not None):
+                result['error'] = "This robot is busy on another delivery"
+                errors = True
+            assigned.add(obj['robot'])
+
+    if errors:
+        return jsonify(results), 400
+
+    changes = []
+    for (delivery, obj, state) in zip(deliveries, data, states):
+        if state == DeliveryState.MOVING_TO_SOURCE:
+            start_delivery(delivery, get_robot(obj['robot']))
+        changes.append((delivery, get_delivery_robot(delivery), state))
+    DELIVERY_STATES.apply_all(changes)
+
+    robots = dict((robot.id, robot) for (delivery, robot, state) in changes
+                  if robot is not None)
+    save_robots(robots.values(), deliveries)
+    return json_response(deliveries, get_targets())
+
+
+def start_delivery(delivery, robot):
+    """
+    Assigns a delivery to a robot, which starts moving to its source.
+    """
+    delivery.robot = robot.id
+    delivery.state = DeliveryState.MOVING_TO_SOURCE
+    delivery.senderAuthToken = generate_challenge_token()
+    delivery.receiverAuthToken = generate_challenge_token()
+    robot.delivery = delivery.id
+    robot.lock = True
+
+
 @app.route('/delivery/<int:id>', methods = ['DELETE'])
 def delivery_delete(id):
     try:
@@ -422,19 +1025,218 @@ def delivery_delete(id):
     return ''
 
 
+#                                          #
+#              DISPATCH ROUTE              #
+#                                          #
+dispatch_lock = threading.Lock()
+dispatch_policies = {}
+
+
+def get_dispatch_policy(name = None):
+    """
+    Returns the dispatch policy with the given name, or DISPATCH_POLICY.
+    Policies are kept per process, as some remember earlier assignments.
+    """
+    if name is None:
+        name = app.config.get('DISPATCH_POLICY', 'priority')
+    if name == 'nearest':
+        return NearestTargetPolicy(get_distance_matrix().distance)
+    if name not in dispatch_policies:
+        dispatch_policies[name] = POLICIES[name]()
+    return dispatch_policies[name]
+
+
+def get_robot_ids():
+    return [int(key[len('robot:'):]) for key in get_cache().keys()
+            if key.startswith('robot:')]
+
+
+def dispatch_deliveries(name = None):
+    """
+    Assigns queued deliveries, in order of priority, to the idle robots
+    chosen by a dispatch policy, and returns the (delivery, robot) pairs
+    assigned. Only as many deliveries as there are idle robots are read.
+
+    Every pair is saved on its own, checking that neither the delivery nor
+    the robot changed since they were read, so a pair that another request
+    or worker took meanwhile is skipped until the next dispatch.
+    """
+    if name is None:
+        name = app.config.get('DISPATCH_POLICY', 'priority')
+    policy = get_dispatch_policy(name)
+    timer = NULL_TIMER
+    if metrics_enabled():
+        timer = metrics.timer('flaskapp_dispatch_duration_seconds',
+                              {'policy': name})
+
+    with timer, dispatch_lock:
+        robots = get_robots(get_robot_ids()).values()
+        idle = [robot for robot in robots if robot.delivery is None]
+        if len(idle) == 0:
+            return []
+
+        (ids, last) = get_delivery_index().query(
+            {'state': DeliveryState.IN_QUEUE.name}, len(idle))
+        deliveries = [get_delivery_by_id(id) for id in ids]
+
+        assigned = []
+        conflicts = 0
+        for delivery, robot in sorted(policy.assign(deliveries, idle),
+                                      key=lambda pair: pair[1].id):
+            try:
+                lock_deliveries([delivery.id])
+                lock_robots([robot.id])
+
+                # Resident objects may have changed before they were locked
+                if (robot.delivery is not None or
+                        delivery.state != DeliveryState.IN_QUEUE):
+                    raise ConflictException("Already dispatched")
+
+                start_delivery(delivery, robot)
+                save_robots([robot], [delivery])
+                assigned.append((delivery, robot))
+            except ConflictException:
+                conflicts += 1
+
+    if metrics_enabled():
+        labels = {'policy': name, 'result': 'assigned'}
+        metrics.inc('flaskapp_dispatch_assignments_total', labels,
+                    len(assigned))
+        labels = {'policy': name, 'result': 'conflict'}
+        metrics.inc('flaskapp_dispatch_assignments_total', labels, conflicts)
+    return assigned
+
+
+def run_dispatcher(interval):
+    """
+    Dispatches deliveries every interval seconds. Each dispatch runs in a
+    request context of its own, so its changes are committed, and the
+    robots it locked released, as for a request.
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            with app.test_request_context('/dispatch', method = 'POST'):
+                dispatch_deliveries()
+        except Exception:
+            app.logger.exception("Dispatching deliveries failed")
+
+
+def start_dispatcher():
+    interval = app.config.get('DISPATCH_INTERVAL', 0)
+    if interval > 0:
+        thread = threading.Thread(target = run_dispatcher,
+                                  args = (interval,))
+        thread.daemon = True
+        thread.start()
+
+
+@app.route('/dispatch', methods = ['POST'])
+def dispatch_post():
+    data = get_data_object()
+    name = None
+    if isinstance(data, dict) and 'policy' in data:
+        name = data['policy']
+        if name not in POLICIES:
+            return bad_request("Invalid dispatch policy")
+
+    assigned = dispatch_deliveries(name)
+    return json_response([{'delivery': delivery.id, 'robot': robot.id}
+                          for delivery, robot in assigned])
+
+
 #                                          #
 #              TARGET ROUTES               #
 #                                          #
-@app.route('/targets', methods = ['GET'])
-def targets_get():
-    targetsTable = get_db()['targets']
-    targets = targetsTable.all()
+TARGETS_VERSION_KEY = 'targetsVersion'
+target_catalogues = {}
+
+
+def get_target_catalogue():
+    """
+    Targets are read from an in-process catalogue, kept per database. The
+    version of the targets table is read from the state store once per
+    request, so that the catalogue is reloaded after other worker
+    processes changed the table.
+    """
+    if 'targetCatalogue' in g:
+        return g.targetCatalogue
+
+    uri = app.config['DATASET_DATABASE_URI']
+    if uri not in target_catalogues:
+        target_catalogues[uri] = TargetCatalogue(
+            lambda: get_db()['targets'].all())
+    catalogue = target_catalogues[uri]
+
+    cache = get_cache()
+    catalogue.refresh(cache[TARGETS_VERSION_KEY]
+                      if TARGETS_VERSION_KEY in cache else 0)
+    g.targetCatalogue = catalogue
+    return catalogue
+
+
+def update_target_catalogue(changes):
+    """
+    Records changes to the targets table, given as a dictionary of the new
+    targets by ID (None for deleted targets). This must run after the
+    table was changed.
+    """
+    catalogue = get_target_catalogue()
+    catalogue.apply(get_cache().incr(TARGETS_VERSION_KEY), changes)
+
+
+def get_targets():
+    """
+    Returns every target by ID. Deliveries only hold the IDs of their
+    targets, which are resolved through this when they are serialised.
+    """
+    return get_target_catalogue().targets()
+
+
+distance_matrices = {}
+distance_matrices_lock = threading.Lock()
+
+
+def get_distance_matrix():
+    """
+    Returns the distances between the targets in the catalogue. The matrix
+    listens to the catalogue, so only the targets that changed are
+    recomputed.
+    """
+    catalogue = get_target_catalogue()
+    with distance_matrices_lock:
+        if catalogue not in distance_matrices:
+            matrix = DistanceMatrix(app.config.get('ROBOT_SPEED', 0.5))
+            catalogue.add_listener(
+                lambda ids: matrix.update(catalogue.targets(), ids))
+            distance_matrices[catalogue] = matrix
+        return distance_matrices[catalogue]
+
+
+def get_coordinates(data):
+    """
+    Returns the (x, y) coordinates given in a request, or None if there are
+    none.
+    """
+    if 'x' not in data and 'y' not in data:
+        return None
+    if 'x' not in data or 'y' not in data:
+        raise BadRequestException("Must provide both x and y")
+    if not is_number(data['x']) or not is_number(data['y']):
+        raise BadRequestException("Coordinates must be numbers")
+    return (float(data['x']), float(data['y']))
 
-    result = []
-    for t in targets:
-        result.append(Target.from_dict(t))
 
-    return jsonify(result)
+def target_list_response():
+    (body, etag) = get_target_catalogue().response()
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/targets', methods = ['GET'])
+def targets_get():
+    return target_list_response().make_conditional(request)
 
 
 @app.route('/targets', methods = ['POST'])
@@ -465,30 +1267,35 @@ def targets_post():
         data_color = sanitize_input(data['color'])
         obj['color'] = data_color
 
-    targetsTable.insert(obj)
+    coordinates = get_coordinates(data)
+    if coordinates is not None:
+        (obj['x'], obj['y']) = coordinates
+
+    obj['id'] = targetsTable.insert(obj)
+    update_target_catalogue({obj['id']: Target.from_dict(obj)})
 
-    return targets_get()
+    return target_list_response()
 
 
 @app.route('/targets', methods = ['DELETE'])
 def targets_delete():
+    ids = get_targets().keys()
     targetsTable = get_db()['targets']
-    targetsTable.drop()
+    targetsTable.delete()
+    update_target_catalogue(dict((id, None) for id in ids))
     return ''
 
 
 @app.route('/target/<int:id>', methods = ['GET'])
 def target_get(id):
-    targetsTable = get_db()['targets']
-
     if id < 0:
         return file_not_found("Target must be positive integer")
 
-    target = targetsTable.find_one(id=id)
+    target = get_target_catalogue().get(id)
     if target is None:
         return file_not_found("This target does not exist")
 
-    return jsonify(Target.from_dict(target))
+    return jsonify(target)
 
 
 @app.route('/target/<int:id>', methods = ['PATCH'])
@@ -498,17 +1305,28 @@ def target_patch(id):
     if id < 0:
         return file_not_found("Target must be positive integer")
 
-    target = targetsTable.find_one(id=id)
+    target = get_target_catalogue().get(id)
     if target is None:
         return file_not_found("This target does not exist")
 
     data = get_data_object()
+    changes = {}
     if 'color' in data:
         if not isinstance(data['color'], basestring):  # NOQA
             return bad_request("Color must be of type string")
 
-        data_color = sanitize_input(data['color'])
-        targetsTable.update({'id': id, 'color': data_color}, ['id'])
+        changes['color'] = sanitize_input(data['color'])
+
+    coordinates = get_coordinates(data)
+    if coordinates is not None:
+        (changes['x'], changes['y']) = coordinates
+
+    if len(changes) > 0:
+        changes['id'] = id
+        targetsTable.update(changes, ['id'])
+        fields = target.__getstate__()
+        fields.update(changes)
+        update_target_catalogue({id: Target.from_dict(fields)})
 
     return target_get(id)
 
@@ -520,71 +1338,353 @@ def target_delete(id):
     if id < 0:
         return file_not_found("Target must be positive integer")
 
-    target = targetsTable.find_one(id=id)
+    target = get_target_catalogue().get(id)
     if target is None:
         return file_not_found("This target does not exist")
 
     targetsTable.delete(id=id)
+    update_target_catalogue({id: None})
 
     return ''
 
 
+@app.route('/target/<int:id>/route/<int:other>', methods = ['GET'])
+def target_route_get(id, other):
+    """
+    Returns the distance between two targets, and the time a robot takes to
+    travel it. Both are null unless the targets have coordinates.
+    """
+    for t in [id, other]:
+        if get_target_catalogue().get(t) is None:
+            return file_not_found("This target does not exist")
+
+    matrix = get_distance_matrix()
+    return jsonify({'from': id, 'to': other,
+                    'distance': matrix.distance(id, other),
+                    'eta': matrix.eta(id, other)})
+
+
 #                                         #
 #            BATCH BATCH ROUTE            #
 #                                         #
 @app.route('/batch', methods = ['POST'])
 def robot_batch_batch_post():
+    """
+    Applies the batch updates of several robots at once. The whole payload
+    is validated first, so either every robot is updated or none is; the
+    response has one result per entry, in order.
+    """
     data = get_data_object()
+    if not isinstance(data, list):
+        return bad_request("Must supply a list of robot updates.")
+
+    results = []
+    errors = False
     for obj in data:
-        if 'robot' not in obj:
-            return bad_request('No robot specified.')
+        if not isinstance(obj, dict) or 'robot' not in obj:
+            results.append({'error': 'No robot specified.'})
+            errors = True
+            continue
+        elif not isinstance(obj['robot'], int):
+            results.append({'error': 'Robot must be integer.'})
+            errors = True
+            continue
+
+        result = {'robot': obj['robot']}
+        try:
+            check_batch_robot(obj)
+        except BadRequestException as e:
+            result['error'] = str(e)
+            errors = True
+        results.append(result)
+
+    if errors:
+        return jsonify(results), 400
+
+    ids = [obj['robot'] for obj in data]
+    lock_robots(ids)
+    robots = get_robots(ids)
+    for obj in data:
+        apply_batch_robot(robots[obj['robot']], obj)
+    save_robots(robots.values())
+    record_telemetry(robots.values())
 
-        id = obj['robot']
-        post_batch_robot(id, obj)
+    for result in results:
+        result['version'] = robots[result['robot']].version
 
-    return ''
+    return jsonify(results)
 
 
 #                                         #
 #              ROBOT ROUTES               #
 #                                         #
+def robot_key(id):
+    return 'robot:' + str(id)
+
+
+def get_telemetry_history():
+    """
+    Telemetry history is kept in memory for each process, with at most
+    TELEMETRY_CAPACITY samples per robot.
+    """
+    global telemetry_history
+    if telemetry_history is None:
+        telemetry_history = TelemetryHistory(
+            app.config.get('TELEMETRY_CAPACITY', 3600))
+    return telemetry_history
+
+
+def get_telemetry_log():
+    """
+    Telemetry is also written to segment files in TELEMETRY_LOG_DIR, unless
+    it is not set.
+    """
+    global telemetry_log
+    if telemetry_log is None and app.config.get('TELEMETRY_LOG_DIR'):
+        telemetry_log = TelemetryLog(
+            app.config['TELEMETRY_LOG_DIR'],
+            app.config.get('TELEMETRY_SEGMENT_RECORDS', 65536),
+            app.config.get('TELEMETRY_MAX_SEGMENTS', 16))
+        atexit.register(telemetry_log.close)
+    return telemetry_log
+
+
+def get_telemetry_points_arg():
+    maxPoints = app.config.get('TELEMETRY_MAX_POINTS', 500)
+    points = get_int_arg('points')
+    if points is None or points > maxPoints:
+        return maxPoints
+    elif points < 1:
+        raise BadRequestException("points must be positive")
+    return points
+
+
+def record_telemetry(robots):
+    now = time.time()
+    history = get_telemetry_history()
+    log = get_telemetry_log()
+    for r in robots:
+        history.record(r, now)
+        if log is not None:
+            log.append(now, r)
+
+
+def lock_robots(ids):
+    """
+    Locks robots for the rest of the request, so that other requests in
+    this process cannot change them until this request's changes are
+    committed. Robots must be locked before they are read for an update.
+    Locks are acquired in order of ID, and a ConflictException is raised if
+    a robot stays locked for longer than ROBOT_LOCK_TIMEOUT.
+    """
+    held = g.setdefault('lockedRobots', set())
+    timeout = app.config.get('ROBOT_LOCK_TIMEOUT', 5.0)
+    for id in sorted(set(ids) - held):
+        if not robot_locks.acquire(id, timeout):
+            raise ConflictException("Robot " + str(id) + " is busy. "
+                                    "Please try again.")
+        held.add(id)
+
+
 def get_robot(id):
-    if 'robots' not in get_cache():
-        get_cache()['robots'] = dict()
+    return get_robots([id])[id]
+
+
+def get_delivery_robot(delivery):
+    """
+    Returns the robot of a delivery, or None if it hasn't been assigned one.
+    """
+    if delivery.robot is None:
+        return None
+    return get_robot(delivery.robot)
+
+
+def get_robots(ids):
+    """
+    Returns a dictionary of the robots with the given IDs. Robots that don't
+    exist yet are created, but only stored once they are saved. A robot is
+    read once per request, and the version read is remembered so that
+    saving it can detect changes made by other requests meanwhile.
+    """
+    cache = get_cache()
+    read = g.setdefault('robots', {})
+    versions = g.setdefault('robotVersions', {})
+    robots = {}
+    for id in ids:
+        if id not in read:
+            key = robot_key(id)
+            read[id] = cache[key] if key in cache else Robot(id)
+            versions[id] = read[id].version
+        robots[id] = read[id]
+    return robots
 
-    if id not in get_cache()['robots']:
-        get_cache()['robots'][id] = Robot(id)
 
-    return get_cache()['robots'][id]
+def save_robot(robot):
+    save_robots([robot])
+
+
+def save_robots(robots, deliveries = ()):
+    """
+    Stores robots, bumping their version. A ConflictException is raised,
+    and nothing is stored, if any of them was changed by another request
+    since it was read. Deliveries given are stored and checked along with
+    the robots.
+    """
+    versions = g.setdefault('robotVersions', {})
+    deliveryVersions = g.setdefault('deliveryVersions', {})
+    entries = {}
+    expected = {}
+    for robot in robots:
+        key = robot_key(robot.id)
+        expected[key] = versions.get(robot.id, robot.version)
+        robot.version = expected[key] + 1
+        entries[key] = robot
+    for delivery in deliveries:
+        key = delivery_key(delivery.id)
+        expected[key] = deliveryVersions.get(delivery.id, delivery.version)
+        delivery.version = expected[key] + 1
+        entries[key] = delivery
+
+    if not get_cache().compare_and_update(entries, expected):
+        raise ConflictException("The robot was changed by another request. "
+                                "Please try again.")
+    for robot in robots:
+        versions[robot.id] = robot.version
+    for delivery in deliveries:
+        deliveryVersions[delivery.id] = delivery.version
+        get_delivery_index().add(delivery)
+
+    if not hasattr(g, 'savedRobots'):
+        g.savedRobots = set()
+    g.savedRobots.update(robot.id for robot in robots)
+
+
+def read_robot_version(id):
+    """
+    Reads the version of a robot through a new handle, so that changes
+    committed by other requests are seen.
+    """
+    cache = get_state_store().open()
+    try:
+        key = robot_key(id)
+        if key not in cache:
+            return 0
+        return cache[key].version
+    finally:
+        cache.close()
+
+
+def get_robot_batch_response(r):
+    """
+    Returns the version of a robot, and its serialised batch response and
+    ETag. These are only rebuilt after the robot has been saved, which
+    includes every change to the state of its delivery.
+    """
+    # Robots may be saved by other requests meanwhile, so the response is
+    # cached under the version read before it was built; a response built
+    # from a newer robot is then merely rebuilt once more.
+    version = r.version
+    cache = r.batchCache
+    hit = cache is not None and cache[0] == version
+    count_cache_lookup('robot_batch', hit)
+    if not hit:
+        response = {}
+        response['correction'] = r.correction
+        response['angle'] = r.angle
+        response['motor'] = r.motor
+        response['distance'] = r.distance
+
+        if r.delivery is not None:
+            delivery = get_delivery_by_id(r.delivery)
+            obj = {}
+            obj['state'] = delivery.state
+            obj['senderAuthToken'] = delivery.senderAuthToken
+            obj['receiverAuthToken'] = delivery.receiverAuthToken
+            response['delivery'] = obj
+
+        with timed('json'):
+            body = dumps(response)
+        cache = (version, body, hashlib.md5(body).hexdigest())
+        r.batchCache = cache
+
+    return cache
 
 
 # Batch instructions route
 @app.route('/robot/<int:id>/batch', methods = ['GET'])
 def robot_batch_get(id):
-    response = {}
-
     r = get_robot(id)
-    response['correction'] = r.correction
-    response['angle'] = r.angle
-    response['motor'] = r.motor
-    response['distance'] = r.distance
+    (version, body, etag) = get_robot_batch_response(r)
+
+    response = app.response_class(body, mimetype='application/json')
+    response.headers['X-Robot-Version'] = str(version)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+# Long-polls for the batch response until the robot's version differs from
+# the version supplied, or until the timeout expires (304).
+@app.route('/robot/<int:id>/batch/poll', methods = ['GET'])
+def robot_batch_poll(id):
+    version = get_int_arg('version')
+    if version is None:
+        return bad_request("Must supply the last seen version")
+
+    maxTimeout = app.config.get('LONG_POLL_TIMEOUT', 30)
+    timeout = get_int_arg('timeout')
+    if timeout is None or timeout > maxTimeout:
+        timeout = maxTimeout
+
+    changed = robot_notifier.wait_for(
+        id, lambda: read_robot_version(id) != version, timeout,
+        app.config.get('LONG_POLL_INTERVAL', 1.0))
+    if not changed:
+        return '', 304
+
+    return robot_batch_get(id)
 
-    if r.delivery is not None:
-        delivery = get_delivery_by_id(r.delivery)
-        obj = {}
-        obj['state'] = delivery.state
-        obj['senderAuthToken'] = delivery.senderAuthToken
-        obj['receiverAuthToken'] = delivery.receiverAuthToken
-        response['delivery'] = obj
 
-    return jsonify(response)
+# Fields accepted by robot updates, with their type and the error messages
+# used when they are missing or of the wrong type.
+ROBOT_FIELDS = {
+    'correction': (float, "You have not supplied a correction angle!",
+                   "Supplied correction is not a float"),
+    'angle': (float, "You have not supplied an angle!",
+              "Supplied angle is not a float"),
+    'distance': (float, "You have not supplied a distance!",
+                 "Supplied distance is not a float"),
+    'motor': (bool, "You have not supplied a motor state!",
+              "Supplied motor state is not a bool")
+}
+ROBOT_BATCH_FIELDS = ['correction', 'distance', 'motor', 'angle']
+
+
+def check_robot_field(data, field):
+    (type, missing, invalid) = ROBOT_FIELDS[field]
+    if field not in data:
+        raise BadRequestException(missing)
+    elif not isinstance(data[field], type):
+        raise BadRequestException(invalid)
+
+
+def check_batch_robot(data):
+    for field in ROBOT_BATCH_FIELDS:
+        check_robot_field(data, field)
+
+
+def apply_batch_robot(r, data):
+    for field in ROBOT_BATCH_FIELDS:
+        setattr(r, field, data[field])
 
 
 def post_batch_robot(id, data):
-    robot_update_correction(id, data)
-    robot_update_distance(id, data)
-    robot_update_motor(id, data)
-    robot_update_angle(id, data)
+    check_batch_robot(data)
+
+    lock_robots([id])
+    r = get_robot(id)
+    apply_batch_robot(r, data)
+    save_robot(r)
+    record_telemetry([r])
 
 
 @app.route('/robot/<int:id>/batch', methods = ['POST'])
@@ -594,6 +1694,28 @@ def robot_batch_post(id):
     return robot_batch_get(id)
 
 
+# Telemetry route, returning the recorded correction, angle and distance
+# samples between since and until, downsampled to at most points samples.
+@app.route('/robot/<int:id>/telemetry', methods = ['GET'])
+def robot_telemetry_get(id):
+    points = get_telemetry_points_arg()
+    return jsonify(get_telemetry_history().query(
+        id, get_float_arg('since'), get_float_arg('until'), points))
+
+
+# Telemetry history route, reading the samples written to the telemetry log.
+# The motor column holds the fraction of samples with the motor on.
+@app.route('/robot/<int:id>/telemetry/history', methods = ['GET'])
+def robot_telemetry_history_get(id):
+    log = get_telemetry_log()
+    if log is None:
+        return file_not_found("The telemetry log is disabled")
+
+    points = get_telemetry_points_arg()
+    return jsonify(log.query(id, get_float_arg('since'),
+                             get_float_arg('until'), points))
+
+
 # Correction routes
 @app.route('/robot/<int:id>/correction', methods = ['GET'])
 def robot_correction_get(id):
@@ -602,13 +1724,13 @@ def robot_correction_get(id):
 
 
 def robot_update_correction(id, data):
-    if 'correction' not in data:
-        raise BadRequestException("You have not supplied a correction angle!")
-    elif not isinstance(data['correction'], float):
-        raise BadRequestException("Supplied correction is not a float")
+    check_robot_field(data, 'correction')
 
+    lock_robots([id])
     r = get_robot(id)
     r.correction = data['correction']
+    save_robot(r)
+    record_telemetry([r])
 
 
 @app.route('/robot/<int:id>/correction', methods = ['POST'])
@@ -617,7 +1739,7 @@ def robot_correction_post(id):
 
     try:
         robot_update_correction(id, data)
-    except Exception as e:
+    except BadRequestException as e:
         return bad_request(e.message)
 
     return robot_correction_get(id)
@@ -631,13 +1753,13 @@ def robot_angle_get(id):
 
 
 def robot_update_angle(id, data):
-    if 'angle' not in data:
-        raise BadRequestException("You have not supplied an angle!")
-    elif not isinstance(data['angle'], float):
-        raise BadRequestException("Supplied angle is not a float")
+    check_robot_field(data, 'angle')
 
+    lock_robots([id])
     r = get_robot(id)
     r.angle = data['angle']
+    save_robot(r)
+    record_telemetry([r])
 
 
 @app.route('/robot/<int:id>/angle', methods = ['POST'])
@@ -660,13 +1782,13 @@ def robot_distance_get(id):
 
 
 def robot_update_distance(id, data):
-    if 'distance' not in data:
-        raise BadRequestException("You have not supplied a distance!")
-    elif not isinstance(data['distance'], float):
-        raise BadRequestException("Supplied distance is not a float")
+    check_robot_field(data, 'distance')
 
+    lock_robots([id])
     r = get_robot(id)
     r.distance = data['distance']
+    save_robot(r)
+    record_telemetry([r])
 
 
 @app.route('/robot/<int:id>/distance', methods = ['POST'])
@@ -689,13 +1811,13 @@ def robot_motor_get(id):
 
 
 def robot_update_motor(id, data):
-    if 'motor' not in data:
-        raise BadRequestException("You have not supplied a motor state!")
-    elif not isinstance(data['motor'], bool):
-        raise BadRequestException("Supplied motor state is not a bool")
+    check_robot_field(data, 'motor')
 
+    lock_robots([id])
     r = get_robot(id)
     r.motor = data['motor']
+    save_robot(r)
+    record_telemetry([r])
 
 
 @app.route('/robot/<int:id>/motor', methods = ['POST'])
@@ -725,8 +1847,10 @@ def robot_lock_post(id):
     elif not isinstance(data['lock'], bool):
         return bad_request("Supplied lock state is not a bool")
 
+    lock_robots([id])
     r = get_robot(id)
     r.lock = data['lock']
+    save_robot(r)
     return robot_lock_get(id)
 
 
@@ -747,33 +1871,22 @@ def robot_verify_post(id):
     except InvalidBearerException as e:
         return unauthorized(e.message)
 
-    trueToken = None
     robot = get_robot(id)
 
     delivery = get_delivery_by_id(robot.delivery)
     if delivery is None:
         return bad_request("This robot is not presently delivering")
 
-    robotState = delivery.state
-    if robotState == DeliveryState.AWAITING_AUTHENTICATION_SENDER:
-        trueToken = delivery.senderAuthToken
-    elif robotState == DeliveryState.AWAITING_AUTHENTICATION_RECEIVER:
-        trueToken = delivery.receiverAuthToken
-    else:
+    transition = DELIVERY_STATES.verification(delivery.state)
+    if transition is None:
         return bad_request("This robot is not awaiting any verification.")
 
-    if data_token != trueToken:
+    if data_token != getattr(delivery, transition.token):
         return unauthorized("Challenge token doesn't match QR")
 
-    if delivery.state == DeliveryState.AWAITING_AUTHENTICATION_SENDER:
-        if delivery.sender == username:
-            return patch_delivery_with_json(delivery.id, {
-                "state": "AWAITING_PACKAGE_LOAD"}, True)
-
-    if delivery.state == DeliveryState.AWAITING_AUTHENTICATION_RECEIVER:
-        if delivery.receiver == username:
-            return patch_delivery_with_json(delivery.id, {
-                "state": "AWAITING_PACKAGE_RETRIEVAL"}, True)
+    if getattr(delivery, transition.party) == username:
+        return patch_delivery_with_json(delivery.id, {
+            "state": transition.target.name}, True)
 
     return unauthorized("You are not allowed to open the box!")
 
@@ -805,6 +1918,32 @@ def unauthorized(friendly):
     return jsonify(data), error_code
 
 
+def conflict(friendly):
+    error_code = 409
+    error = 'Conflict'
+
+    data = {
+        'code': error_code,
+        'error': error,
+        'friendly':  friendly
+    }
+
+    return jsonify(data), error_code
+
+
+def too_many_requests(friendly):
+    error_code = 429
+    error = 'Too many requests'
+
+    data = {
+        'code': error_code,
+        'error': error,
+        'friendly':  friendly
+    }
+
+    return jsonify(data), error_code
+
+
 def file_not_found(friendly):
     error_code = 404
     error = 'File not found'
@@ -824,6 +1963,16 @@ def bad_request_exception_handler(friendly):
                     "friendly": str(friendly)}), 400
 
 
+@app.errorhandler(ConflictException)
+def conflict_exception_handler(error):
+    return conflict(str(error))
+
+
+@app.errorhandler(PoolSaturatedException)
+def pool_saturated_exception_handler(error):
+    return too_many_requests(str(error))
+
+
 @app.errorhandler(Exception)
 def exception_handler(error):
     if 'TESTING' in app.config and app.config['TESTING']:
@@ -836,7 +1985,8 @@ def exception_handler(error):
 
 
 def main():
-    app.run(host=app.config['HOST'])
+    app.run(host=app.config['HOST'],
+            threaded=is_threaded_store(app.config))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,35 @@
+import multiprocessing
+from config import Config
+from store import is_shared_store, is_threaded_store
+
+bind = '0.0.0.0:5000'
+
+# Several workers can only serve the same state through a shared store
+workers = 1
+if is_shared_store(vars(Config)):
+    workers = multiprocessing.cpu_count() * 2 + 1
+
+# Threaded workers, so that long-polling robots don't hold a whole process
+worker_class = 'gthread'
+threads = 8 if is_threaded_store(vars(Config)) else 1
+timeout = 60
+
+
+def on_starting(server):
+    from flaskapp import app, reset_state
+
+    # Workers only see each other's robots and deliveries through a shared
+    # store; others would each keep their own state and overwrite the same
+    # files
+    if server.cfg.workers > 1 and not is_shared_store(app.config):
+        raise RuntimeError("STATE_STORE must be 'sqlite' to run several "
+                           "workers")
+    if server.cfg.threads > 1 and not is_threaded_store(app.config):
+        raise RuntimeError("The 'shelve' store can't serve several requests "
+                           "at once; set threads to 1")
+
+    # Clear the shared state once, rather than in the first request of each
+    # worker, which would wipe the state written by the other workers
+    if not app.config.get('DEBUG') and not app.config.get('STATE_RECOVER'):
+        reset_state()
+    app.config['STATE_CLEARED'] = True
@@ -0,0 +1,78 @@
+import atexit
+import multiprocessing
+import threading
+import bcrypt
+from werkzeug.security import safe_str_cmp
+
+
+def _encode(value):
+    if isinstance(value, unicode):      # NOQA
+        return value.encode('utf-8')
+    return value
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(_encode(password), bcrypt.gensalt(rounds))
+
+
+def _check_password(pw_hash, password):
+    pw_hash = _encode(pw_hash)
+    return safe_str_cmp(bcrypt.hashpw(_encode(password), pw_hash), pw_hash)
+
+
+class PoolSaturatedException(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a dedicated pool of worker processes, so that a burst of
+    logins cannot starve the threads serving robot requests. At most
+    queueLimit hashes may be pending at once; any further request is
+    rejected with a PoolSaturatedException instead of queueing.
+
+    With no workers, hashing runs on the calling thread but is still bounded
+    by queueLimit.
+    """
+
+    def __init__(self, rounds = 12, workers = 2, queueLimit = 16,
+                 timeout = 30.0):
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(queueLimit)
+        self._pool = None
+
+    def _get_pool(self):
+        with self.lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.workers)
+                atexit.register(self.close)
+            return self._pool
+
+    def _run(self, function, args):
+        if not self._slots.acquire(False):
+            raise PoolSaturatedException("Too many pending password hashes. "
+                                         "Please try again later.")
+
+        try:
+            if self.workers == 0:
+                return function(*args)
+
+            result = self._get_pool().apply_async(function, args)
+            return result.get(self.timeout)
+        finally:
+            self._slots.release()
+
+    def generate_password_hash(self, password):
+        return self._run(_hash_password, (password, self.rounds))
+
+    def check_password_hash(self, pw_hash, password):
+        return self._run(_check_password, (pw_hash, password))
+
+    def close(self):
+        with self.lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
@@ -0,0 +1,118 @@
+import bisect
+
+
+class DeliveryIndex:
+    """
+    Keeps delivery IDs ordered by (priority, id), so the queue can be listed
+    without sorting it on every read. The position of an entry is found by
+    binary search when it is added or removed.
+
+    Secondary indexes map the value of each field in FIELDS to the
+    deliveries carrying it, also ordered by (priority, id), so that a page
+    of a filtered listing is found by binary search too. Filtering on
+    several fields walks the shortest of their lists, and only checks the
+    other fields of the deliveries it visits.
+    """
+
+    FIELDS = ('state', 'robot', 'sender', 'receiver')
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, id):
+        return id in self._entries
+
+    def _values(self, delivery):
+        return (delivery.state.name, delivery.robot, delivery.sender,
+                delivery.receiver)
+
+    def add(self, delivery):
+        """
+        Adds a delivery to the index, or re-indexes it if its priority or
+        any indexed field changed.
+        """
+        id = delivery.id
+        entry = (delivery.priority, self._values(delivery))
+        if id in self._entries:
+            if self._entries[id] == entry:
+                return
+            self.remove(id)
+
+        self._entries[id] = entry
+        key = (entry[0], id)
+        bisect.insort(self._order, key)
+        for field, value in zip(self.FIELDS, entry[1]):
+            bisect.insort(self._fields[field].setdefault(value, []), key)
+
+    def remove(self, id):
+        (priority, values) = self._entries.pop(id)
+        key = (priority, id)
+        del self._order[bisect.bisect_left(self._order, key)]
+
+        for field, value in zip(self.FIELDS, values):
+            order = self._fields[field][value]
+            del order[bisect.bisect_left(order, key)]
+            if len(order) == 0:
+                del self._fields[field][value]
+
+    def clear(self):
+        self._order = []
+        self._entries = {}
+        self._fields = dict((field, {}) for field in self.FIELDS)
+
+    def ids(self):
+        return [x[1] for x in self._order]
+
+    def query(self, filters = None, limit = None, after = None,
+              minPriority = None, maxPriority = None):
+        """
+        Returns a page of delivery IDs in (priority, id) order, starting after
+        the (priority, id) key given in after. The second element of the
+        result is the key of the last entry returned if more entries follow,
+        and None otherwise.
+        """
+        order = self._order
+        if filters:
+            order = min((self._fields[field].get(value, [])
+                         for field, value in filters.items()), key = len)
+
+        start = 0
+        end = len(order)
+        if minPriority is not None:
+            start = bisect.bisect_left(order, (minPriority,))
+        if maxPriority is not None:
+            end = bisect.bisect_right(order, (maxPriority, float('inf')))
+        if after is not None:
+            start = max(start, bisect.bisect_right(order, after))
+
+        if filters and len(filters) > 1:
+            return self._scan(order, start, end, filters, limit)
+
+        stop = end
+        if limit is not None:
+            stop = min(end, start + limit)
+
+        page = order[start:stop]
+        last = None
+        if stop < end and len(page) > 0:
+            last = page[-1]
+
+        return ([x[1] for x in page], last)
+
+    def _scan(self, order, start, end, filters, limit):
+        filters = [(self.FIELDS.index(field), value)
+                   for field, value in filters.items()]
+        page = []
+        for i in range(start, end):
+            values = self._entries[order[i][1]][1]
+            if all(values[f] == value for f, value in filters):
+                if limit is not None and len(page) == limit:
+                    # Another entry follows the page
+                    last = page[-1] if len(page) > 0 else None
+                    return ([x[1] for x in page], last)
+                page.append(order[i])
+
+        return ([x[1] for x in page], None)
@@ -0,0 +1,153 @@
+import atexit
+import marshal
+import os
+import struct
+import threading
+import zlib
+import codec
+
+RECORD_HEADER = struct.Struct('<II')
+
+
+class Journal:
+    """
+    An append-only log of the entries written to a state store, so that the
+    writes made since its last snapshot can be replayed after a restart.
+
+    Each record holds a key and its encoded value, or None if the key was
+    deleted, behind its length and CRC32. Records are buffered in memory and
+    written with a single fsync every commitInterval seconds by a background
+    thread, so writers never wait for the disk; a crash loses at most the
+    records of the last interval. With a commitInterval of 0, every record
+    is committed as it is appended.
+
+    Once a snapshot has been written, the journal is truncated.
+    """
+
+    def __init__(self, filename, commitInterval = 0.05):
+        self.filename = filename
+        self.commitInterval = commitInterval
+        self.lock = threading.Lock()
+        self.commitLock = threading.Lock()
+        self._pending = []
+        self._file = None
+        self._thread = None
+        self._pid = None
+        self._stopped = threading.Event()
+
+    def write(self, key, value):
+        self._append(key, codec.dumps(value))
+
+    def delete(self, key):
+        self._append(key, None)
+
+    def _append(self, key, data):
+        payload = marshal.dumps((key, data), 2)
+        record = RECORD_HEADER.pack(len(payload),
+                                    zlib.crc32(payload) & 0xffffffff)
+        with self.lock:
+            self._pending.append(record + payload)
+
+        if self.commitInterval <= 0:
+            self.commit()
+        else:
+            self._start_committer()
+
+    def _start_committer(self):
+        # The committer is started lazily, and again in forked processes,
+        # which don't inherit threads
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._file = None
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopped.wait(self.commitInterval):
+            self.commit()
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.filename, 'ab')
+        return self._file
+
+    def commit(self):
+        """
+        Writes the pending records and waits until they are on disk.
+        """
+        with self.commitLock:
+            with self.lock:
+                records = self._pending
+                self._pending = []
+            if len(records) == 0:
+                return
+
+            f = self._open()
+            f.write(''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def truncate(self):
+        """
+        Discards every record, once the state they describe is in a
+        snapshot. The caller must prevent records from being appended
+        meanwhile.
+        """
+        with self.commitLock:
+            with self.lock:
+                self._pending = []
+            f = self._open()
+            f.truncate(0)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self):
+        """
+        Returns the (key, value) pairs of every record in order, where the
+        value of a deleted key is None. A torn or corrupt record at the end
+        of the file, left by a crash in the middle of a write, is discarded
+        along with anything after it.
+        """
+        if not os.path.exists(self.filename):
+            return []
+
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+
+        entries = []
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            (length, checksum) = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            payload = data[start:start + length]
+            if (len(payload) < length or
+                    zlib.crc32(payload) & 0xffffffff != checksum):
+                break
+
+            (key, value) = marshal.loads(payload)
+            entries.append((key, None if value is None
+                            else codec.loads(value)))
+            offset = start + length
+
+        if offset < len(data):
+            with open(self.filename, 'r+b') as f:
+                f.truncate(offset)
+        return entries
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        self.commit()
+        with self.commitLock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class RobotLocks:
+    """
+    A lock for every robot, so that requests updating different robots
+    never wait for each other. Deliveries are locked the same way. Unlike
+    threading.Lock, acquiring a robot gives up after a timeout, so that
+    requests locking the same robots in a different order cannot deadlock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._conditions = {}
+        self._held = set()
+
+    def _condition(self, id):
+        with self.lock:
+            if id not in self._conditions:
+                self._conditions[id] = threading.Condition()
+            return self._conditions[id]
+
+    def acquire(self, id, timeout):
+        """
+        Waits up to timeout seconds for the robot to be released, and
+        returns whether it was acquired.
+        """
+        deadline = time.time() + timeout
+        condition = self._condition(id)
+        with condition:
+            while id in self._held:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                condition.wait(remaining)
+            self._held.add(id)
+
+        return True
+
+    def release(self, id):
+        condition = self._condition(id)
+        with condition:
+            self._held.discard(id)
+            condition.notify()
@@ -0,0 +1,127 @@
+import bisect
+import threading
+import timeit
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class NullTimer:
+    """
+    Stands in for a Timer when metrics are disabled, so that timed code
+    only pays for entering and leaving an empty context.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.metrics.observe(self.name, self.labels,
+                             timeit.default_timer() - self.start)
+        return False
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, _escape(value))
+                          for key, value in labels) + '}'
+
+
+class Metrics:
+    """
+    Collects counters and latency histograms in this process, and renders
+    them in the Prometheus text exposition format. Labels are given as a
+    dictionary, e.g. {'route': '/deliveries'}.
+    """
+
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self._descriptions = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, type, help):
+        self._descriptions[name] = (type, help)
+
+    def inc(self, name, labels, amount = 1):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry = series[key]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def timer(self, name, labels):
+        """
+        Returns a context manager that observes how long its block takes.
+        """
+        return Timer(self, name, labels)
+
+    def clear(self):
+        with self.lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name in sorted(set(self._counters) | set(self._histograms)):
+                if name in self._descriptions:
+                    (type, help) = self._descriptions[name]
+                    lines.append('# HELP %s %s' % (name, help))
+                    lines.append('# TYPE %s %s' % (name, type))
+
+                for key, value in sorted(self._counters.get(name,
+                                                            {}).items()):
+                    lines.append('%s%s %s' % (name, _format_labels(key),
+                                              value))
+
+                for key, (counts, total) in sorted(
+                        self._histograms.get(name, {}).items()):
+                    cumulative = 0
+                    bounds = [repr(b) for b in self.buckets] + ['+Inf']
+                    for bound, count in zip(bounds, counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(key + (('le', bound),)),
+                            cumulative))
+                    lines.append('%s_sum%s %r' % (name, _format_labels(key),
+                                                  total))
+                    lines.append('%s_count%s %d' % (
+                        name, _format_labels(key), cumulative))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,41 @@
+import threading
+import time
+
+
+class RobotNotifier:
+    """
+    Lets requests wait for a robot to change. Waiters are woken as soon as
+    notify() is called for their robot in this process, and re-check their
+    condition every interval seconds to pick up changes made elsewhere.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._conditions = {}
+
+    def _condition(self, id):
+        with self.lock:
+            if id not in self._conditions:
+                self._conditions[id] = threading.Condition()
+            return self._conditions[id]
+
+    def notify(self, id):
+        condition = self._condition(id)
+        with condition:
+            condition.notify_all()
+
+    def wait_for(self, id, predicate, timeout, interval = 1.0):
+        """
+        Blocks until predicate() returns True or the timeout expires, and
+        returns whether the predicate was satisfied.
+        """
+        deadline = time.time() + timeout
+        condition = self._condition(id)
+        with condition:
+            while not predicate():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                condition.wait(min(remaining, interval))
+
+        return True
@@ -0,0 +1,146 @@
+from classes import DeliveryState
+
+
+class Transition:
+    """
+    A transition of a delivery between two states. Transitions that require
+    authentication name the party of the delivery ('sender' or 'receiver')
+    who must present their challenge token; they are only taken through
+    verification, never by a plain state change.
+    """
+
+    def __init__(self, source, target, party = None):
+        self.source = source
+        self.target = target
+        self.party = party
+
+    @property
+    def token(self):
+        if self.party is None:
+            return None
+        return self.party + 'AuthToken'
+
+
+class StateMachine:
+    """
+    Compiles a list of transitions, whether each state leaves the robot's
+    box locked, and hooks called when a delivery enters a state, into
+    tables keyed by state, so that checking and applying a transition are
+    single lookups.
+    """
+
+    def __init__(self, transitions, locks):
+        self._states = dict((state.name, state) for state in DeliveryState)
+        self._transitions = {}
+        self._verifications = {}
+        for transition in transitions:
+            self._transitions[(transition.source,
+                               transition.target)] = transition
+            if transition.party is not None:
+                self._verifications[transition.source] = transition
+        self._locks = dict(locks)
+        self._hooks = dict((state, []) for state in DeliveryState)
+
+    def add_hook(self, state, hook):
+        """
+        Adds a hook, called with the delivery and its robot whenever a
+        delivery enters the given state.
+        """
+        self._hooks[state].append(hook)
+
+    def state(self, name):
+        """
+        Returns the state with the given name, or None if there is none.
+        """
+        return self._states.get(name)
+
+    def transition(self, source, target):
+        """
+        Returns the transition between two states, or None if it isn't
+        allowed.
+        """
+        return self._transitions.get((source, target))
+
+    def verification(self, state):
+        """
+        Returns the authenticated transition out of a state, or None if
+        deliveries in that state aren't awaiting verification.
+        """
+        return self._verifications.get(state)
+
+    def check(self, delivery, target):
+        """
+        Returns whether a delivery may change to the target state without
+        authentication.
+        """
+        transition = self.transition(delivery.state, target)
+        return transition is not None and transition.party is None
+
+    def apply(self, delivery, robot, target):
+        """
+        Moves a delivery to the target state, locks or unlocks the box of its
+        robot, and calls the hooks of the state. The transition isn't
+        checked. Deliveries without a robot, which can only be changed while
+        testing, just change state.
+        """
+        delivery.state = target
+        if robot is None:
+            return
+        robot.lock = self._locks.get(target, False)
+        for hook in self._hooks[target]:
+            hook(delivery, robot)
+
+    def apply_all(self, changes):
+        """
+        Applies a list of (delivery, robot, target) changes.
+        """
+        for (delivery, robot, target) in changes:
+            self.apply(delivery, robot, target)
+
+
+def arrive_at_source(delivery, robot):
+    robot.location = delivery.fromTarget
+
+
+def arrive_at_destination(delivery, robot):
+    robot.location = delivery.toTarget
+    robot.delivery = None
+
+
+TRANSITIONS = [
+    Transition(DeliveryState.IN_QUEUE, DeliveryState.MOVING_TO_SOURCE),
+    Transition(DeliveryState.MOVING_TO_SOURCE,
+               DeliveryState.AWAITING_AUTHENTICATION_SENDER),
+    Transition(DeliveryState.AWAITING_AUTHENTICATION_SENDER,
+               DeliveryState.AWAITING_PACKAGE_LOAD, 'sender'),
+    Transition(DeliveryState.AWAITING_PACKAGE_LOAD,
+               DeliveryState.PACKAGE_LOAD_COMPLETE),
+    Transition(DeliveryState.PACKAGE_LOAD_COMPLETE,
+               DeliveryState.MOVING_TO_DESTINATION),
+    Transition(DeliveryState.MOVING_TO_DESTINATION,
+               DeliveryState.AWAITING_AUTHENTICATION_RECEIVER),
+    Transition(DeliveryState.AWAITING_AUTHENTICATION_RECEIVER,
+               DeliveryState.AWAITING_PACKAGE_RETRIEVAL, 'receiver'),
+    Transition(DeliveryState.AWAITING_PACKAGE_RETRIEVAL,
+               DeliveryState.PACKAGE_RETRIEVAL_COMPLETE),
+    Transition(DeliveryState.PACKAGE_RETRIEVAL_COMPLETE,
+               DeliveryState.COMPLETE)
+]
+
+# The box is only unlocked while a package is loaded or retrieved
+LOCKS = {
+    DeliveryState.MOVING_TO_SOURCE: True,
+    DeliveryState.AWAITING_AUTHENTICATION_SENDER: True,
+    DeliveryState.AWAITING_PACKAGE_LOAD: False,
+    DeliveryState.PACKAGE_LOAD_COMPLETE: True,
+    DeliveryState.MOVING_TO_DESTINATION: True,
+    DeliveryState.AWAITING_AUTHENTICATION_RECEIVER: True,
+    DeliveryState.AWAITING_PACKAGE_RETRIEVAL: False,
+    DeliveryState.PACKAGE_RETRIEVAL_COMPLETE: True,
+    DeliveryState.COMPLETE: True
+}
+
+DELIVERY_STATES = StateMachine(TRANSITIONS, LOCKS)
+DELIVERY_STATES.add_hook(DeliveryState.AWAITING_AUTHENTICATION_SENDER,
+                         arrive_at_source)
+DELIVERY_STATES.add_hook(DeliveryState.COMPLETE, arrive_at_destination)
@@ -0,0 +1,581 @@
+import codec
+import sqlite3
+import threading
+import time
+import warnings
+from journal import Journal
+
+
+# Snapshots written before every object had its own key kept all robots
+# and deliveries in one pickled dictionary under these keys, which can't be
+# read any more
+LEGACY_KEYS = ('robots', 'deliveries')
+
+
+class StateStore(object):
+    """
+    A state store keeps the volatile server state (robots, deliveries and
+    counters). Each request obtains a handle through open(), which behaves
+    like a dictionary of arbitrary picklable objects. Values are serialised
+    in the compact format of the codec module.
+
+    Every robot and delivery is stored under its own key (e.g. 'robot:0',
+    'delivery:3'). Objects read from a handle may be mutated in place, but
+    must be assigned back to their key to be persisted. Objects with a
+    version attribute can also be written with compare_and_update(), which
+    fails if another request has stored a different version meanwhile.
+
+    A shared store may be written by several processes at once, so state
+    derived from it in one process (such as the delivery index) must be
+    refreshed through changes().
+    """
+
+    shared = False
+    threaded = True
+
+    def open(self):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+
+class ShelveStore(StateStore):
+    """
+    Compatibility mode: every request opens the shelve file and persists
+    the entries it wrote on teardown. Requests served at once would write
+    back stale copies of the file, so it can only serve one request at a
+    time.
+    """
+
+    threaded = False
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def open(self):
+        return ShelveHandle(self.filename)
+
+
+class ShelveHandle(object):
+    """
+    Per-request view of the shelve file. Entries read are kept for the rest
+    of the request so they can be mutated in place, but only the entries
+    assigned through the handle are written back on sync().
+    """
+
+    def __init__(self, filename):
+        self._shelf = codec.open_shelf(filename)
+        self._cache = {}
+        self._dirty = set()
+
+    def keys(self):
+        return list(set(self._shelf.keys()) | self._dirty)
+
+    def __contains__(self, key):
+        return key in self._cache or key in self._shelf
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            self._cache[key] = self._shelf[key]
+        return self._cache[key]
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+        self._dirty.add(key)
+
+    def update(self, entries):
+        self._cache.update(entries)
+        self._dirty.update(entries.keys())
+
+    def compare_and_update(self, entries, versions):
+        for key, value in entries.items():
+            if key in self._dirty:
+                # The shelf is behind the entries written by this request,
+                # which are only changed in place through the same object
+                stored = self._cache[key]
+                if stored is value:
+                    continue
+            else:
+                stored = self._shelf[key] if key in self._shelf else None
+            if _version(stored) != versions[key]:
+                return False
+
+        self.update(entries)
+        return True
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self._cache.pop(key, None)
+        self._dirty.discard(key)
+        if key in self._shelf:
+            del self._shelf[key]
+
+    def incr(self, key, amount = 1):
+        value = (self[key] if key in self else 0) + amount
+        self[key] = value
+        return value
+
+    def clear(self):
+        self._shelf.clear()
+        self._cache.clear()
+        self._dirty.clear()
+
+    def sync(self):
+        for key in self._dirty:
+            self._shelf[key] = self._cache[key]
+        self._dirty.clear()
+        self._shelf.sync()
+
+    def close(self):
+        self.sync()
+        self._shelf.close()
+
+
+class MemoryStore(StateStore):
+    """
+    Keeps all objects resident in the process and periodically snapshots
+    the entries written since the last snapshot to the shelve file.
+
+    Given a journal, every write is also appended to it, and the journal is
+    truncated after each snapshot. The writes it holds are replayed when
+    the store is loaded, so a restart recovers the state up to the last
+    commit of the journal rather than the last snapshot.
+    """
+
+    def __init__(self, filename, snapshot_interval = 5.0, journal = None):
+        self.filename = filename
+        self.snapshot_interval = snapshot_interval
+        self.journal = journal
+        self.lock = threading.RLock()
+        self._data = {}
+        self._dirty = set()
+        self._deleted = set()
+        self._load()
+        self._last_snapshot = time.time()
+
+    def _load(self):
+        snapshot = codec.open_shelf(self.filename)
+        try:
+            for key in snapshot.keys():
+                if key in LEGACY_KEYS:
+                    # Removed from the snapshot on the next flush
+                    warnings.warn("Discarding the legacy '%s' entry of %s" %
+                                  (key, self.filename))
+                    self._deleted.add(key)
+                else:
+                    self._data[key] = snapshot[key]
+        finally:
+            snapshot.close()
+
+        if self.journal is not None:
+            for key, value in self.journal.replay():
+                if value is None:
+                    self._data.pop(key, None)
+                    self._dirty.discard(key)
+                    self._deleted.add(key)
+                else:
+                    self._data[key] = value
+                    self._dirty.add(key)
+                    self._deleted.discard(key)
+
+            # Compact the replayed writes into the snapshot straight away
+            self.flush()
+
+    def open(self):
+        return self
+
+    def keys(self):
+        return self._data.keys()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self._data[key] = value
+            self._dirty.add(key)
+            self._deleted.discard(key)
+            if self.journal is not None:
+                self.journal.write(key, value)
+
+    def update(self, entries):
+        """
+        Writes several entries at once, under a single acquisition of the
+        store lock.
+        """
+        with self.lock:
+            self._data.update(entries)
+            self._dirty.update(entries.keys())
+            self._deleted.difference_update(entries.keys())
+            if self.journal is not None:
+                for key, value in entries.items():
+                    self.journal.write(key, value)
+
+    def compare_and_update(self, entries, versions):
+        """
+        Objects are resident, so an entry that is still the object being
+        written can only have been changed through that object, and its
+        version is only compared when it has been replaced. Requests must
+        lock the robots and deliveries they update, so that they don't
+        change the same object at once.
+        """
+        with self.lock:
+            for key, value in entries.items():
+                stored = self._data.get(key)
+                if stored is not value and _version(stored) != versions[key]:
+                    return False
+
+            self.update(entries)
+            return True
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self._data[key]
+            self._dirty.discard(key)
+            self._deleted.add(key)
+            if self.journal is not None:
+                self.journal.delete(key)
+
+    def incr(self, key, amount = 1):
+        with self.lock:
+            value = self._data.get(key, 0) + amount
+            self[key] = value
+            return value
+
+    def clear(self):
+        with self.lock:
+            for key in list(self._data.keys()):
+                del self[key]
+
+    def sync(self):
+        if time.time() - self._last_snapshot >= self.snapshot_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every dirty entry to the snapshot file and removes the
+        entries deleted since the last snapshot, which makes the journal
+        redundant. The journal is only truncated once the snapshot is on
+        disk, so that a crash never loses both.
+        """
+        with self.lock:
+            if len(self._dirty) > 0 or len(self._deleted) > 0:
+                snapshot = codec.open_shelf(self.filename)
+                try:
+                    for key in self._deleted:
+                        if key in snapshot:
+                            del snapshot[key]
+                    for key in self._dirty:
+                        snapshot[key] = self._data[key]
+                finally:
+                    snapshot.close()
+                codec.fsync_shelf(self.filename)
+
+                self._dirty.clear()
+                self._deleted.clear()
+                if self.journal is not None:
+                    self.journal.truncate()
+
+            self._last_snapshot = time.time()
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(StateStore):
+    """
+    Keeps the state in an SQLite database, so that it can be shared by
+    several worker processes. Each request reads through its own connection
+    and commits the entries it wrote in a single transaction on teardown.
+
+    Every commit is stamped with a new revision, and deleted entries are
+    kept as tombstones, so that a process can catch up with the changes
+    committed by the others through changes(). Clearing the store starts a
+    new generation instead.
+    """
+
+    shared = True
+
+    def __init__(self, filename, timeout = 30.0):
+        self.filename = filename
+        self.timeout = timeout
+
+        db = self._connect()
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY '
+                       'KEY, value BLOB, revision INTEGER NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS state_revision '
+                       'ON state (revision)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY '
+                       'KEY, value INTEGER NOT NULL)')
+            db.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0)")
+            db.execute("INSERT OR IGNORE INTO meta VALUES ('revision', 0)")
+        finally:
+            db.close()
+
+    def _connect(self):
+        # Connections are opened per handle rather than kept per thread, so
+        # they are never inherited by forked worker processes
+        return sqlite3.connect(self.filename, timeout = self.timeout,
+                               isolation_level = None)
+
+    def open(self):
+        return SQLiteHandle(self._connect())
+
+    def changes(self, prefix, position = None):
+        """
+        Returns the entries under a key prefix that changed after position,
+        as (position, reset, entries). entries is a list of (key, value)
+        pairs, where the value of a deleted entry is None. When position is
+        None or from an earlier generation, reset is True and every entry
+        under the prefix is returned instead.
+        """
+        db = self._connect()
+        try:
+            db.execute('BEGIN')
+            meta = dict(db.execute('SELECT name, value FROM meta'))
+            current = (meta['generation'], meta['revision'])
+
+            query = 'SELECT key, value FROM state WHERE key >= ? AND key < ?'
+            args = [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+            reset = position is None or position[0] != current[0]
+            if reset:
+                query += ' AND value IS NOT NULL'
+            else:
+                query += ' AND revision > ?'
+                args.append(position[1])
+
+            entries = [(str(key), _loads(value))
+                       for key, value in db.execute(query, args)]
+            db.execute('COMMIT')
+            return (current, reset, entries)
+        finally:
+            db.close()
+
+
+def _version(value):
+    return 0 if value is None else value.version
+
+
+def _dumps(value):
+    return buffer(codec.dumps(value))       # NOQA
+
+
+def _loads(value):
+    return None if value is None else codec.loads(str(value))
+
+
+class SQLiteHandle(object):
+    """
+    Per-request view of an SQLite store. Like ShelveHandle, entries read are
+    kept for the rest of the request, and only the entries assigned or
+    deleted through the handle are written back on sync().
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._cache = {}
+        self._dirty = set()
+        self._deleted = set()
+
+    def keys(self):
+        keys = set(str(key) for (key,) in self._db.execute(
+            'SELECT key FROM state WHERE value IS NOT NULL'))
+        return list((keys | self._dirty) - self._deleted)
+
+    def __contains__(self, key):
+        if key in self._deleted:
+            return False
+        if key in self._cache:
+            return True
+        return self._read(key) is not None
+
+    def _read(self, key):
+        row = self._db.execute('SELECT value FROM state WHERE key = ?',
+                               (key,)).fetchone()
+        value = None if row is None else _loads(row[0])
+        if value is not None:
+            self._cache[key] = value
+        return value
+
+    def __getitem__(self, key):
+        if key in self._deleted or (key not in self._cache and
+                                    self._read(key) is None):
+            raise KeyError(key)
+        return self._cache[key]
+
+    def __setitem__(self, key, value):
+        self._cache[key] = value
+        self._dirty.add(key)
+        self._deleted.discard(key)
+
+    def update(self, entries):
+        self._cache.update(entries)
+        self._dirty.update(entries.keys())
+        self._deleted.difference_update(entries.keys())
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self._cache.pop(key, None)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+
+    def compare_and_update(self, entries, versions):
+        """
+        Writes entries only if the version of every stored entry (0 for
+        missing entries) still matches versions, and returns whether they
+        were written. The entries are committed immediately, so that other
+        processes compare against them.
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            for key in entries:
+                row = self._db.execute('SELECT value FROM state WHERE key = ?',
+                                       (key,)).fetchone()
+                stored = None if row is None else _loads(row[0])
+                if _version(stored) != versions[key]:
+                    self._db.execute('ROLLBACK')
+                    return False
+
+            revision = self._next_revision()
+            self._db.executemany(
+                'INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                [(key, _dumps(value), revision)
+                 for key, value in entries.items()])
+            self._db.execute('COMMIT')
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+
+        self._cache.update(entries)
+        self._dirty.difference_update(entries.keys())
+        self._deleted.difference_update(entries.keys())
+        return True
+
+    def _next_revision(self):
+        self._db.execute("UPDATE meta SET value = value + 1 "
+                         "WHERE name = 'revision'")
+        return self._db.execute("SELECT value FROM meta "
+                                "WHERE name = 'revision'").fetchone()[0]
+
+    def incr(self, key, amount = 1):
+        """
+        Atomically adds amount to a counter, and returns its new value. The
+        increment is committed immediately, so concurrent requests in other
+        processes never see the same value.
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            if key in self._dirty:
+                value = self._cache[key]
+            elif key in self._deleted:
+                value = 0
+            else:
+                value = self._read(key) or 0
+            value += amount
+
+            self._db.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                             (key, _dumps(value), self._next_revision()))
+            self._db.execute('COMMIT')
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+
+        self._cache[key] = value
+        self._dirty.discard(key)
+        self._deleted.discard(key)
+        return value
+
+    def clear(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        self._db.execute('DELETE FROM state')
+        self._db.execute("UPDATE meta SET value = value + 1 "
+                         "WHERE name = 'generation'")
+        self._db.execute('COMMIT')
+
+        self._cache.clear()
+        self._dirty.clear()
+        self._deleted.clear()
+
+    def sync(self):
+        if len(self._dirty) == 0 and len(self._deleted) == 0:
+            return
+
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            revision = self._next_revision()
+            self._db.executemany(
+                'INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+                [(key, _dumps(self._cache[key]), revision)
+                 for key in self._dirty])
+            self._db.executemany(
+                'UPDATE state SET value = NULL, revision = ? WHERE key = ?',
+                [(revision, key) for key in self._deleted])
+            self._db.execute('COMMIT')
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+
+        self._dirty.clear()
+        self._deleted.clear()
+
+    def close(self):
+        try:
+            self.sync()
+        finally:
+            self._db.close()
+
+
+def store_class(config):
+    backends = {'shelve': ShelveStore, 'memory': MemoryStore,
+                'sqlite': SQLiteStore}
+    return backends.get(config.get('STATE_STORE', 'shelve'), StateStore)
+
+
+def is_shared_store(config):
+    """
+    Returns whether the state store selected by STATE_STORE can be shared
+    by several processes, without creating it.
+    """
+    return store_class(config).shared
+
+
+def is_threaded_store(config):
+    """
+    Returns whether the state store selected by STATE_STORE can serve
+    several requests at once in a process.
+    """
+    return store_class(config).threaded
+
+
+def create_store(config):
+    """
+    Builds the state store selected by STATE_STORE in the configuration.
+    """
+    backend = config.get('STATE_STORE', 'shelve')
+    filename = config['SHELVE_FILENAME']
+
+    if backend == 'shelve':
+        return ShelveStore(filename)
+    elif backend == 'memory':
+        journal = None
+        if config.get('STATE_JOURNAL_FILENAME'):
+            journal = Journal(config['STATE_JOURNAL_FILENAME'],
+                              config.get('STATE_JOURNAL_COMMIT_INTERVAL',
+                                         0.05))
+        return MemoryStore(filename,
+                           config.get('STATE_SNAPSHOT_INTERVAL', 5.0),
+                           journal)
+    elif backend == 'sqlite':
+        return SQLiteStore(config['STATE_DATABASE_FILENAME'])
+
+    raise ValueError("Unknown state store: " + str(backend))
@@ -0,0 +1,388 @@
+import array
+import fcntl
+import glob
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def downsample(columns, points = None):
+    """
+    Averages consecutive samples of every column into at most points
+    buckets, and returns the columns as lists. Columns may be lists, arrays
+    or NumPy arrays.
+    """
+    n = len(columns['time'])
+    if points is None or n <= points:
+        return dict((name, values.tolist() if hasattr(values, 'tolist')
+                     else list(values)) for name, values in columns.items())
+
+    starts = [b * n // points for b in range(0, points)]
+    ends = starts[1:] + [n]
+    result = {}
+    for name, values in columns.items():
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            sums = numpy.add.reduceat(values.astype('f8'), starts)
+            result[name] = (sums / numpy.diff(starts + [n])).tolist()
+        else:
+            result[name] = [float(sum(values[start:end])) / (end - start)
+                            for start, end in zip(starts, ends)]
+    return result
+
+
+class TelemetryRing:
+    """
+    Fixed-capacity ring buffer of robot telemetry samples. Each column is a
+    flat array of doubles, so a robot's history takes a bounded amount of
+    memory and appending a sample does not allocate.
+    """
+
+    COLUMNS = ('time', 'correction', 'angle', 'distance')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self._columns = [array.array('d', [0.0]) * capacity
+                         for c in self.COLUMNS]
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, sample):
+        """
+        Appends a sample, given as a tuple of values in COLUMNS order,
+        overwriting the oldest sample once the buffer is full.
+        """
+        with self.lock:
+            i = self._count % self.capacity
+            for column, value in zip(self._columns, sample):
+                column[i] = value
+            self._count += 1
+
+    def _bisect(self, times, value, lo, hi, right = False):
+        # Samples are appended in time order, so the logical range
+        # [lo, hi) is sorted by time even when it wraps around.
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = times[mid % self.capacity]
+            if t < value or (right and t == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, since = None, until = None, points = None):
+        """
+        Returns the samples taken between since and until (inclusive) as a
+        dictionary of column lists in chronological order. When more than
+        points samples match, consecutive samples are averaged into points
+        buckets.
+        """
+        with self.lock:
+            times = self._columns[0]
+            lo = max(0, self._count - self.capacity)
+            hi = self._count
+            if since is not None:
+                lo = self._bisect(times, since, lo, hi)
+            if until is not None:
+                hi = self._bisect(times, until, lo, hi, True)
+
+            # Copy the range out of the ring, in at most two slices
+            start = lo % self.capacity
+            end = start + (hi - lo)
+            result = {}
+            for name, column in zip(self.COLUMNS, self._columns):
+                values = column[start:min(end, self.capacity)]
+                if end > self.capacity:
+                    values += column[0:end - self.capacity]
+                result[name] = values
+
+        return downsample(result, points)
+
+
+class TelemetryHistory:
+    """
+    Keeps a TelemetryRing for every robot that has reported telemetry.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self._rings = {}
+
+    def get(self, id):
+        ring = self._rings.get(id)
+        if ring is None:
+            with self.lock:
+                ring = self._rings.setdefault(id, TelemetryRing(self.capacity))
+        return ring
+
+    def query(self, id, since = None, until = None, points = None):
+        ring = self._rings.get(id)
+        if ring is None:
+            return dict((c, []) for c in TelemetryRing.COLUMNS)
+        return ring.query(since, until, points)
+
+    def record(self, robot, timestamp):
+        self.get(robot.id).append((timestamp, robot.correction, robot.angle,
+                                   robot.distance))
+
+
+# Telemetry log segments start with a header of (magic, format version,
+# reserved, capacity, count), followed by one block per column holding
+# capacity values of the given struct format.
+SEGMENT_HEADER = struct.Struct('<4sHHII')
+SEGMENT_MAGIC = 'RXTL'
+SEGMENT_VERSION = 1
+SEGMENT_COUNT_OFFSET = 12
+SEGMENT_COLUMNS = (('time', 'd'), ('correction', 'd'), ('angle', 'd'),
+                   ('distance', 'd'), ('robot', 'i'), ('motor', 'B'))
+
+
+def segment_layout(capacity):
+    """
+    Returns the offset of every column in a segment, and the segment size.
+    """
+    offsets = {}
+    offset = SEGMENT_HEADER.size
+    for name, format in SEGMENT_COLUMNS:
+        offsets[name] = offset
+        offset += struct.calcsize('<' + format) * capacity
+    return (offsets, offset)
+
+
+def read_segment(path, id, since = None, until = None):
+    """
+    Reads the samples of a robot between since and until from a segment
+    file, or returns None if the segment holds no such samples. The segment
+    is memory-mapped, and with NumPy each column is viewed in place so that
+    only the matching samples are copied.
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        # Removed by another process meanwhile, once it had too many
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size < SEGMENT_HEADER.size:
+            return None
+        segment = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    # The samples returned are copies, so the map is closed either way
+    try:
+        return read_samples(segment, id, since, until)
+    finally:
+        segment.close()
+
+
+def read_samples(segment, id, since, until):
+    """
+    Reads the samples of a robot from a memory-mapped segment, like
+    read_segment.
+    """
+    (magic, version, _, capacity, count) = \
+        SEGMENT_HEADER.unpack_from(segment)
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or count == 0:
+        return None
+
+    # Samples are appended in time order, so a segment outside the range
+    # can be skipped by looking at its first and last timestamps.
+    (offsets, _) = segment_layout(capacity)
+    first = struct.unpack_from('<d', segment, offsets['time'])[0]
+    last = struct.unpack_from('<d', segment,
+                              offsets['time'] + 8 * (count - 1))[0]
+    if ((since is not None and last < since) or
+            (until is not None and first > until)):
+        return None
+
+    if numpy is not None:
+        columns = dict((name, numpy.frombuffer(segment, '<' + format, count,
+                                               offsets[name]))
+                       for name, format in SEGMENT_COLUMNS)
+        mask = columns['robot'] == id
+        if since is not None:
+            mask &= columns['time'] >= since
+        if until is not None:
+            mask &= columns['time'] <= until
+
+        return dict((name, column[mask])
+                    for name, column in columns.items() if name != 'robot')
+
+    columns = {}
+    for name, format in SEGMENT_COLUMNS:
+        size = struct.calcsize('<' + format)
+        values = array.array(format)
+        values.fromstring(segment[offsets[name]:offsets[name] + size * count])
+        columns[name] = values
+
+    indices = [i for i in range(0, count) if columns['robot'][i] == id and
+               (since is None or columns['time'][i] >= since) and
+               (until is None or columns['time'][i] <= until)]
+    return dict((name, [column[i] for i in indices])
+                for name, column in columns.items() if name != 'robot')
+
+
+class TelemetryLog:
+    """
+    Persists telemetry samples to a directory of fixed-size segment files.
+    Each segment lays its records out column by column, so that a column
+    can be read back as one flat array. Samples are written through a
+    memory map of the active segment, and a new segment is started once
+    it is full; only the newest maxSegments segments are kept.
+
+    The active segment is locked, so that a restarted process carries on
+    writing the newest segment it finds unless another process still holds
+    it, rather than leaving a mostly empty segment behind on every start.
+    """
+
+    def __init__(self, directory, segmentRecords = 65536, maxSegments = 16):
+        self.directory = directory
+        self.segmentRecords = segmentRecords
+        self.maxSegments = maxSegments
+        self.lock = threading.Lock()
+        (self._offsets, self._size) = segment_layout(segmentRecords)
+        self._structs = [(self._offsets[name], struct.Struct('<' + format))
+                         for name, format in SEGMENT_COLUMNS]
+        self._segment = None
+        self._file = None
+        self._sequence = 0
+        self._count = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory,
+                                             'telemetry-*.seg')))
+
+    def _close_segment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        if self._file is not None:
+            # Closing the file releases its lock
+            self._file.close()
+            self._file = None
+
+    def _lock_segment(self, f):
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def _resume_segment(self):
+        """
+        Reopens the newest segment that isn't being written by another
+        process, and returns whether it had room left.
+        """
+        for path in reversed(self.segments()):
+            try:
+                f = open(path, 'r+b')
+            except IOError:
+                # Removed by another process meanwhile
+                continue
+            if not self._lock_segment(f):
+                continue
+
+            header = self._file.read(SEGMENT_HEADER.size)
+            if (len(header) == SEGMENT_HEADER.size and
+                    os.fstat(self._file.fileno()).st_size == self._size):
+                (magic, version, _, capacity, count) = \
+                    SEGMENT_HEADER.unpack(header)
+                if (magic == SEGMENT_MAGIC and version == SEGMENT_VERSION and
+                        capacity == self.segmentRecords and
+                        count < capacity):
+                    self._segment = mmap.mmap(self._file.fileno(),
+                                              self._size)
+                    self._count = count
+                    return True
+
+            self._close_segment()
+            return False
+        return False
+
+    def _start_segment(self, timestamp):
+        self._close_segment()
+
+        # Names sort by creation time, and stay unique across processes
+        name = 'telemetry-%013d-%d-%d.seg' % (int(timestamp * 1000),
+                                              os.getpid(), self._sequence)
+        self._sequence += 1
+
+        f = open(os.path.join(self.directory, name), 'w+b')
+        self._lock_segment(f)
+        f.truncate(self._size)
+        f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, 0,
+                                    self.segmentRecords, 0))
+        f.flush()
+        self._segment = mmap.mmap(f.fileno(), self._size)
+        self._count = 0
+
+        if self.maxSegments > 0:
+            for path in self.segments()[:-self.maxSegments]:
+                os.remove(path)
+
+    def append(self, timestamp, robot):
+        values = (timestamp, robot.correction, robot.angle, robot.distance,
+                  robot.id, robot.motor)
+
+        with self.lock:
+            if self._segment is None:
+                if not self._resume_segment():
+                    self._start_segment(timestamp)
+            elif self._count == self.segmentRecords:
+                self._start_segment(timestamp)
+
+            for (offset, column), value in zip(self._structs, values):
+                column.pack_into(self._segment,
+                                 offset + column.size * self._count, value)
+
+            # The count is written last, so readers only see whole records
+            self._count += 1
+            struct.pack_into('<I', self._segment, SEGMENT_COUNT_OFFSET,
+                             self._count)
+
+    def query(self, id, since = None, until = None, points = None):
+        """
+        Returns the samples of a robot between since and until across all
+        segments, downsampled like TelemetryRing.query.
+        """
+        parts = [part for part in [read_segment(path, id, since, until)
+                                   for path in self.segments()]
+                 if part is not None]
+
+        names = [name for name, format in SEGMENT_COLUMNS if name != 'robot']
+        if numpy is not None:
+            columns = dict((name, numpy.concatenate(
+                [part[name] for part in parts] or [numpy.zeros(0)]))
+                for name in names)
+
+            # Segments written by different processes may interleave
+            order = numpy.argsort(columns['time'], kind = 'mergesort')
+            columns = dict((name, column[order])
+                           for name, column in columns.items())
+        else:
+            merged = dict((name, []) for name in names)
+            for part in parts:
+                for name in names:
+                    merged[name].extend(part[name])
+
+            samples = sorted(zip(*[merged[name] for name in names]))
+            columns = dict((name, [sample[i] for sample in samples])
+                           for i, name in enumerate(names))
+
+        return downsample(columns, points)
+
+    def close(self):
+        with self.lock:
+            self._close_segment()
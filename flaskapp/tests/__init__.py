@@ -0,0 +1,9 @@
+import atexit
+import shutil
+import tempfile
+import flaskapp
+
+# Telemetry written by the tests is kept out of the source tree
+flaskapp.app.config['TELEMETRY_LOG_DIR'] = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, flaskapp.app.config['TELEMETRY_LOG_DIR'],
+                True)
@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from allocator import IdAllocator
+from store import MemoryStore, SQLiteStore
+
+
+def allocate_ids(filename, count, queue):
+    store = SQLiteStore(filename)
+    allocator = IdAllocator('deliveryQueue', 10)
+    ids = []
+    for i in range(0, count):
+        cache = store.open()
+        ids.append(allocator.allocate(cache))
+        cache.close()
+    queue.put(ids)
+
+
+class IdAllocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'state.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_allocate_sequential_blocks(self):
+        store = MemoryStore(self.filename)
+        first = IdAllocator('deliveryQueue', 3)
+        second = IdAllocator('deliveryQueue', 3)
+
+        self.assertEquals(first.allocate(store), 0)
+        self.assertEquals(second.allocate(store), 3)
+        self.assertEquals([first.allocate(store) for i in range(0, 3)],
+                          [1, 2, 6])
+        self.assertEquals(store['deliveryQueueCounter'], 9)
+
+    def test_allocate_block(self):
+        store = MemoryStore(self.filename)
+        allocator = IdAllocator('deliveryQueue', 5)
+        self.assertEquals(allocator.allocate(store), 0)
+
+        # Taken from the current block while it has room, and reserved
+        # separately otherwise
+        self.assertEquals(allocator.allocate_block(store, 3), 1)
+        self.assertEquals(allocator.allocate_block(store, 3), 5)
+        self.assertEquals(allocator.allocate(store), 4)
+        self.assertEquals(allocator.allocate(store), 8)
+
+    def test_continues_existing_counter(self):
+        store = MemoryStore(self.filename)
+        store['deliveryQueueCounter'] = 5
+        self.assertEquals(IdAllocator('deliveryQueue').allocate(store), 5)
+
+    def test_reset(self):
+        store = MemoryStore(self.filename)
+        first = IdAllocator('deliveryQueue', 10)
+        second = IdAllocator('deliveryQueue', 10)
+        first.allocate(store)
+        second.allocate(store)
+
+        first.reset(store)
+        self.assertEquals(second.allocate(store), 0)
+        self.assertEquals(first.allocate(store), 10)
+        self.assertFalse('deliveryQueueCounter' in store)
+
+    def test_allocate_across_threads(self):
+        store = MemoryStore(self.filename)
+        allocator = IdAllocator('deliveryQueue', 7)
+        ids = []
+
+        def allocate():
+            for i in range(0, 100):
+                ids.append(allocator.allocate(store))
+
+        threads = [threading.Thread(target=allocate) for i in range(0, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(sorted(ids), range(0, 400))
+
+    def test_allocate_across_processes(self):
+        SQLiteStore(self.filename)
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=allocate_ids,
+                                             args=(self.filename, 25, queue))
+                     for i in range(0, 4)]
+        for process in processes:
+            process.start()
+        ids = sum([queue.get() for process in processes], [])
+        for process in processes:
+            process.join()
+
+        self.assertEquals(len(set(ids)), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+from flask_testing import TestCase
+import unittest
+import benchmark
+import flaskapp
+
+
+class BenchmarkTest(TestCase):
+    def create_app(self):
+        app = flaskapp.app
+        app.config['TESTING'] = True
+        app.config['DATASET_DATABASE_URI'] = 'sqlite:///testdb.db'
+        return app
+
+    def test_percentile(self):
+        latencies = range(1, 101)
+        self.assertEquals(benchmark.percentile(latencies, 50), 50)
+        self.assertEquals(benchmark.percentile(latencies, 99), 99)
+        self.assertEquals(benchmark.percentile([5], 95), 5)
+        self.assertEquals(benchmark.percentile([], 50), None)
+
+    def test_configure_app(self):
+        # Every file of the benchmark is kept in its directory
+        config = dict(self.app.config)
+        try:
+            benchmark.configure_app(self.app, '/tmp/benchmark', None)
+            for key, value in self.app.config.items():
+                if key.endswith('_FILENAME') or key.endswith('_DIR'):
+                    self.assertTrue(value.startswith('/tmp/benchmark/'), key)
+        finally:
+            self.app.config.clear()
+            self.app.config.update(config)
+
+    def test_parse_args_error_unknown_scenario(self):
+        with self.assertRaises(SystemExit):
+            benchmark.parse_args(['--scenarios', 'foo'])
+
+    def test_run_scenarios(self):
+        options = benchmark.parse_args([
+            '--requests', '6', '--concurrency', '2', '--robots', '3',
+            '--scenarios', 'deliveries_post,delivery_patch,robot_poll,'
+            'robot_update,fleet_batch'])
+        results = benchmark.Benchmark(
+            lambda: benchmark.TestClient(self.app), options).run(
+                options.scenarios)
+
+        self.assertEquals(sorted(results.keys()), sorted(options.scenarios))
+        for result in results.values():
+            self.assertEquals(result['requests'], 6)
+            self.assertEquals(result['errors'], 0)
+            self.assertTrue(result['p50_ms'] <= result['p99_ms'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import json
+import unittest
+from catalogue import TargetCatalogue
+from classes import Target
+
+
+class CatalogueTest(unittest.TestCase):
+    def setUp(self):
+        self.rows = [{'id': 1, 'name': 'Reception'},
+                     {'id': 2, 'name': 'Office', 'color': 'red'}]
+        self.loads = 0
+        self.notifications = []
+        self.catalogue = TargetCatalogue(self.load)
+        self.catalogue.add_listener(self.notifications.append)
+
+    def load(self):
+        self.loads += 1
+        return [dict(row) for row in self.rows]
+
+    def test_refresh(self):
+        self.catalogue.refresh(0)
+        self.catalogue.refresh(0)
+        self.assertEquals(self.loads, 1)
+        self.assertEquals(self.catalogue.get(2).color, 'red')
+        self.assertEquals(self.catalogue.get(3), None)
+        self.assertEquals(self.notifications, [])
+
+        # A new version reloads the table and reports what changed
+        self.rows[1]['color'] = 'blue'
+        self.rows.append({'id': 3, 'name': 'Pharmacy'})
+        self.catalogue.refresh(1)
+        self.assertEquals(self.loads, 2)
+        self.assertEquals(self.catalogue.get(2).color, 'blue')
+        self.assertEquals(self.notifications, [set([2, 3])])
+
+    def test_apply(self):
+        self.catalogue.refresh(0)
+        self.catalogue.apply(1, {3: Target(3, 'Pharmacy'), 1: None})
+        self.assertEquals(self.loads, 1)
+        self.assertEquals(sorted(self.catalogue.targets()), [2, 3])
+        self.assertEquals(self.catalogue.version, 1)
+        self.assertEquals(self.notifications, [set([1, 3])])
+
+        # Missing a version means another process changed the table
+        self.catalogue.apply(3, {4: Target(4, 'Ward')})
+        self.assertEquals(self.loads, 2)
+        self.assertEquals(sorted(self.catalogue.targets()), [1, 2])
+        self.assertEquals(self.catalogue.version, 3)
+
+    def test_response(self):
+        self.catalogue.refresh(0)
+        (body, etag) = self.catalogue.response()
+        self.assertEquals([t['id'] for t in json.loads(body)], [1, 2])
+        self.assertTrue(self.catalogue.response()[0] is body)
+
+        self.catalogue.apply(1, {2: Target(2, 'Office')})
+        (body2, etag2) = self.catalogue.response()
+        self.assertFalse('red' in body2)
+        self.assertNotEquals(etag, etag2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import cPickle
+import marshal
+import os
+import shelve
+import shutil
+import tempfile
+import unittest
+import codec
+from classes import Delivery, DeliveryState, Instruction, InstructionType
+from classes import Robot, Target
+
+
+class CodecTest(unittest.TestCase):
+    def roundtrip(self, value):
+        return codec.loads(codec.dumps(value))
+
+    def test_domain_objects(self):
+        delivery = Delivery(3, {'id': 1, 'name': 'Reception'},
+                            Target(2, 'Office'), 'foo', 'foo2', 2, 'Papers',
+                            state = DeliveryState.MOVING_TO_SOURCE, robot = 0)
+        delivery.senderAuthToken = 'abc'
+        result = self.roundtrip(delivery)
+        self.assertEquals(result.__getstate__(), delivery.__getstate__())
+        self.assertEquals(result.fromTarget, 1)
+        self.assertEquals(result.toTarget, 2)
+        self.assertTrue(result.state is DeliveryState.MOVING_TO_SOURCE)
+
+        robot = Robot(4)
+        robot.angle = 90.0
+        robot.version = 7
+        robot.batchCache = (7, '{}', 'etag')
+        result = self.roundtrip(robot)
+        self.assertEquals(result.angle, 90.0)
+        self.assertEquals(result.version, 7)
+        self.assertEquals(result.batchCache, None)
+
+        target = self.roundtrip(Target(1, 'Reception', color = 'red',
+                                       x = 1.5, y = -2.0))
+        self.assertEquals(target.__getstate__(), {
+            'id': 1, 'name': 'Reception', 'description': None,
+            'color': 'red', 'x': 1.5, 'y': -2.0})
+
+        instruction = self.roundtrip(Instruction(InstructionType.TURN, 90.0))
+        self.assertTrue(instruction.type is InstructionType.TURN)
+        self.assertEquals(instruction.value, 90.0)
+
+    def test_records_are_compact(self):
+        row = {'id': 1, 'name': 'Reception', 'description': None,
+               'color': None}
+        delivery = Delivery(3, row, row, 'foo', 'foo2', 2, 'Papers')
+        self.assertTrue(len(codec.dumps(delivery)) <
+                        len(cPickle.dumps(delivery, 2)) / 2)
+
+    def test_plain_values(self):
+        for value in [5, None, 'foo', {'a': [1, 2.5, u'b']}]:
+            self.assertEquals(self.roundtrip(value), value)
+
+        # Values marshal can't serialise are pickled
+        value = {'robots': [Robot(1)]}
+        data = codec.dumps(value)
+        self.assertEquals(data[:1], codec.PICKLE_PREFIX)
+        self.assertEquals(codec.loads(data)['robots'][0].id, 1)
+
+    def test_missing_fields_keep_defaults(self):
+        data = marshal.dumps((codec.FORMAT_VERSION, 'robot', (1, True)), 2)
+        robot = codec.loads(data)
+        self.assertEquals(robot.id, 1)
+        self.assertEquals(robot.motor, True)
+        self.assertEquals(robot.version, 0)
+
+    def test_unknown_version(self):
+        data = marshal.dumps((codec.FORMAT_VERSION + 1, None, 5), 2)
+        with self.assertRaises(ValueError):
+            codec.loads(data)
+
+    def test_shelf(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'cache.db')
+            snapshot = shelve.open(filename, protocol = 2)
+            snapshot['deliveryQueueCounter'] = 3
+            snapshot.close()
+
+            snapshot = codec.open_shelf(filename)
+            self.assertEquals(snapshot['deliveryQueueCounter'], 3)
+            snapshot['robot:0'] = Robot(0)
+            snapshot.close()
+
+            snapshot = codec.open_shelf(filename)
+            self.assertEquals(snapshot['robot:0'].id, 0)
+            snapshot.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 from flask_testing import TestCase
 import unittest
 import flaskapp
+from indexes import DeliveryIndex
 
 
 class DataStructureTest(TestCase):
@@ -25,6 +26,71 @@ class DataStructureTest(TestCase):
             flaskapp.Delivery(1, t1, t2, 0, "Foo", "Bar",
                               "jdoe", "drseuss", 5, 20.0, 21.0, -1)
 
+    def make_delivery(self, id, priority, sender = "foo"):
+        return flaskapp.Delivery(id, 1, 2, sender, "foo2", priority, "Foo")
+
+    def test_delivery_index(self):
+        index = DeliveryIndex()
+        index.add(self.make_delivery(0, 1))
+        index.add(self.make_delivery(1, 0))
+        index.add(self.make_delivery(2, 1))
+        index.add(self.make_delivery(3, 0))
+        self.assertEquals(index.ids(), [1, 3, 0, 2])
+        self.assertEquals(len(index), 4)
+
+        # Re-adding with a new priority moves the entry
+        index.add(self.make_delivery(2, -1))
+        self.assertEquals(index.ids(), [2, 1, 3, 0])
+
+        index.remove(1)
+        self.assertFalse(1 in index)
+        self.assertEquals(index.ids(), [2, 3, 0])
+
+        with self.assertRaises(KeyError):
+            index.remove(1)
+
+        index.clear()
+        self.assertEquals(index.ids(), [])
+
+    def test_delivery_index_query(self):
+        index = DeliveryIndex()
+        for id in range(0, 10):
+            index.add(self.make_delivery(id, id % 3,
+                                         "foo" if id % 2 == 0 else "bar"))
+
+        self.assertEquals(index.query(), (index.ids(), None))
+        self.assertEquals(index.query(limit = 3), ([0, 3, 6], (0, 6)))
+        self.assertEquals(index.query(limit = 3, after = (0, 6)),
+                          ([9, 1, 4], (1, 4)))
+        self.assertEquals(index.query(minPriority = 1, maxPriority = 1),
+                          ([1, 4, 7], None))
+        self.assertEquals(index.query({'sender': 'bar'}),
+                          ([3, 9, 1, 7, 5], None))
+        self.assertEquals(index.query({'sender': 'bar'}, limit = 2,
+                                      minPriority = 1),
+                          ([1, 7], (1, 7)))
+        self.assertEquals(index.query({'sender': 'baz'}), ([], None))
+
+        # Secondary indexes follow field changes
+        delivery = self.make_delivery(3, 0, "foo")
+        delivery.robot = 1
+        index.add(delivery)
+        self.assertEquals(index.query({'sender': 'bar'}),
+                          ([9, 1, 7, 5], None))
+        self.assertEquals(index.query({'robot': 1, 'state': 'IN_QUEUE'}),
+                          ([3], None))
+
+        # Pages of filters on several fields
+        filters = {'sender': 'bar', 'state': 'IN_QUEUE'}
+        self.assertEquals(index.query(filters, limit = 2),
+                          ([9, 1], (1, 1)))
+        self.assertEquals(index.query(filters, limit = 2, after = (1, 1)),
+                          ([7, 5], None))
+        self.assertEquals(index.query(filters, limit = 4),
+                          ([9, 1, 7, 5], None))
+        self.assertEquals(index.query(filters, maxPriority = 1),
+                          ([9, 1, 7], None))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,10 @@
 from flask_testing import TestCase
 import json
+import os
+import shutil
+import tempfile
 import flaskapp
-import dataset
+from store import ShelveStore
 
 
 class DeliveryGroupTest(TestCase):
@@ -15,7 +18,7 @@ class DeliveryGroupTest(TestCase):
         return self.app
 
     def clear_database(self):
-        db = dataset.connect(self.app.config['DATASET_DATABASE_URI'])
+        db = flaskapp.get_database()
         db['users'].drop()
 
     def setUp(self):
@@ -172,6 +175,51 @@ class DeliveryGroupTest(TestCase):
         self.assertEquals(r.status_code, 200)
         self.check_response_in_range(r)
 
+    def test_get_deliveries_paginated(self):
+        self.add_data_triple()
+        self.post_data_triple()
+
+        r = self.client.get(self.route + '?limit=2')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(len(r.json), 2)
+        self.check_delivery_response_match(r.json[0], self.data[0])
+        self.check_delivery_response_match(r.json[1], self.data[2])
+        self.assertTrue('X-Next-Cursor' in r.headers)
+
+        r = self.client.get(self.route + '?limit=2&cursor=' +
+                            r.headers['X-Next-Cursor'])
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(len(r.json), 1)
+        self.check_delivery_response_match(r.json[0], self.data[1])
+        self.assertFalse('X-Next-Cursor' in r.headers)
+
+    def test_get_deliveries_filtered(self):
+        self.add_data_triple()
+        self.post_data_triple()
+        self.change_delivery_state("MOVING_TO_SOURCE", 0, 2)
+
+        r = self.client.get(self.route + '?state=IN_QUEUE')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals([d['id'] for d in r.json], [0, 1])
+
+        r = self.client.get(self.route + '?robot=0&sender=foo')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals([d['id'] for d in r.json], [2])
+
+        r = self.client.get(self.route + '?receiver=foo')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json, [])
+
+        r = self.client.get(self.route + '?minPriority=1&maxPriority=1')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals([d['id'] for d in r.json], [1])
+
+    def test_get_deliveries_error_invalid_query(self):
+        for query in ['?limit=0', '?limit=foo', '?state=FOOBAR',
+                      '?robot=foo', '?cursor=foo', '?minPriority=foo']:
+            r = self.client.get(self.route + query)
+            self.assertEquals(r.status_code, 400)
+
     def test_post_deliveries(self):
         self.add_data_single()
         r = self.post_data_single()
@@ -220,6 +268,108 @@ class DeliveryGroupTest(TestCase):
         r = self.post_data_single()
         self.assertEquals(r.status_code, 400)
 
+    def test_post_deliveries_bulk(self):
+        self.add_data_triple()
+        r = self.client.post('/deliveries/bulk', data = json.dumps(self.data),
+                             headers = self.headers)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(len(r.json), 3)
+        self.check_response_in_range(r)
+        ids = [d['id'] for d in r.json]
+        self.assertEquals(ids, range(ids[0], ids[0] + 3))
+
+        # Single deliveries carry on from the bulk ones
+        r = self.client.get(self.route)
+        self.assertEquals([d['id'] for d in r.json],
+                          [ids[0], ids[2], ids[1]])
+        self.add_data_single()
+        r = self.post_data_single()
+        self.assertFalse(r.json['id'] in ids)
+
+    def test_post_deliveries_bulk_errors(self):
+        self.add_data_triple()
+        self.data[1]['to'] = 5
+        self.data[2]['receiver'] = 'nobody'
+        r = self.client.post('/deliveries/bulk', data = json.dumps(self.data),
+                             headers = self.headers)
+        self.assertEquals(r.status_code, 400)
+        self.assertEquals(len(r.json), 3)
+        self.assertFalse('error' in r.json[0])
+        self.assertEquals(r.json[1]['error'], "To target doesn't exist")
+        self.assertEquals(r.json[2]['error'], "Receiver user doesn't exist")
+
+        # Nothing is created
+        r = self.client.get(self.route)
+        self.assertEquals(r.json, [])
+
+    def test_post_deliveries_bulk_unauthorized(self):
+        self.add_data_single()
+        r = self.client.post('/deliveries/bulk', data = json.dumps(self.data))
+        self.assertEquals(r.status_code, 401)
+
+        r = self.client.post('/deliveries/bulk', data = json.dumps({}),
+                             headers = self.headers)
+        self.assertEquals(r.status_code, 400)
+
+    def test_patch_delivery_error_locked(self):
+        self.add_data_single()
+        self.post_data_single()
+
+        timeout = self.app.config.get('ROBOT_LOCK_TIMEOUT')
+        self.app.config['ROBOT_LOCK_TIMEOUT'] = 0.1
+        self.assertTrue(flaskapp.delivery_locks.acquire(0, 1.0))
+        try:
+            r = self.client.patch('/delivery/0', data = json.dumps({
+                'state': 'MOVING_TO_SOURCE', 'robot': 1}))
+            self.assertEquals(r.status_code, 409)
+        finally:
+            flaskapp.delivery_locks.release(0)
+            self.app.config['ROBOT_LOCK_TIMEOUT'] = timeout
+
+        r = self.client.patch('/delivery/0', data = json.dumps({
+            'state': 'MOVING_TO_SOURCE', 'robot': 1}))
+        self.assertEquals(r.status_code, 200)
+
+    def test_patch_deliveries(self):
+        self.add_data_multiple()
+        self.post_data_multiple()
+
+        changes = [{'id': 0, 'state': 'MOVING_TO_SOURCE', 'robot': 0},
+                   {'id': 1, 'state': 'MOVING_TO_SOURCE', 'robot': 1}]
+        r = self.client.patch(self.route, data = json.dumps(changes))
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals([d['state'] for d in r.json],
+                          ['MOVING_TO_SOURCE', 'MOVING_TO_SOURCE'])
+        self.assertEquals([d['robot'] for d in r.json], [0, 1])
+
+        r = self.client.get('/robot/1/batch')
+        self.assertEquals(r.json['delivery']['state'], 'MOVING_TO_SOURCE')
+
+    def test_patch_deliveries_errors(self):
+        self.add_data_triple()
+        self.post_data_triple()
+
+        changes = [{'id': 0, 'state': 'MOVING_TO_SOURCE', 'robot': 0},
+                   {'id': 5, 'state': 'COMPLETE'},
+                   {'id': 2, 'state': 'FOO'}]
+        r = self.client.patch(self.route, data = json.dumps(changes))
+        self.assertEquals(r.status_code, 400)
+        self.assertFalse('error' in r.json[0])
+        self.assertTrue('error' in r.json[1])
+        self.assertEquals(r.json[2]['error'], 'Invalid state')
+
+        # A robot can't take two deliveries
+        changes = [{'id': 0, 'state': 'MOVING_TO_SOURCE', 'robot': 0},
+                   {'id': 1, 'state': 'MOVING_TO_SOURCE', 'robot': 0}]
+        r = self.client.patch(self.route, data = json.dumps(changes))
+        self.assertEquals(r.status_code, 400)
+        self.assertEquals(r.json[1]['error'],
+                          "This robot is busy on another delivery")
+
+        # Nothing is changed
+        r = self.client.get(self.route + '?state=IN_QUEUE')
+        self.assertEquals([d['id'] for d in r.json], [0, 2, 1])
+
     def test_delete_deliveries_empty(self):
         r = self.client.delete(self.route)
         self.assertEquals(r.status_code, 200)
@@ -286,6 +436,32 @@ class DeliveryGroupTest(TestCase):
             self.assertEquals(r.status_code, 200)
             self.assertTrue('delivery' not in r.json)
 
+    def test_delete_deliveries_of_one_robot_shelve(self):
+        directory = tempfile.mkdtemp()
+        previous = (flaskapp.state_store, flaskapp.delivery_index,
+                    flaskapp.delivery_index_position)
+        flaskapp.state_store = ShelveStore(os.path.join(directory, 'cache'))
+        flaskapp.delivery_index = None
+        flaskapp.delivery_index_position = None
+        try:
+            # A new app context, so that requests open the shelve store
+            with self.app.app_context():
+                self.add_data_single()
+                self.post_data_single()
+                self.post_data_single()
+                self.simulate_delivery_state_changes('COMPLETE', 0, 0)
+                self.simulate_delivery_state_changes('COMPLETE', 0, 1)
+
+                # The robot is saved once for each delivery
+                r = self.client.delete(self.route)
+                self.assertEquals(r.status_code, 200)
+                r = self.client.get(self.route)
+                self.assertEquals(r.json, [])
+        finally:
+            (flaskapp.state_store, flaskapp.delivery_index,
+             flaskapp.delivery_index_position) = previous
+            shutil.rmtree(directory)
+
     def test_post_deliveries_unique_id(self):
         self.add_data_multiple()
         self.post_data_multiple()
@@ -352,6 +528,23 @@ class DeliveryGroupTest(TestCase):
         self.assertTrue('state' in r.json['delivery'])
         self.assertEquals(r.json['delivery']['state'], "MOVING_TO_SOURCE")
 
+    def test_patch_delivery_without_robot(self):
+        # Any state may be set while testing, even without a robot
+        self.add_data_multiple()
+        self.post_data_multiple()
+        r = self.client.patch('/delivery/0', data = json.dumps(
+            {"state": "AWAITING_PACKAGE_LOAD"}))
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json['state'], 'AWAITING_PACKAGE_LOAD')
+        r = self.client.patch(self.route, data = json.dumps(
+            [{"id": 1, "state": "PACKAGE_LOAD_COMPLETE"}]))
+        self.assertEquals(r.status_code, 200)
+
+        # No robot is stored for them
+        r = self.client.post('/dispatch')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json, [])
+
     def test_patch_delivery_syncs_with_robot(self):
         self.add_data_single()
         r = self.post_data_single()
@@ -386,6 +579,16 @@ class DeliveryGroupTest(TestCase):
         self.assertEquals(r.json['delivery']['state'],
                           "AWAITING_AUTHENTICATION_SENDER")
 
+    def test_patch_delivery_assigns_other_robot(self):
+        self.add_data_single()
+        self.post_data_single()
+
+        r = self.client.patch('/delivery/0', data = json.dumps(
+            {"state": "MOVING_TO_SOURCE", "robot": 3}))
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json['id'], 0)
+        self.assertEquals(r.json['robot'], 3)
+
     def test_patch_delivery_to_complete_clears_robot_assignment(self):
         self.add_data_single()
         r = self.post_data_single()
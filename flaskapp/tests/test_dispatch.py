@@ -0,0 +1,165 @@
+from flask_testing import TestCase
+import json
+import unittest
+import flaskapp
+from classes import Delivery, Robot
+from dispatch import NearestTargetPolicy, PriorityPolicy, RoundRobinPolicy
+
+
+def make_robot(id, location = None):
+    robot = Robot(id)
+    robot.location = location
+    return robot
+
+
+class DispatchPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.deliveries = [Delivery(i, i, 9, 'foo', 'foo2', 0, 'Papers')
+                           for i in range(0, 3)]
+        self.robots = [make_robot(2), make_robot(0, 1), make_robot(1, 0)]
+
+    def assigned(self, pairs):
+        return [(delivery.id, robot.id) for delivery, robot in pairs]
+
+    def test_priority(self):
+        policy = PriorityPolicy()
+        self.assertEquals(
+            self.assigned(policy.assign(self.deliveries, self.robots)),
+            [(0, 0), (1, 1), (2, 2)])
+        self.assertEquals(
+            self.assigned(policy.assign(self.deliveries[:1], self.robots)),
+            [(0, 0)])
+
+    def test_round_robin(self):
+        policy = RoundRobinPolicy()
+        self.assertEquals(
+            self.assigned(policy.assign(self.deliveries[:2], self.robots)),
+            [(0, 0), (1, 1)])
+        self.assertEquals(
+            self.assigned(policy.assign(self.deliveries[:2], self.robots)),
+            [(0, 2), (1, 0)])
+
+    def test_nearest(self):
+        policy = NearestTargetPolicy()
+        self.assertEquals(
+            self.assigned(policy.assign(self.deliveries, self.robots)),
+            [(0, 1), (1, 0), (2, 2)])
+
+        # Distances between targets, when they are known
+        policy = NearestTargetPolicy(lambda a, b: abs(a - b)
+                                     if a is not None else None)
+        self.assertEquals(
+            self.assigned(policy.assign(self.deliveries[2:], self.robots)),
+            [(2, 0)])
+
+
+class DispatchTest(TestCase):
+    def create_app(self):
+        self.app = flaskapp.app
+        self.app.config['TESTING'] = True
+        self.app.config['DATASET_DATABASE_URI'] = 'sqlite:///testdb.db'
+        return self.app
+
+    def setUp(self):
+        flaskapp.get_database()['users'].drop()
+        self.client.delete('/deliveries')
+        self.client.delete('/targets')
+        self.client.post('/targets', data = json.dumps({'name': 'A'}))
+        self.client.post('/targets', data = json.dumps({'name': 'B'}))
+        for username, password in [('foo', 'bar'), ('foo2', 'bar2')]:
+            self.client.post('/register', data = json.dumps({
+                'username': username, 'password': password}))
+
+        r = self.client.post('/login', data = json.dumps({
+            'username': 'foo', 'password': 'bar'}))
+        self.headers = {'Authorization': 'Bearer ' + str(r.json['bearer'])}
+
+    def post_delivery(self, priority):
+        r = self.client.post('/deliveries', headers = self.headers,
+                             data = json.dumps({
+                                 'name': 'Papers', 'priority': priority,
+                                 'from': 1, 'to': 2, 'sender': 'foo',
+                                 'receiver': 'foo2'}))
+        return r.json['id']
+
+    def add_robots(self, ids):
+        for id in ids:
+            self.client.post('/robot/' + str(id) + '/correction',
+                             data = json.dumps({'correction': 0.0}))
+
+    def dispatch(self, data = None):
+        r = self.client.post('/dispatch', data = json.dumps(data or {}))
+        self.assertEquals(r.status_code, 200)
+        return [(pair['delivery'], pair['robot']) for pair in r.json]
+
+    def test_dispatch(self):
+        ids = [self.post_delivery(priority) for priority in [2, 0, 1]]
+        self.add_robots([0, 1])
+
+        self.assertEquals(self.dispatch(), [(ids[1], 0), (ids[2], 1)])
+        r = self.client.get('/delivery/' + str(ids[1]))
+        self.assertEquals(r.json['state'], 'MOVING_TO_SOURCE')
+        self.assertEquals(r.json['robot'], 0)
+        r = self.client.get('/robot/0/batch')
+        self.assertEquals(r.json['delivery']['state'], 'MOVING_TO_SOURCE')
+        self.assertTrue(r.json['delivery']['senderAuthToken'] is not None)
+
+        # Every robot is busy now
+        self.assertEquals(self.dispatch(), [])
+        r = self.client.get('/deliveries?state=IN_QUEUE')
+        self.assertEquals([d['id'] for d in r.json], [ids[0]])
+
+    def test_dispatch_round_robin(self):
+        self.add_robots([0, 1, 2])
+        policy = {'policy': 'round-robin'}
+        id = self.post_delivery(0)
+        self.assertEquals(self.dispatch(policy), [(id, 0)])
+        self.client.patch('/delivery/' + str(id),
+                          data = json.dumps({'state': 'COMPLETE'}))
+
+        # Robot 0 is idle again, but the next delivery goes to robot 1
+        id = self.post_delivery(0)
+        self.assertEquals(self.dispatch(policy), [(id, 1)])
+
+    def test_dispatch_nearest(self):
+        self.add_robots([1])
+        id = self.post_delivery(0)
+        self.assertEquals(self.dispatch(), [(id, 1)])
+        for state in ['AWAITING_AUTHENTICATION_SENDER', 'COMPLETE']:
+            self.client.patch('/delivery/' + str(id),
+                              data = json.dumps({'state': state}))
+
+        # Robot 1 was left at the destination of its delivery, where the
+        # next delivery starts
+        self.add_robots([0])
+        r = self.client.post('/deliveries', headers = self.headers,
+                             data = json.dumps({
+                                 'name': 'Papers', 'priority': 0, 'from': 2,
+                                 'to': 1, 'sender': 'foo',
+                                 'receiver': 'foo2'}))
+        id = r.json['id']
+        self.assertEquals(self.dispatch({'policy': 'nearest'}), [(id, 1)])
+
+    def test_dispatch_metrics(self):
+        self.app.config['METRICS_ENABLED'] = True
+        try:
+            flaskapp.metrics.clear()
+            self.post_delivery(0)
+            self.add_robots([0])
+            self.dispatch()
+            lines = flaskapp.metrics.render().splitlines()
+        finally:
+            self.app.config['METRICS_ENABLED'] = False
+
+        self.assertTrue('flaskapp_dispatch_assignments_total{policy='
+                        '"priority",result="assigned"} 1' in lines)
+        self.assertTrue('flaskapp_dispatch_duration_seconds_count{policy='
+                        '"priority"} 1' in lines)
+
+    def test_dispatch_error_policy(self):
+        r = self.client.post('/dispatch', data = json.dumps({'policy': 'x'}))
+        self.assertEquals(r.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
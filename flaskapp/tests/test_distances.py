@@ -0,0 +1,54 @@
+import math
+import unittest
+import distances
+from classes import Target
+from distances import DistanceMatrix
+
+
+class DistanceMatrixTest(unittest.TestCase):
+    def check_matrix(self):
+        matrix = DistanceMatrix(speed = 2.0)
+        matrix.set(1, 0.0, 0.0)
+        matrix.set(2, 3.0, 4.0)
+        self.assertEquals(matrix.distance(1, 2), 5.0)
+        self.assertEquals(matrix.distance(2, 1), 5.0)
+        self.assertEquals(matrix.distance(2, 2), 0.0)
+        self.assertEquals(matrix.eta(1, 2), 2.5)
+
+        # Unknown targets, except at no distance from themselves
+        self.assertEquals(matrix.distance(1, 3), None)
+        self.assertEquals(matrix.eta(3, 1), None)
+        self.assertEquals(matrix.distance(3, 3), 0.0)
+
+        # Moving a target recomputes its distances
+        matrix.set(2, 0.0, 1.0)
+        self.assertEquals(matrix.distance(1, 2), 1.0)
+
+        # Slots of removed targets are reused, and the matrix grows
+        matrix.remove(1)
+        self.assertFalse(1 in matrix)
+        self.assertEquals(matrix.distance(1, 2), None)
+        for id in range(3, 20):
+            matrix.set(id, float(id), 1.0)
+        self.assertEquals(matrix.distance(2, 19), 19.0)
+        self.assertEquals(matrix.distance(3, 19), 16.0)
+
+        targets = {2: Target(2, 'Office'), 3: Target(3, 'Ward', x = 3.0,
+                                                     y = 5.0)}
+        matrix.update(targets, [2, 3, 4])
+        self.assertFalse(2 in matrix)
+        self.assertFalse(4 in matrix)
+        self.assertEquals(matrix.distance(3, 19), math.hypot(16.0, 4.0))
+
+    def test_matrix(self):
+        numpy = distances.numpy
+        try:
+            for module in [numpy, None]:
+                distances.numpy = module
+                self.check_matrix()
+        finally:
+            distances.numpy = numpy
+
+
+if __name__ == '__main__':
+    unittest.main()
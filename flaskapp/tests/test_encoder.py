@@ -0,0 +1,63 @@
+from flask_testing import TestCase
+import json
+import unittest
+import flaskapp
+from classes import Delivery, DeliveryState, Instruction, InstructionType
+from classes import Target
+from encoder import CustomJSONEncoder, dumps
+
+
+class SpecialTarget(Target):
+    pass
+
+
+class EncoderTest(TestCase):
+    def create_app(self):
+        app = flaskapp.app
+        app.config['TESTING'] = True
+        return app
+
+    def encode(self, obj, targets = None):
+        return json.loads(json.dumps(obj, cls=CustomJSONEncoder,
+                                     targets=targets))
+
+    def test_encode_domain_objects(self):
+        targets = {1: Target(1, 'Reception', 'Front desk')}
+        delivery = Delivery(3, 1, 2, 'foo', 'foo2', 2, 'Papers')
+        self.assertEquals(self.encode(delivery, targets), {
+            'id': 3, 'name': 'Papers', 'priority': 2,
+            'from': {'id': 1, 'name': 'Reception',
+                     'description': 'Front desk'},
+            'to': {'id': 2}, 'state': 'IN_QUEUE', 'sender': 'foo',
+            'receiver': 'foo2'})
+
+        delivery.robot = 0
+        delivery.description = 'Records'
+        delivery.state = DeliveryState.COMPLETE
+        result = self.encode(delivery)
+        self.assertEquals(result['robot'], 0)
+        self.assertEquals(result['description'], 'Records')
+        self.assertEquals(result['state'], 'COMPLETE')
+
+        self.assertEquals(self.encode(Target(1, 'Reception', color='red')),
+                          {'id': 1, 'name': 'Reception', 'color': 'red'})
+        self.assertEquals(self.encode(SpecialTarget(2, 'Office')),
+                          {'id': 2, 'name': 'Office'})
+        self.assertEquals(
+            self.encode(Instruction(InstructionType.TURN, 90.0)),
+            {'type': 'TURN', 'value': 90.0})
+
+    def test_dumps_matches_encoder(self):
+        targets = {1: Target(1, 'Reception')}
+        objs = [Delivery(i, 1, 1, 'foo', 'foo2', i, 'Papers', robot=i)
+                for i in range(0, 3)]
+        objs.append({'targets': [Target(1, 'Reception', 'Desk')]})
+
+        body = dumps(objs, targets)
+        self.assertFalse('\n' in body)
+        self.assertEquals(json.loads(body), self.encode(objs, targets))
+        self.assertEquals(json.loads(dumps(objs))[0]['from'], {'id': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
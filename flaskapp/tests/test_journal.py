@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from classes import Robot
+from journal import Journal
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cache.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay(self):
+        journal = Journal(self.filename, 0.0)
+        self.assertEquals(journal.replay(), [])
+        journal.write('robot:0', Robot(0))
+        journal.write('deliveryQueueCounter', 3)
+        journal.delete('robot:0')
+        journal.close()
+
+        entries = Journal(self.filename).replay()
+        self.assertEquals([key for key, value in entries],
+                          ['robot:0', 'deliveryQueueCounter', 'robot:0'])
+        self.assertEquals(entries[0][1].id, 0)
+        self.assertEquals(entries[1][1], 3)
+        self.assertEquals(entries[2][1], None)
+
+    def test_torn_record_is_discarded(self):
+        journal = Journal(self.filename, 0.0)
+        journal.write('deliveryQueueCounter', 3)
+        journal.write('deliveryQueueCounter', 4)
+        journal.close()
+
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'r+b') as f:
+            f.truncate(size - 1)
+
+        journal = Journal(self.filename, 0.0)
+        self.assertEquals(journal.replay(), [('deliveryQueueCounter', 3)])
+
+        # Later records follow the last whole one
+        journal.write('deliveryQueueCounter', 5)
+        self.assertEquals(journal.replay(), [('deliveryQueueCounter', 3),
+                                             ('deliveryQueueCounter', 5)])
+
+    def test_group_commit(self):
+        journal = Journal(self.filename, 0.05)
+        for i in range(0, 100):
+            journal.write('deliveryQueueCounter', i)
+
+        # Records are written in the background
+        deadline = time.time() + 5.0
+        while len(journal.replay()) < 100 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(journal.replay()[-1], ('deliveryQueueCounter', 99))
+
+    def test_truncate(self):
+        journal = Journal(self.filename, 60.0)
+        journal.write('deliveryQueueCounter', 3)
+        journal.commit()
+        journal.write('deliveryQueueCounter', 4)
+        journal.truncate()
+        journal.commit()
+        self.assertEquals(journal.replay(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
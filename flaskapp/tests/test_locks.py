@@ -0,0 +1,36 @@
+import threading
+import time
+import unittest
+from locks import RobotLocks
+
+
+class RobotLocksTest(unittest.TestCase):
+    def test_acquire_timeout(self):
+        locks = RobotLocks()
+        self.assertTrue(locks.acquire(0, 1.0))
+        self.assertFalse(locks.acquire(0, 0.05))
+
+        # Other robots can still be locked
+        self.assertTrue(locks.acquire(1, 0.05))
+
+        locks.release(0)
+        self.assertTrue(locks.acquire(0, 0.05))
+
+    def test_release_wakes_waiter(self):
+        locks = RobotLocks()
+        locks.acquire(0, 1.0)
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(locks.acquire(0, 5.0)))
+        waiter.start()
+
+        time.sleep(0.05)
+        start = time.time()
+        locks.release(0)
+        waiter.join()
+        self.assertEquals(acquired, [True])
+        self.assertTrue(time.time() - start < 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
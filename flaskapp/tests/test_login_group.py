@@ -2,7 +2,8 @@ from flask_testing import TestCase
 import json
 import unittest
 import flaskapp
-import dataset
+from tokens import TokenCache
+from hashing import PasswordHasher, PoolSaturatedException
 
 
 class LoginGroupTest(TestCase):
@@ -15,7 +16,7 @@ class LoginGroupTest(TestCase):
         return self.app
 
     def clear_database(self):
-        db = dataset.connect(self.app.config['DATASET_DATABASE_URI'])
+        db = flaskapp.get_database()
         db['users'].drop()
 
     def setUp(self):
@@ -74,6 +75,80 @@ class LoginGroupTest(TestCase):
 
         self.assertNotEquals(bearer1, bearer2)
 
+    def test_post_login_invalidates_previous_bearer(self):
+        self.register_foo()
+        data = {'username': 'foo',
+                'password': 'bar'}
+        route = '/robot/99/verify'
+        verifyData = json.dumps({'token': 'foo'})
+
+        r = self.client.post(self.loginRoute, data = json.dumps(data))
+        bearer1 = r.json['bearer']
+        r = self.client.post(route, data = verifyData, headers = {
+            'Authorization': 'Bearer ' + bearer1})
+        self.assertEquals(r.status_code, 400)
+
+        r = self.client.post(self.loginRoute, data = json.dumps(data))
+        bearer2 = r.json['bearer']
+        r = self.client.post(route, data = verifyData, headers = {
+            'Authorization': 'Bearer ' + bearer1})
+        self.assertEquals(r.status_code, 401)
+        r = self.client.post(route, data = verifyData, headers = {
+            'Authorization': 'Bearer ' + bearer2})
+        self.assertEquals(r.status_code, 400)
+
+    def test_token_cache(self):
+        cache = TokenCache()
+        cache.set('a' * 32, 'foo')
+        self.assertEquals(cache.get('a' * 32), 'foo')
+        self.assertEquals(cache.get('b' * 32), None)
+
+        cache.set('b' * 32, 'foo')
+        self.assertEquals(cache.get('a' * 32), None)
+        self.assertEquals(cache.get('b' * 32), 'foo')
+
+        cache = TokenCache(-1.0)
+        cache.set('a' * 32, 'foo')
+        self.assertEquals(cache.get('a' * 32), None)
+
+        # Tokens replaced by logging in through another process
+        cache = TokenCache()
+        cache.set('a' * 32, 'foo')
+        self.assertEquals(cache.get('a' * 32, lambda username: None), 'foo')
+        self.assertEquals(cache.get('a' * 32, lambda username: 'a' * 32),
+                          'foo')
+        self.assertEquals(cache.get('a' * 32, lambda username: 'b' * 32),
+                          None)
+        self.assertEquals(cache.get('a' * 32), None)
+
+    def test_post_login_fail_hashing_saturated(self):
+        self.register_foo()
+        data = {'username': 'foo',
+                'password': 'bar'}
+        hasher = flaskapp.password_hasher
+        flaskapp.password_hasher = PasswordHasher(4, 0, 0)
+        try:
+            r = self.client.post(self.loginRoute, data = json.dumps(data))
+            self.assertEquals(r.status_code, 429)
+            r = self.client.post(self.registerRoute, data = json.dumps({
+                'username': 'foo3', 'password': 'bar3'}))
+            self.assertEquals(r.status_code, 429)
+        finally:
+            flaskapp.password_hasher = hasher
+
+    def test_password_hasher(self):
+        for workers in [0, 1]:
+            hasher = PasswordHasher(4, workers, 1)
+            pw_hash = hasher.generate_password_hash(u'bar')
+            self.assertTrue(pw_hash.startswith('$2b$04$'))
+            self.assertTrue(hasher.check_password_hash(pw_hash, 'bar'))
+            self.assertFalse(hasher.check_password_hash(unicode(pw_hash),  # NOQA
+                                                        'baz'))
+            hasher.close()
+
+        with self.assertRaises(PoolSaturatedException):
+            PasswordHasher(4, 0, 0).generate_password_hash('bar')
+
     def test_post_login_fail_wrong_combination(self):
         self.register_foo()
         data = {'username': 'INEXISTENTUSER',
@@ -0,0 +1,76 @@
+from flask_testing import TestCase
+import json
+import unittest
+import flaskapp
+from metrics import Metrics
+
+
+class MetricsTest(TestCase):
+    def create_app(self):
+        app = flaskapp.app
+        app.config['TESTING'] = True
+        app.config['DATASET_DATABASE_URI'] = 'sqlite:///testdb.db'
+        return app
+
+    def setUp(self):
+        flaskapp.metrics.clear()
+        self.app.config['METRICS_ENABLED'] = True
+
+    def tearDown(self):
+        self.app.config['METRICS_ENABLED'] = False
+
+    def test_render(self):
+        metrics = Metrics((0.1, 1.0))
+        metrics.describe('requests_total', 'counter', 'Requests.')
+        metrics.inc('requests_total', {'route': '/a"b'})
+        metrics.inc('requests_total', {'route': '/a"b'}, 2)
+        metrics.observe('latency_seconds', {'route': '/'}, 0.05)
+        metrics.observe('latency_seconds', {'route': '/'}, 0.5)
+        metrics.observe('latency_seconds', {'route': '/'}, 5.0)
+
+        self.assertEquals(metrics.render().splitlines(), [
+            'latency_seconds_bucket{route="/",le="0.1"} 1',
+            'latency_seconds_bucket{route="/",le="1.0"} 2',
+            'latency_seconds_bucket{route="/",le="+Inf"} 3',
+            'latency_seconds_sum{route="/"} 5.55',
+            'latency_seconds_count{route="/"} 3',
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{route="/a\\"b"} 3'])
+
+    def test_get_metrics(self):
+        self.client.post('/robot/0/correction',
+                         data = json.dumps({'correction': 1.0}))
+        self.client.get('/robot/0/batch')
+        self.client.get('/robot/0/batch')
+        self.client.get('/users')
+
+        r = self.client.get('/metrics')
+        self.assertEquals(r.status_code, 200)
+        self.assertTrue(r.content_type.startswith('text/plain'))
+        lines = r.data.splitlines()
+        self.assertTrue('flaskapp_requests_total{method="GET",route="/robot/'
+                        '<int:id>/batch",status="200"} 2' in lines)
+        self.assertTrue('flaskapp_cache_requests_total{cache="robot_batch",'
+                        'result="hit"} 1' in lines)
+        self.assertTrue('flaskapp_cache_requests_total{cache="robot_batch",'
+                        'result="miss"} 1' in lines)
+
+        stages = [line.split(' ')[0] for line in lines
+                  if line.startswith('flaskapp_stage_duration_seconds_count')]
+        self.assertTrue('flaskapp_stage_duration_seconds_count{route='
+                        '"/users",stage="db"}' in stages)
+        self.assertTrue('flaskapp_stage_duration_seconds_count{route='
+                        '"/robot/<int:id>/batch",stage="json"}' in stages)
+
+    def test_get_metrics_error_disabled(self):
+        self.app.config['METRICS_ENABLED'] = False
+        self.client.get('/targets')
+        self.assertEquals(flaskapp.metrics.render(), '\n')
+
+        r = self.client.get('/metrics')
+        self.assertEquals(r.status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
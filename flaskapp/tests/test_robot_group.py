@@ -1,7 +1,10 @@
 from flask_testing import TestCase
 import json
+import threading
+import time
 import unittest
 import flaskapp
+from classes import Robot
 
 
 class RobotGroupTest(TestCase):
@@ -145,6 +148,133 @@ class RobotGroupTest(TestCase):
         self.assertEquals(r.status_code, 200)
         self.check_batch_get_response_match(data)
 
+    def test_get_batch_etag(self):
+        r = self.get_batch()
+        self.assertEquals(r.status_code, 200)
+        etag = r.headers['ETag']
+
+        # Unchanged state is served from cache
+        r = self.client.get(self.routeBase + '/batch',
+                            headers = {'If-None-Match': etag})
+        self.assertEquals(r.status_code, 304)
+        self.assertEquals(r.data, '')
+        r2 = self.get_batch()
+        self.assertEquals(r2.headers['ETag'], etag)
+
+        # Any change produces a new response
+        self.post_angle(12.0)
+        r = self.client.get(self.routeBase + '/batch',
+                            headers = {'If-None-Match': etag})
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json['angle'], 12.0)
+        self.assertNotEquals(r.headers['ETag'], etag)
+
+    def test_batch_response_saved_meanwhile(self):
+        robot = Robot(0)
+        robot.angle = 1.0
+        robot.version = 1
+        dumps = flaskapp.dumps
+
+        def save_meanwhile(response):
+            # Another request saves the robot while the response is built
+            robot.angle = 99.0
+            robot.version = 2
+            return dumps(response)
+
+        flaskapp.dumps = save_meanwhile
+        try:
+            (version, body, etag) = flaskapp.get_robot_batch_response(robot)
+        finally:
+            flaskapp.dumps = dumps
+        self.assertEquals(version, 1)
+
+        (version, body, etag) = flaskapp.get_robot_batch_response(robot)
+        self.assertEquals(version, 2)
+        self.assertEquals(json.loads(body)['angle'], 99.0)
+
+    def test_poll_batch_unchanged(self):
+        r = self.get_batch()
+        version = r.headers['X-Robot-Version']
+        r = self.client.get(self.routeBase + '/batch/poll?timeout=0&version=' +
+                            version)
+        self.assertEquals(r.status_code, 304)
+
+    def test_poll_batch_stale_version(self):
+        r = self.get_batch()
+        version = int(r.headers['X-Robot-Version'])
+        r = self.client.get(self.routeBase + '/batch/poll?timeout=0&version=' +
+                            str(version - 1))
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.headers['X-Robot-Version'], str(version))
+
+    def test_poll_batch_woken_by_update(self):
+        r = self.get_batch()
+        route = (self.routeBase + '/batch/poll?timeout=10&version=' +
+                 r.headers['X-Robot-Version'])
+        result = {}
+
+        def poll():
+            start = time.time()
+            with self.app.test_client() as client:
+                result['response'] = client.get(route)
+            result['elapsed'] = time.time() - start
+
+        thread = threading.Thread(target = poll)
+        thread.start()
+        time.sleep(0.2)
+        self.post_angle(42.0)
+        thread.join()
+
+        self.assertEquals(result['response'].status_code, 200)
+        self.assertEquals(json.loads(result['response'].data)['angle'], 42.0)
+        self.assertTrue(result['elapsed'] < 5)
+
+    def test_poll_batch_error_no_version(self):
+        r = self.client.get(self.routeBase + '/batch/poll')
+        self.assertEquals(r.status_code, 400)
+
+    def test_post_fleet_batch(self):
+        data = [
+            {'robot': 0, 'angle': 1.0, 'correction': 2.0, 'motor': True,
+             'distance': 3.0},
+            {'robot': 1, 'angle': 4.0, 'correction': 5.0, 'motor': False,
+             'distance': 6.0}
+        ]
+        r = self.client.post('/batch', data = json.dumps(data))
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals([x['robot'] for x in r.json], [0, 1])
+        self.assertTrue('error' not in r.json[0])
+        version = r.json[1]['version']
+
+        r = self.client.get('/robot/1/batch')
+        self.assertEquals(r.headers['X-Robot-Version'], str(version))
+        del data[0]['robot']
+        self.check_batch_get_response_match(data[0])
+
+    def test_post_fleet_batch_error_applies_nothing(self):
+        data = [
+            {'robot': 0, 'angle': 1.0, 'correction': 2.0, 'motor': True,
+             'distance': 3.0},
+            {'robot': 1, 'angle': 'foo', 'correction': 5.0, 'motor': False,
+             'distance': 6.0},
+            {'angle': 4.0}
+        ]
+        r = self.client.post('/batch', data = json.dumps(data))
+        self.assertEquals(r.status_code, 400)
+        self.assertEquals(len(r.json), 3)
+        self.assertTrue('error' not in r.json[0])
+        self.assertEquals(r.json[1]['error'], "Supplied angle is not a float")
+        self.assertTrue('error' in r.json[2])
+
+        self.check_batch_get_response_match({'angle': 0.0,
+                                             'correction': 0.0,
+                                             'motor': False,
+                                             'distance': 0.0})
+
+    def test_post_fleet_batch_error_not_list(self):
+        r = self.client.post('/batch', data = json.dumps({'robot': 0}))
+        self.assertEquals(r.status_code, 400)
+
     def test_post_batch_error_null_input(self):
         r = self.client.post(self.routeBase + '/batch', data = '')
         self.assertEquals(r.status_code, 400)
@@ -294,6 +424,50 @@ class RobotGroupTest(TestCase):
         self.assertEquals(r.status_code, 200)
         self.assertEquals(r.json, data)
 
+    def test_post_robot_error_locked(self):
+        timeout = self.app.config.get('ROBOT_LOCK_TIMEOUT')
+        self.app.config['ROBOT_LOCK_TIMEOUT'] = 0.1
+        self.assertTrue(flaskapp.robot_locks.acquire(0, 1.0))
+        try:
+            r = self.post_angle(1.0)
+            self.assertEquals(r.status_code, 409)
+            r = self.client.post(self.routeBase + '/correction',
+                                 data = json.dumps({'correction': 1.0}))
+            self.assertEquals(r.status_code, 409)
+
+            # Other robots are not affected
+            r = self.client.post('/robot/1/angle',
+                                 data = json.dumps({'angle': 1.0}))
+            self.assertEquals(r.status_code, 200)
+        finally:
+            flaskapp.robot_locks.release(0)
+            self.app.config['ROBOT_LOCK_TIMEOUT'] = timeout
+
+        r = self.post_angle(1.0)
+        self.assertEquals(r.status_code, 200)
+
+    def test_post_robot_concurrent_updates(self):
+        version = self.client.get(self.routeBase + '/batch')
+        version = int(version.headers['X-Robot-Version'])
+        statuses = []
+
+        def post():
+            for i in range(0, 10):
+                with self.app.test_client() as client:
+                    statuses.append(client.post(
+                        self.routeBase + '/angle',
+                        data = json.dumps({'angle': 1.0})).status_code)
+
+        threads = [threading.Thread(target=post) for i in range(0, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(statuses, [200] * 40)
+        r = self.client.get(self.routeBase + '/batch')
+        self.assertEquals(int(r.headers['X-Robot-Version']), version + 40)
+
 
 if __name__ == '__main__':
     unittest.main()
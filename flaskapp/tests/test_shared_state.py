@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import tempfile
+import flaskapp
+from allocator import IdAllocator
+from classes import Delivery, Robot
+from store import SQLiteStore
+from tests import test_delivery_group
+
+
+class SharedStateDeliveryGroupTest(test_delivery_group.DeliveryGroupTest):
+    """
+    Runs the delivery tests against a shared SQLite state store, as used
+    when serving with several worker processes.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.previous = (flaskapp.state_store, flaskapp.delivery_index,
+                         flaskapp.delivery_index_position)
+        flaskapp.state_store = SQLiteStore(
+            os.path.join(self.directory, 'state.db'))
+        flaskapp.delivery_index = None
+        flaskapp.delivery_index_position = None
+        super(SharedStateDeliveryGroupTest, self).setUp()
+
+    def tearDown(self):
+        (flaskapp.state_store, flaskapp.delivery_index,
+         flaskapp.delivery_index_position) = self.previous
+        shutil.rmtree(self.directory)
+
+    def test_get_deliveries_added_by_other_worker(self):
+        self.add_data_single()
+        self.post_data_single()
+
+        # Another worker adds a delivery straight to the shared store, with
+        # an ID from its own block
+        cache = flaskapp.state_store.open()
+        id = IdAllocator('deliveryQueue').allocate(cache)
+        delivery = cache['delivery:0']
+        cache['delivery:' + str(id)] = Delivery(
+            id, delivery.fromTarget, delivery.toTarget, 'foo', 'foo2', 1,
+            'Papers')
+        del cache['delivery:0']
+        cache.close()
+
+        r = self.client.get(self.route)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals([d['id'] for d in r.json], [100])
+
+        r = self.client.post(self.route, data = json.dumps(self.data[0]),
+                             headers = self.headers)
+        self.assertEquals(r.json['id'], 1)
+
+    def test_login_on_other_worker(self):
+        self.add_data_single()
+        self.assertEquals(self.post_data_single().status_code, 200)
+
+        # Another worker logs foo in again, replacing the cached bearer
+        bearer = 'b' * 32
+        flaskapp.get_database()['users'].update(
+            {'username': 'foo', 'bearer': bearer}, ['username'])
+        cache = flaskapp.state_store.open()
+        cache[flaskapp.bearer_key('foo')] = bearer
+        cache.close()
+
+        # A new app context, as this worker's next request would get
+        with self.app.app_context():
+            self.assertEquals(self.post_data_single().status_code, 401)
+            self.headers = {'Authorization': 'Bearer ' + bearer}
+            self.assertEquals(self.post_data_single().status_code, 200)
+
+    def test_save_robot_conflict(self):
+        with self.app.test_request_context():
+            robot = flaskapp.get_robot(7)
+
+            # Another worker saves the robot meanwhile
+            cache = flaskapp.state_store.open()
+            other = Robot(7)
+            other.version = 1
+            cache['robot:7'] = other
+            cache.close()
+
+            robot.angle = 1.0
+            with self.assertRaises(flaskapp.ConflictException):
+                flaskapp.save_robot(robot)
+
+    def test_patch_delivery_conflict(self):
+        self.add_data_single()
+        self.post_data_single()
+
+        with self.app.test_request_context():
+            flaskapp.get_delivery_by_id(0)
+
+            # Another worker assigns the delivery meanwhile
+            cache = flaskapp.state_store.open()
+            other = cache['delivery:0']
+            other.robot = 1
+            other.version += 1
+            cache['delivery:0'] = other
+            cache.close()
+
+            with self.assertRaises(flaskapp.ConflictException):
+                flaskapp.patch_delivery_with_json(0, {
+                    'state': 'MOVING_TO_SOURCE', 'robot': 2})
+
+        cache = flaskapp.state_store.open()
+        self.assertEquals(cache['delivery:0'].robot, 1)
+        self.assertFalse('robot:2' in cache)
+        cache.close()
+
+    def test_dispatch_conflict(self):
+        self.add_data_single()
+        self.post_data_single()
+        self.client.post('/robot/0/correction',
+                         data = json.dumps({'correction': 0.0}))
+
+        with self.app.test_request_context():
+            delivery = flaskapp.get_delivery_by_id(0)
+            robot = flaskapp.get_robot(0)
+
+            # Another worker dispatches the delivery meanwhile
+            cache = flaskapp.state_store.open()
+            other = cache['delivery:0']
+            other.robot = 1
+            other.version += 1
+            cache['delivery:0'] = other
+            cache.close()
+
+            flaskapp.start_delivery(delivery, robot)
+            with self.assertRaises(flaskapp.ConflictException):
+                flaskapp.save_robots([robot], [delivery])
+
+        cache = flaskapp.state_store.open()
+        self.assertEquals(cache['delivery:0'].robot, 1)
+        self.assertEquals(cache['robot:0'].delivery, None)
+        cache.close()
@@ -0,0 +1,78 @@
+import unittest
+from classes import Delivery, DeliveryState, Robot
+from statemachine import DELIVERY_STATES, LOCKS, TRANSITIONS, StateMachine
+
+
+class StateMachineTest(unittest.TestCase):
+    def setUp(self):
+        self.delivery = Delivery(0, 1, 2, 'foo', 'foo2', 0, 'Papers',
+                                 robot = 0)
+        self.robot = Robot(0)
+        self.robot.delivery = 0
+
+    def test_states(self):
+        self.assertTrue(DELIVERY_STATES.state('COMPLETE') is
+                        DeliveryState.COMPLETE)
+        self.assertEquals(DELIVERY_STATES.state('FOO'), None)
+
+    def test_check(self):
+        self.assertTrue(DELIVERY_STATES.check(
+            self.delivery, DeliveryState.MOVING_TO_SOURCE))
+        self.assertFalse(DELIVERY_STATES.check(
+            self.delivery, DeliveryState.COMPLETE))
+
+        # Authenticated transitions are only taken through verification
+        self.delivery.state = DeliveryState.AWAITING_AUTHENTICATION_SENDER
+        self.assertFalse(DELIVERY_STATES.check(
+            self.delivery, DeliveryState.AWAITING_PACKAGE_LOAD))
+
+    def test_verification(self):
+        self.assertEquals(DELIVERY_STATES.verification(
+            DeliveryState.IN_QUEUE), None)
+        transition = DELIVERY_STATES.verification(
+            DeliveryState.AWAITING_AUTHENTICATION_RECEIVER)
+        self.assertEquals(transition.target,
+                          DeliveryState.AWAITING_PACKAGE_RETRIEVAL)
+        self.assertEquals(transition.party, 'receiver')
+        self.assertEquals(transition.token, 'receiverAuthToken')
+
+    def test_apply(self):
+        DELIVERY_STATES.apply(self.delivery, self.robot,
+                              DeliveryState.AWAITING_AUTHENTICATION_SENDER)
+        self.assertEquals(self.delivery.state,
+                          DeliveryState.AWAITING_AUTHENTICATION_SENDER)
+        self.assertEquals(self.robot.lock, True)
+        self.assertEquals(self.robot.location, 1)
+
+        DELIVERY_STATES.apply(self.delivery, self.robot,
+                              DeliveryState.AWAITING_PACKAGE_LOAD)
+        self.assertEquals(self.robot.lock, False)
+
+        DELIVERY_STATES.apply(self.delivery, self.robot,
+                              DeliveryState.COMPLETE)
+        self.assertEquals(self.robot.lock, True)
+        self.assertEquals(self.robot.location, 2)
+
+        # Without a robot, only the delivery changes
+        DELIVERY_STATES.apply(self.delivery, None,
+                              DeliveryState.AWAITING_PACKAGE_LOAD)
+        self.assertEquals(self.delivery.state,
+                          DeliveryState.AWAITING_PACKAGE_LOAD)
+        self.assertEquals(self.robot.delivery, None)
+
+    def test_hooks(self):
+        machine = StateMachine(TRANSITIONS, LOCKS)
+        entered = []
+        machine.add_hook(DeliveryState.MOVING_TO_SOURCE,
+                         lambda d, r: entered.append((d.id, r.id)))
+
+        other = Delivery(1, 1, 2, 'foo', 'foo2', 0, 'Papers')
+        machine.apply_all([
+            (self.delivery, self.robot, DeliveryState.MOVING_TO_SOURCE),
+            (other, Robot(1), DeliveryState.MOVING_TO_SOURCE)])
+        self.assertEquals(entered, [(0, 0), (1, 1)])
+        self.assertEquals(other.state, DeliveryState.MOVING_TO_SOURCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,355 @@
+import anydbm
+import codec
+import cPickle
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+from journal import Journal
+from store import MemoryStore, ShelveStore, SQLiteStore, create_store
+from store import is_shared_store, is_threaded_store
+
+
+class Versioned(object):
+    def __init__(self, version):
+        self.version = version
+
+
+class Legacy:
+    """
+    An instance of a classic class, as the domain classes were before they
+    used slots.
+    """
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+def legacy_pickle(value, cls):
+    # Pickle classic instances, then point them at the domain class
+    data = cPickle.dumps(value, 2)
+    return data.replace('c' + __name__ + '\nLegacy\n',
+                        'cclasses\n' + cls + '\n')
+
+
+def increment_counter(filename, count):
+    store = SQLiteStore(filename)
+    for i in range(0, count):
+        cache = store.open()
+        cache.incr('deliveryQueueCounter')
+        cache.close()
+
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_snapshot(self):
+        snapshot = codec.open_shelf(self.filename)
+        try:
+            return dict(snapshot)
+        finally:
+            snapshot.close()
+
+    def test_create_store(self):
+        config = {'SHELVE_FILENAME': self.filename}
+        self.assertTrue(isinstance(create_store(config), ShelveStore))
+
+        config['STATE_STORE'] = 'memory'
+        self.assertTrue(isinstance(create_store(config), MemoryStore))
+        config['STATE_JOURNAL_FILENAME'] = self.filename + '.journal'
+        self.assertTrue(isinstance(create_store(config).journal, Journal))
+
+        config['STATE_STORE'] = 'sqlite'
+        config['STATE_DATABASE_FILENAME'] = self.filename + '.sqlite'
+        self.assertTrue(isinstance(create_store(config), SQLiteStore))
+
+        config['STATE_STORE'] = 'foo'
+        with self.assertRaises(ValueError):
+            create_store(config)
+
+    def test_is_shared_store(self):
+        self.assertFalse(is_shared_store({}))
+        self.assertFalse(is_shared_store({'STATE_STORE': 'memory'}))
+        self.assertTrue(is_shared_store({'STATE_STORE': 'sqlite'}))
+
+    def test_is_threaded_store(self):
+        self.assertFalse(is_threaded_store({}))
+        self.assertTrue(is_threaded_store({'STATE_STORE': 'memory'}))
+        self.assertTrue(is_threaded_store({'STATE_STORE': 'sqlite'}))
+
+    def test_shelve_store_persists_assigned_entries(self):
+        store = ShelveStore(self.filename)
+        cache = store.open()
+        cache['robot:0'] = {'angle': 0.0}
+        cache['robot:1'] = {'angle': 0.0}
+        cache.close()
+
+        cache = store.open()
+        cache['robot:0']['angle'] = 5.0
+        cache['robot:1']['angle'] = 5.0
+        self.assertEquals(cache['robot:1']['angle'], 5.0)
+        cache['robot:0'] = cache['robot:0']
+        cache.close()
+
+        # Only the entry assigned back is written
+        self.assertEquals(self.read_snapshot(), {'robot:0': {'angle': 5.0},
+                                                 'robot:1': {'angle': 0.0}})
+
+    def test_shelve_store_delete(self):
+        store = ShelveStore(self.filename)
+        cache = store.open()
+        cache['robot:0'] = {}
+        cache['robot:1'] = {}
+        cache.sync()
+        del cache['robot:0']
+        self.assertFalse('robot:0' in cache)
+        self.assertEquals(sorted(cache.keys()), ['robot:1'])
+        with self.assertRaises(KeyError):
+            del cache['robot:2']
+        cache.close()
+
+        self.assertEquals(self.read_snapshot(), {'robot:1': {}})
+
+    def test_memory_store_is_resident(self):
+        store = MemoryStore(self.filename, 60.0)
+        store.open()['robots'] = {0: 'foo'}
+        store.open().sync()
+
+        # Nothing is written before the snapshot interval elapses
+        self.assertEquals(self.read_snapshot(), {})
+        self.assertEquals(store.open()['robots'], {0: 'foo'})
+
+    def test_memory_store_flush(self):
+        store = MemoryStore(self.filename, 60.0)
+        store['robots'] = {0: 'foo'}
+        store['deliveries'] = {}
+        store.flush()
+        self.assertEquals(self.read_snapshot(),
+                          {'robots': {0: 'foo'}, 'deliveries': {}})
+
+        del store['deliveries']
+        store.flush()
+        self.assertEquals(self.read_snapshot(), {'robots': {0: 'foo'}})
+
+    def test_memory_store_loads_snapshot(self):
+        store = MemoryStore(self.filename, 0.0)
+        store['deliveryQueueCounter'] = 5
+        store.sync()
+
+        store = MemoryStore(self.filename)
+        self.assertEquals(store['deliveryQueueCounter'], 5)
+
+    def test_memory_store_discards_legacy_snapshot(self):
+        # The layout of the snapshots written before every object had its
+        # own key
+        snapshot = anydbm.open(self.filename, 'c')
+        snapshot['deliveryQueueCounter'] = cPickle.dumps(3, 2)
+        snapshot['robots'] = legacy_pickle(
+            {0: Legacy({'id': 0, 'angle': 1.0})}, 'Robot')
+        snapshot['deliveries'] = legacy_pickle(
+            {0: Legacy({'id': 0, 'name': 'Papers'})}, 'Delivery')
+        snapshot.close()
+        with self.assertRaises(TypeError):
+            codec.loads(legacy_pickle(Legacy({'id': 0}), 'Robot'))
+
+        with warnings.catch_warnings(record = True) as caught:
+            warnings.simplefilter('always')
+            store = MemoryStore(self.filename)
+        self.assertEquals(len(caught), 2)
+        self.assertEquals(sorted(store.keys()), ['deliveryQueueCounter'])
+        self.assertEquals(store['deliveryQueueCounter'], 3)
+
+        store.flush()
+        self.assertEquals(self.read_snapshot(), {'deliveryQueueCounter': 3})
+
+    def test_memory_store_clear(self):
+        store = MemoryStore(self.filename, 0.0)
+        store['deliveryQueueCounter'] = 5
+        store.clear()
+        store.sync()
+
+        self.assertFalse('deliveryQueueCounter' in store)
+        self.assertEquals(self.read_snapshot(), {})
+
+    def test_memory_store_recovers_from_journal(self):
+        journal = Journal(self.filename + '.journal', 0.0)
+        store = MemoryStore(self.filename, 60.0, journal)
+        store['deliveryQueueCounter'] = 5
+        store['robot:0'] = {'angle': 0.0}
+        store.flush()
+        store.update({'robot:0': {'angle': 5.0}, 'robot:1': {}})
+        del store['deliveryQueueCounter']
+
+        # Writes since the snapshot are replayed, then compacted into it
+        journal = Journal(self.filename + '.journal', 0.0)
+        store = MemoryStore(self.filename, 60.0, journal)
+        self.assertEquals(sorted(store.keys()), ['robot:0', 'robot:1'])
+        self.assertEquals(store['robot:0'], {'angle': 5.0})
+        self.assertEquals(self.read_snapshot(),
+                          {'robot:0': {'angle': 5.0}, 'robot:1': {}})
+        self.assertEquals(journal.replay(), [])
+
+    def test_memory_store_syncs_snapshot_before_truncating(self):
+        calls = []
+        journal = Journal(self.filename + '.journal', 0.0)
+        journal.truncate = lambda: calls.append('journal')
+        store = MemoryStore(self.filename, 60.0, journal)
+        store['robot:0'] = {'angle': 0.0}
+
+        fsync_shelf = codec.fsync_shelf
+        codec.fsync_shelf = lambda filename: (calls.append('snapshot'),
+                                              fsync_shelf(filename))
+        try:
+            del calls[:]
+            store.flush()
+        finally:
+            codec.fsync_shelf = fsync_shelf
+        self.assertEquals(calls, ['snapshot', 'journal'])
+
+    def test_sqlite_store_persists_assigned_entries(self):
+        store = SQLiteStore(self.filename)
+        cache = store.open()
+        cache['robot:0'] = {'angle': 0.0}
+        cache['robot:1'] = {'angle': 0.0}
+        cache.close()
+
+        cache = store.open()
+        cache['robot:0']['angle'] = 5.0
+        cache['robot:1']['angle'] = 5.0
+        cache['robot:0'] = cache['robot:0']
+        cache.close()
+
+        cache = store.open()
+        self.assertEquals(sorted(cache.keys()), ['robot:0', 'robot:1'])
+        self.assertEquals(cache['robot:0'], {'angle': 5.0})
+        self.assertEquals(cache['robot:1'], {'angle': 0.0})
+        cache.close()
+
+    def test_sqlite_store_delete(self):
+        store = SQLiteStore(self.filename)
+        cache = store.open()
+        cache['robot:0'] = {}
+        cache['robot:1'] = {}
+        cache.sync()
+        del cache['robot:0']
+        self.assertFalse('robot:0' in cache)
+        self.assertEquals(sorted(cache.keys()), ['robot:1'])
+        with self.assertRaises(KeyError):
+            cache['robot:0']
+        with self.assertRaises(KeyError):
+            del cache['robot:2']
+        cache.close()
+
+        cache = store.open()
+        self.assertEquals(cache.keys(), ['robot:1'])
+        cache.close()
+
+    def test_sqlite_store_compare_and_update(self):
+        store = SQLiteStore(self.filename)
+        cache = store.open()
+        self.assertTrue(cache.compare_and_update(
+            {'robot:0': Versioned(1)}, {'robot:0': 0}))
+
+        other = store.open()
+        self.assertEquals(other['robot:0'].version, 1)
+        self.assertTrue(other.compare_and_update(
+            {'robot:0': Versioned(2)}, {'robot:0': 1}))
+        other.close()
+
+        self.assertFalse(cache.compare_and_update(
+            {'robot:0': Versioned(2)}, {'robot:0': 1}))
+        cache.close()
+
+    def test_shelve_store_compare_and_update(self):
+        store = ShelveStore(self.filename)
+        cache = store.open()
+        robot = Versioned(1)
+        self.assertTrue(cache.compare_and_update({'robot:0': robot},
+                                                 {'robot:0': 0}))
+
+        # Saved again by the same request, before the shelf is synced
+        robot.version = 2
+        self.assertTrue(cache.compare_and_update({'robot:0': robot},
+                                                 {'robot:0': 1}))
+        self.assertFalse(cache.compare_and_update({'robot:0': Versioned(3)},
+                                                  {'robot:0': 1}))
+        self.assertTrue(cache.compare_and_update({'robot:0': Versioned(3)},
+                                                 {'robot:0': 2}))
+        cache.close()
+
+        cache = store.open()
+        self.assertFalse(cache.compare_and_update({'robot:0': Versioned(4)},
+                                                  {'robot:0': 2}))
+        self.assertTrue(cache.compare_and_update({'robot:0': Versioned(4)},
+                                                 {'robot:0': 3}))
+        cache.close()
+
+    def test_memory_store_compare_and_update(self):
+        store = MemoryStore(self.filename)
+        robot = Versioned(0)
+        self.assertTrue(store.compare_and_update({'robot:0': robot},
+                                                 {'robot:0': 0}))
+
+        # The resident object may be updated in place
+        robot.version = 1
+        self.assertTrue(store.compare_and_update({'robot:0': robot},
+                                                 {'robot:0': 0}))
+
+        store['robot:0'] = Versioned(2)
+        self.assertFalse(store.compare_and_update({'robot:0': robot},
+                                                  {'robot:0': 1}))
+
+    def test_sqlite_store_changes(self):
+        store = SQLiteStore(self.filename)
+        cache = store.open()
+        cache['delivery:0'] = 'foo'
+        cache['robot:0'] = 'bar'
+        cache.close()
+
+        (position, reset, entries) = store.changes('delivery:')
+        self.assertTrue(reset)
+        self.assertEquals(entries, [('delivery:0', 'foo')])
+
+        cache = store.open()
+        cache['delivery:1'] = 'baz'
+        del cache['delivery:0']
+        cache.close()
+
+        (position, reset, entries) = store.changes('delivery:', position)
+        self.assertFalse(reset)
+        self.assertEquals(sorted(entries), [('delivery:0', None),
+                                            ('delivery:1', 'baz')])
+        self.assertEquals(store.changes('delivery:', position)[2], [])
+
+        cache = store.open()
+        cache.clear()
+        cache.close()
+        self.assertEquals(store.changes('delivery:', position)[1:],
+                          (True, []))
+
+    def test_sqlite_store_incr_across_processes(self):
+        store = SQLiteStore(self.filename)
+        processes = [multiprocessing.Process(target=increment_counter,
+                                             args=(self.filename, 50))
+                     for i in range(0, 4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        cache = store.open()
+        self.assertEquals(cache['deliveryQueueCounter'], 200)
+        cache['deliveryQueueCounter'] = 0
+        self.assertEquals(cache.incr('deliveryQueueCounter'), 1)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 from flask_testing import TestCase
+import dataset
 import json
 import unittest
 import flaskapp
@@ -202,6 +203,108 @@ class TargetGroupTest(TestCase):
         r = self.client.delete(route)
         self.assertEquals(r.status_code, 404)
 
+    def test_delete_target_removes_it(self):
+        data = self.get_default_data()
+        self.client.post('/targets', data = json.dumps(data[0]))
+        self.client.post('/targets', data = json.dumps(data[1]))
+
+        self.client.delete('/target/1')
+        self.assertEquals(self.client.get('/target/1').status_code, 404)
+        r = self.client.get('/targets')
+        self.assertEquals([t['id'] for t in r.json], [2])
+
+    def test_get_targets_etag(self):
+        data = self.get_default_data()
+        self.client.post('/targets', data = json.dumps(data[0]))
+
+        r = self.client.get('/targets')
+        etag = r.headers['ETag']
+        r = self.client.get('/targets', headers = {'If-None-Match': etag})
+        self.assertEquals(r.status_code, 304)
+
+        self.client.patch('/target/1', data = json.dumps({'color': 'red'}))
+        r = self.client.get('/targets', headers = {'If-None-Match': etag})
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json[0]['color'], 'red')
+        self.assertNotEquals(r.headers['ETag'], etag)
+
+    def test_targets_changed_by_other_worker(self):
+        data = self.get_default_data()
+        self.client.post('/targets', data = json.dumps(data[0]))
+        self.assertEquals(self.client.get('/target/1').json['name'], 'ok')
+
+        # Another worker changes the table and increments its version
+        flaskapp.get_db()['targets'].update({'id': 1, 'name': 'Lobby'},
+                                            ['id'])
+        cache = flaskapp.get_state_store().open()
+        cache.incr(flaskapp.TARGETS_VERSION_KEY)
+        cache.close()
+
+        self.assertEquals(self.client.get('/target/1').json['name'],
+                          'Lobby')
+
+    def test_targets_cleared_by_other_worker(self):
+        data = self.get_default_data()
+        self.client.post('/targets', data = json.dumps(data[0]))
+
+        # Another worker has its own database handle
+        other = dataset.connect(self.app.config['DATASET_DATABASE_URI'])
+        flaskapp.create_schema(other)
+        other['targets'].delete()
+        other['targets'].insert({'name': 'Lobby', 'x': 1.0, 'y': 2.0})
+        other.engine.dispose()
+        cache = flaskapp.get_state_store().open()
+        cache.incr(flaskapp.TARGETS_VERSION_KEY)
+        cache.close()
+
+        r = self.client.post('/targets', data = json.dumps(
+            {'name': 'Reception', 'x': 0, 'y': 0}))
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals([t['name'] for t in r.json],
+                          ['Lobby', 'Reception'])
+
+    def test_post_targets_coordinates(self):
+        data = [{'name': 'Reception', 'x': 1.5, 'y': 2}]
+        self.post_data_single(data)
+        r = self.client.get('/target/1')
+        self.assertEquals(r.json['x'], 1.5)
+        self.assertEquals(r.json['y'], 2.0)
+
+    def test_post_targets_error_coordinates(self):
+        for data in [{'name': 'Reception', 'x': 1.5},
+                     {'name': 'Reception', 'x': 'a', 'y': 1}]:
+            r = self.client.post(self.route, data = json.dumps(data))
+            self.assertEquals(r.status_code, 400)
+
+    def test_get_target_route(self):
+        self.client.post(self.route, data = json.dumps(
+            {'name': 'Reception', 'x': 0, 'y': 0}))
+        self.client.post(self.route, data = json.dumps(
+            {'name': 'Pharmacy', 'x': 3, 'y': 4}))
+        self.client.post(self.route, data = json.dumps({'name': 'Lobby'}))
+
+        r = self.client.get('/target/1/route/2')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json['distance'], 5.0)
+        self.assertEquals(r.json['eta'],
+                          5.0 / flaskapp.app.config['ROBOT_SPEED'])
+
+        r = self.client.get('/target/1/route/3')
+        self.assertEquals(r.json['distance'], None)
+        self.assertEquals(r.json['eta'], None)
+
+        r = self.client.get('/target/1/route/4')
+        self.assertEquals(r.status_code, 404)
+
+        # Moving a target updates its distances
+        self.client.patch('/target/2', data = json.dumps({'x': 0, 'y': 1}))
+        r = self.client.get('/target/1/route/2')
+        self.assertEquals(r.json['distance'], 1.0)
+
+        self.client.delete('/target/2')
+        r = self.client.get('/target/1/route/2')
+        self.assertEquals(r.status_code, 404)
+
 
 if __name__ == '__main__':
     unittest.main()
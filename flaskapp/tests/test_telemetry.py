@@ -0,0 +1,176 @@
+from flask_testing import TestCase
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import flaskapp
+import telemetry
+from classes import Robot
+from telemetry import TelemetryRing, TelemetryHistory, TelemetryLog
+
+
+class TelemetryTest(TestCase):
+    def create_app(self):
+        app = flaskapp.app
+        app.config['TESTING'] = True
+        return app
+
+    def make_ring(self, capacity, count):
+        ring = TelemetryRing(capacity)
+        for i in range(0, count):
+            ring.append((float(i), i * 10.0, i * 100.0, i * 1000.0))
+        return ring
+
+    def test_ring_query(self):
+        ring = self.make_ring(8, 4)
+        self.assertEquals(len(ring), 4)
+        self.assertEquals(ring.query(), {
+            'time': [0.0, 1.0, 2.0, 3.0],
+            'correction': [0.0, 10.0, 20.0, 30.0],
+            'angle': [0.0, 100.0, 200.0, 300.0],
+            'distance': [0.0, 1000.0, 2000.0, 3000.0]
+        })
+
+        self.assertEquals(ring.query(1.0, 2.0)['time'], [1.0, 2.0])
+        self.assertEquals(ring.query(0.5)['time'], [1.0, 2.0, 3.0])
+        self.assertEquals(ring.query(5.0)['time'], [])
+
+    def test_ring_wraps_around(self):
+        ring = self.make_ring(4, 10)
+        self.assertEquals(len(ring), 4)
+        self.assertEquals(ring.query()['time'], [6.0, 7.0, 8.0, 9.0])
+        self.assertEquals(ring.query(until = 7.0)['time'], [6.0, 7.0])
+        self.assertEquals(ring.query(since = 8.0)['angle'], [800.0, 900.0])
+
+    def test_ring_downsampling(self):
+        ring = self.make_ring(16, 10)
+        result = ring.query(points = 3)
+        self.assertEquals(result['time'], [1.0, 4.0, 7.5])
+        self.assertEquals(len(result['distance']), 3)
+
+    def test_history_unknown_robot(self):
+        history = TelemetryHistory(4)
+        self.assertEquals(history.query(0)['time'], [])
+
+    def make_log(self, directory, segmentRecords, maxSegments = 0):
+        log = TelemetryLog(directory, segmentRecords, maxSegments)
+        for i in range(0, 10):
+            r = Robot(i % 2)
+            r.angle = i * 100.0
+            r.motor = i % 4 == 0
+            log.append(float(i), r)
+        return log
+
+    def test_log_query(self):
+        directory = tempfile.mkdtemp()
+        numpy = telemetry.numpy
+        try:
+            log = self.make_log(directory, 4)
+            self.assertEquals(len(log.segments()), 3)
+
+            for module in [numpy, None]:
+                telemetry.numpy = module
+                result = log.query(0)
+                self.assertEquals(result['time'], [0.0, 2.0, 4.0, 6.0, 8.0])
+                self.assertEquals(result['angle'],
+                                  [0.0, 200.0, 400.0, 600.0, 800.0])
+                self.assertEquals(result['motor'], [1, 0, 1, 0, 1])
+                self.assertEquals(log.query(1, 2.0, 5.0)['time'], [3.0, 5.0])
+                self.assertEquals(log.query(1, points = 2)['time'],
+                                  [2.0, 7.0])
+                self.assertEquals(log.query(2)['time'], [])
+            log.close()
+        finally:
+            telemetry.numpy = numpy
+            shutil.rmtree(directory)
+
+    def test_log_query_removed_segment(self):
+        directory = tempfile.mkdtemp()
+        try:
+            log = self.make_log(directory, 4)
+
+            # Another process removes a segment while it is queried
+            segments = log.segments()
+            os.remove(segments[0])
+            log.segments = lambda: segments
+            self.assertEquals(log.query(0)['time'], [4.0, 6.0, 8.0])
+            log.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_log_max_segments(self):
+        directory = tempfile.mkdtemp()
+        try:
+            log = self.make_log(directory, 4, 2)
+            self.assertEquals(len(log.segments()), 2)
+            self.assertEquals(log.query(0)['time'], [4.0, 6.0, 8.0])
+            log.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_log_reopen(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.make_log(directory, 4).close()
+
+            # The last segment still has room, so it is written again
+            log = TelemetryLog(directory, 4, 0)
+            log.append(10.0, Robot(0))
+            self.assertEquals(len(log.segments()), 3)
+
+            # Unless another log is still writing it
+            other = TelemetryLog(directory, 4, 0)
+            other.append(11.0, Robot(0))
+            self.assertEquals(len(log.segments()), 4)
+            self.assertEquals(log.query(0)['time'],
+                              [0.0, 2.0, 4.0, 6.0, 8.0, 10.0, 11.0])
+            other.close()
+            log.close()
+
+            # Segments of another size are never reopened
+            log = TelemetryLog(directory, 2, 0)
+            log.append(12.0, Robot(0))
+            self.assertEquals(len(log.segments()), 5)
+            log.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_get_telemetry_history(self):
+        self.client.post('/robot/4/batch', data = json.dumps({
+            'angle': 2.0, 'correction': 3.0, 'motor': True, 'distance': 4.0}))
+
+        r = self.client.get('/robot/4/telemetry/history')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json['angle'][-1], 2.0)
+        self.assertEquals(r.json['motor'][-1], 1)
+
+    def test_get_telemetry(self):
+        route = '/robot/3/telemetry'
+        self.client.post('/robot/3/angle', data = json.dumps({'angle': 1.0}))
+        self.client.post('/robot/3/batch', data = json.dumps({
+            'angle': 2.0, 'correction': 3.0, 'motor': True, 'distance': 4.0}))
+
+        r = self.client.get(route)
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json['angle'][-2:], [1.0, 2.0])
+        self.assertEquals(r.json['distance'][-1], 4.0)
+
+        since = r.json['time'][-1]
+        r = self.client.get(route + '?since=' + repr(since))
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(r.json['angle'][-1], 2.0)
+        self.assertTrue(min(r.json['time']) >= since)
+
+        r = self.client.get(route + '?points=1')
+        self.assertEquals(r.status_code, 200)
+        self.assertEquals(len(r.json['angle']), 1)
+
+    def test_get_telemetry_error_invalid_query(self):
+        for query in ['?points=0', '?points=foo', '?since=foo']:
+            r = self.client.get('/robot/3/telemetry' + query)
+            self.assertEquals(r.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,6 @@ from flask_testing import TestCase
 import json
 import unittest
 import flaskapp
-import dataset
 
 
 class UsersGroupTest(TestCase):
@@ -15,7 +14,7 @@ class UsersGroupTest(TestCase):
         return self.app
 
     def clear_database(self):
-        db = dataset.connect(self.app.config['DATASET_DATABASE_URI'])
+        db = flaskapp.get_database()
         db['users'].drop()
 
     def setUp(self):
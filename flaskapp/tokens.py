@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class TokenCache:
+    """
+    Maps bearer tokens to usernames for a limited time, so authenticated
+    requests don't need to look the token up in the database. Each user has
+    at most one cached token, as logging in replaces the previous one.
+
+    Logging in through another process can't invalidate the tokens cached
+    here, so cached tokens may also be checked against the current token
+    of their user.
+    """
+
+    def __init__(self, ttl = 300.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._usernames = {}
+        self._bearers = {}
+
+    def get(self, bearer, current = None):
+        """
+        Returns the username for a cached bearer token, or None if the token
+        is unknown or has expired. current, if given, returns the current
+        token of a user, or None if it is unknown.
+        """
+        entry = self._usernames.get(bearer)
+        if entry is None:
+            return None
+
+        (username, expiry) = entry
+        token = None if current is None else current(username)
+        if expiry < time.time() or token not in (None, bearer):
+            with self.lock:
+                if self._bearers.get(username) == bearer:
+                    self._invalidate(username)
+            return None
+
+        return username
+
+    def set(self, bearer, username):
+        with self.lock:
+            self._invalidate(username)
+            self._usernames[bearer] = (username, time.time() + self.ttl)
+            self._bearers[username] = bearer
+
+    def invalidate(self, username):
+        with self.lock:
+            self._invalidate(username)
+
+    def _invalidate(self, username):
+        bearer = self._bearers.pop(username, None)
+        if bearer is not None:
+            self._usernames.pop(bearer, None)
+
+    def clear(self):
+        with self.lock:
+            self._usernames.clear()
+            self._bearers.clear()
@@ -0,0 +1 @@
+from flaskapp import app as application